@@ -16,10 +16,12 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 import argparse
+import os
 import sys
 
 import ksconf
 import ksconf.util
+from ksconf.conf import cache
 from ksconf.commands import KsconfCmd, MyDescriptionHelpFormatter, get_entrypoints
 from ksconf.util.completers import autocomplete
 from ksconf.consts import EXIT_CODE_INTERNAL_ERROR
@@ -41,6 +43,16 @@ version controlled (default) folder, and dealing with more than one layer of
 # ------------------------------------------ wrap to 80 chars ----------------^
 
 
+class _CacheDirAction(argparse.Action):
+    """ Enable the parse cache as soon as the option is seen.  Subcommand arguments (like
+    ConfFileType("r", "load")) are parsed during parse_args(), so waiting until afterwards would
+    be too late. """
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        setattr(namespace, self.dest, values)
+        cache.PARSE_CACHE = cache.ParseCache(values) if values else None
+
+
 def cli(argv=None, _unittest=False):
     parser = argparse.ArgumentParser(fromfile_prefix_chars="@",
                                      formatter_class=MyDescriptionHelpFormatter,
@@ -100,12 +112,19 @@ def cli(argv=None, _unittest=False):
     parser.add_argument("--force-color", action="store_true", default=False,
                         help="Force TTY color mode on.  Useful if piping the output a color-aware "
                              "pager, like 'less -R'")
+    cache_dir = os.environ.get("KSCONF_CACHE_DIR")
+    parser.add_argument("--cache-dir", metavar="DIR", action=_CacheDirAction, default=cache_dir,
+                        help="Cache parsed .conf files in DIR to speed up repeated runs.  "
+                             "Unchanged files are loaded from the cache instead of being "
+                             "re-parsed.  Defaults to the KSCONF_CACHE_DIR environment variable.  "
+                             "See 'ksconf cache' for maintenance.")
 
     # Logging settings -- not really necessary for simple things like 'diff', 'merge', and 'sort';
     # more useful for 'patch', very important for 'combine'
 
 
     autocomplete(parser)
+    cache.PARSE_CACHE = cache.ParseCache(cache_dir) if cache_dir else None
     args = parser.parse_args(argv)
 
     ksconf.util.terminal.FORCE_TTY_COLOR = args.force_color
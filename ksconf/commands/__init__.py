@@ -9,7 +9,9 @@ import textwrap
 # Used by ksconf.commands.* (not locally here)
 from textwrap import dedent
 
-from ksconf.conf.parser import parse_conf, smart_write_conf, write_conf, ConfParserException
+from ksconf.conf import cache as conf_cache
+from ksconf.conf.parser import parse_conf, parse_conf_many, smart_write_conf, write_conf, \
+    ConfParserException
 from ksconf.consts import SMART_CREATE
 from ksconf.util import memoize
 
@@ -26,7 +28,7 @@ class ConfDirProxy(object):
 
 
 class ConfFileProxy(object):
-    def __init__(self, name, mode, stream=None, parse_profile=None, is_file=None):
+    def __init__(self, name, mode, stream=None, parse_profile=None, is_file=None, manifest=None):
         self.name = name
         if is_file is not None:
             self._is_file = is_file
@@ -39,6 +41,10 @@ class ConfFileProxy(object):
         # Not sure if there's a good reason to keep a copy of the data locally?
         self._data = None
         self._parse_profile = parse_profile or {}
+        # Optional WriteManifest used by dump() to skip comparing unchanged files
+        self._manifest = manifest
+        # Set by ConfFileType(action="load");  parsed by KsconfCmd.launch() before run()
+        self._load_pending = False
 
     def is_file(self):
         return self._is_file
@@ -105,6 +111,10 @@ class ConfFileProxy(object):
         parse_profile = dict(self._parse_profile)
         if profile:
             parse_profile.update(profile)
+        parse_cache = conf_cache.PARSE_CACHE
+        if parse_cache is not None and self._is_file:
+            return parse_cache.load(self.name, parse_profile,
+                                    lambda: parse_conf(self.stream, profile=parse_profile))
         data = parse_conf(self.stream, profile=parse_profile)
         return data
 
@@ -117,7 +127,7 @@ class ConfFileProxy(object):
         # write vs smart write here ----
         if self._is_file:
             self.close()
-            return smart_write_conf(self.name, data)
+            return smart_write_conf(self.name, data, manifest=self._manifest)
         else:
             write_conf(self._stream, data)
             return SMART_CREATE
@@ -137,6 +147,76 @@ class ConfFileProxy(object):
         raise NotImplementedError
 
 
+def load_conf_files(proxies, jobs=1):
+    """ Load the data of several ConfFileProxy objects at once.  With more than one job, files
+    are parsed in parallel with parse_conf_many().  The parse cache is used when enabled.
+
+    Returns a list of (proxy, exception) for each file that failed to parse.  The exception is
+    either a ConfParserException, or a TypeError if the parse profile itself is invalid.
+    """
+    proxies = [cfp for cfp in proxies if cfp._data is None]
+    errors = []
+
+    def load(cfp):
+        try:
+            cfp.data
+        except (ConfParserException, TypeError) as e:
+            # TypeError is a bad parse profile rather than a problem with the file
+            errors.append((cfp, e))
+
+    if jobs == 1:
+        for cfp in proxies:
+            load(cfp)
+        return errors
+    parse_cache = conf_cache.PARSE_CACHE
+    # Group files by parse profile, skipping any that are already cached
+    pending = {}
+    for cfp in proxies:
+        if not cfp.is_file():
+            load(cfp)
+            continue
+        profile = cfp._parse_profile
+        key = parse_cache.key(cfp.name, profile) if parse_cache is not None else None
+        if key is not None:
+            data = parse_cache.get(key)
+            if data is not None:
+                cfp._data = data
+                continue
+        pending.setdefault(tuple(sorted(profile.items())), []).append((cfp, key))
+    for (profile, items) in pending.items():
+        results = parse_conf_many([cfp.name for (cfp, _) in items], dict(profile), jobs=jobs)
+        for (cfp, key) in items:
+            try:
+                (_, data) = next(results)
+            except TypeError as e:
+                errors.append((cfp, e))
+                break
+            if isinstance(data, ConfParserException):
+                errors.append((cfp, data))
+                continue
+            cfp._data = data
+            if key is not None:
+                parse_cache.put(key, data)
+    return errors
+
+
+def add_jobs_argument(parser):
+    """ Add the standard '--jobs' option for commands that read many conf files """
+    def job_count(value):
+        try:
+            jobs = int(value)
+        except ValueError:
+            jobs = -1
+        if jobs < 0:
+            parser.error("argument --jobs/-j: expected 0 or a positive number:  {0!r}".format(
+                value))
+        return jobs
+
+    parser.add_argument("--jobs", "-j", metavar="N", type=job_count, default=1, help="""
+        Number of processes used to parse conf files in parallel.
+        Use 0 for one process per CPU.  The default is 1 (no parallel parsing).""")
+
+
 class ConfFileType(object):
     """Factory for creating conf file object types;  returns a lazy-loader ConfFile proxy class
 
@@ -187,17 +267,12 @@ class ConfFileType(object):
                 cfp = ConfFileProxy(string, self._mode, stream=stream,
                                     parse_profile=self._parse_profile, is_file=True)
                 if self._action == "load":
-                    # Force file to be parsed by accessing the 'data' property
-                    d = cfp.data
-                    del d
+                    # Parsed (in bulk) by KsconfCmd.launch(), once all arguments are known
+                    cfp._load_pending = True
                 return cfp
             except IOError as e:
                 message = "can't open '%s': %s"
                 raise ArgumentTypeError(message % (string, e))
-            except ConfParserException as e:
-                raise ArgumentTypeError("failed to parse '%s': %s" % (string, e))
-            except TypeError as e:
-                raise ArgumentTypeError("Parser config error '%s': %s" % (string, e))
 
     def __repr__(self):     # pragma: no cover
         args = self._mode, self._action, self._parse_profile
@@ -264,6 +339,7 @@ class KsconfCmd(object):
 
     def launch(self, args):
         """ Handle flow control betweeen pre_run() / run() / post_run() """
+        self.load_conf_args(args)
         # If this fails, exception is passed up, no handling errors/logging done here.
         self.pre_run(args)
 
@@ -278,6 +354,22 @@ class KsconfCmd(object):
             self.post_run(args, exc)
         return return_code
 
+    def load_conf_args(self, args):
+        """ Parse all the conf files given as ConfFileType(action="load") arguments.  A parsing
+        error is reported as a usage error, just like an unreadable file. """
+        proxies = []
+        for value in vars(args).values():
+            for cfp in (value if isinstance(value, list) else [value]):
+                if isinstance(cfp, ConfFileProxy) and cfp._load_pending:
+                    cfp._load_pending = False
+                    proxies.append(cfp)
+        errors = load_conf_files(proxies, getattr(args, "jobs", 1))
+        if errors:
+            (cfp, e) = errors[0]
+            if isinstance(e, TypeError):
+                self.parser.error("Parser config error '{0}': {1}".format(cfp.name, e))
+            self.parser.error("failed to parse '{0}': {1}".format(cfp.name, e))
+
     def pre_run(self, args):
         """ Pre-run hook.  Any exceptions here prevent run() from being called. """
         pass
@@ -0,0 +1,76 @@
+""" SUBCOMMAND:  ksconf cache <stats|clear>
+
+Usage example:
+
+    ksconf --cache-dir ~/.cache/ksconf cache stats
+
+"""
+from __future__ import absolute_import, unicode_literals
+
+import time
+
+from ksconf.commands import KsconfCmd, dedent
+from ksconf.conf.cache import ParseCache, default_cache_dir
+from ksconf.consts import EXIT_CODE_SUCCESS
+
+
+def _format_size(size):
+    for unit in ("bytes", "KB", "MB"):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = "GB"
+    if unit == "bytes":
+        return "{0} {1}".format(int(size), unit)
+    return "{0:.1f} {1}".format(size, unit)
+
+
+def _format_age(timestamp):
+    if timestamp is None:
+        return "n/a"
+    return "{0}  ({1:.1f} hours ago)".format(
+        time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)),
+        (time.time() - timestamp) / 3600.0)
+
+
+class CacheCmd(KsconfCmd):
+    help = "Show statistics for, or clear, the parsed .conf file cache"
+    description = dedent("""\
+    Manage the persistent parse cache.
+
+    When the global '--cache-dir' option (or the KSCONF_CACHE_DIR environment
+    variable) is given, parsed .conf files are cached in that directory so that
+    repeated runs (like a scheduled 'ksconf combine') don't re-parse unchanged
+    files.  Entries are automatically evicted based on size and age.
+
+    This command uses the same cache directory, or the default location if no
+    cache directory has been given.
+    """)
+    format = "manual"
+
+    def register_args(self, parser):
+        parser.add_argument("action", choices=["stats", "clear"], help="""
+            'stats' reports the number, size, and age of cached entries.
+            'clear' removes cached entries.""")
+        parser.add_argument("--expired", action="store_true", default=False, help="""
+            When clearing, only remove entries beyond the cache's size and age limits.""")
+
+    def run(self, args):
+        parse_cache = ParseCache(args.cache_dir or default_cache_dir())
+        if args.action == "clear":
+            if args.expired:
+                (count, size) = parse_cache.prune()
+            else:
+                (count, size) = parse_cache.clear()
+            self.stdout.write("Removed {0} cache entries ({1}) from {2}\n".format(
+                count, _format_size(size), parse_cache.path))
+        else:
+            stats = parse_cache.stats()
+            self.stdout.write("Cache directory:  {0}\n".format(stats["path"]))
+            self.stdout.write("Entries:          {0}\n".format(stats["entries"]))
+            self.stdout.write("Total size:       {0}  (limit {1})\n".format(
+                _format_size(stats["size"]), _format_size(parse_cache.max_size)))
+            self.stdout.write("Oldest entry:     {0}\n".format(_format_age(stats["oldest"])))
+            self.stdout.write("Newest entry:     {0}\n".format(_format_age(stats["newest"])))
+        return EXIT_CODE_SUCCESS
@@ -10,8 +10,8 @@ from __future__ import absolute_import, unicode_literals
 import os
 from collections import Counter
 
-from ksconf.commands import KsconfCmd, dedent
-from ksconf.conf.parser import parse_conf, PARSECONF_STRICT_NC, ConfParserException
+from ksconf.commands import KsconfCmd, dedent, add_jobs_argument
+from ksconf.conf.parser import parse_conf_many, PARSECONF_STRICT_NC, ConfParserException
 from ksconf.consts import EXIT_CODE_SUCCESS, EXIT_CODE_BAD_CONF_FILE, EXIT_CODE_INTERNAL_ERROR
 from ksconf.util.completers import conf_files_completer
 from ksconf.util.file import _stdin_iter
@@ -33,11 +33,10 @@ class CheckCmd(KsconfCmd):
                          ).completer = conf_files_completer
         parser.add_argument("--quiet", "-q", default=False, action="store_true",
                             help="Reduce the volume of output.")
-        ''' # Do we really need this?
-        parser.add_argument("--max-errors", metavar="INT", type=int, default=0, help=
-            "Abort check if more than this many files fail validation.  "
-            "Useful for a pre-commit hook where any failure is unacceptable.")
-        '''
+        parser.add_argument("--max-errors", metavar="INT", type=int, default=0, help="""
+            Stop checking once this many errors have been found.  By default, every problem in
+            every file is reported.""")
+        add_jobs_argument(parser)
 
     def run(self, args):
         # Should we read a list of conf files from STDIN?
@@ -45,32 +44,45 @@ class CheckCmd(KsconfCmd):
             confs = _stdin_iter()
         else:
             confs = args.conf
+        confs = [(conf, os.path.isfile(conf)) for conf in confs]
         c = Counter()
         exit_code = EXIT_CODE_SUCCESS
-        for conf in confs:
+        results = parse_conf_many([conf for (conf, exists) in confs if exists],
+                                  PARSECONF_STRICT_NC, jobs=args.jobs, check_only=True,
+                                  max_errors=args.max_errors)
+        for (conf, exists) in confs:
             c["checked"] += 1
-            if not os.path.isfile(conf):
+            if not exists:
                 self.stderr.write("Skipping missing file:  {0}\n".format(conf))
                 c["missing"] += 1
                 continue
             try:
-                parse_conf(conf, profile=PARSECONF_STRICT_NC)
-                c["okay"] += 1
-                if not args.quiet:
-                    self.stdout.write("Successfully parsed {0}\n".format(conf))
-                    self.stdout.flush()
-            except ConfParserException as e:
-                self.stderr.write("Error in file {0}:  {1}\n".format(conf, e))
-                self.stderr.flush()
-                exit_code = EXIT_CODE_BAD_CONF_FILE
-                # TODO:  Break out counts by error type/category (there's only a few of them)
-                c["error"] += 1
+                (_, result) = next(results)
             except Exception as e:  # pragma: no cover
                 self.stderr.write("Unhandled top-level exception while parsing {0}.  "
                                   "Aborting.\n{1}\n".format(conf, e))
                 exit_code = EXIT_CODE_INTERNAL_ERROR
                 c["error"] += 1
                 break
+            if isinstance(result, ConfParserException):
+                errors = ["{0}  (line {1})".format(e.value, e.lineno) for e in result.errors]
+                if args.max_errors:
+                    errors = errors[:args.max_errors - c["errors"]]
+                for error in errors:
+                    self.stderr.write("Error in file {0}:  {1}\n".format(conf, error))
+                self.stderr.flush()
+                exit_code = EXIT_CODE_BAD_CONF_FILE
+                # TODO:  Break out counts by error type/category (there's only a few of them)
+                c["error"] += 1
+                c["errors"] += len(errors)
+                if args.max_errors and c["errors"] >= args.max_errors:
+                    self.stderr.write("Stopping after {0} errors.\n".format(c["errors"]))
+                    break
+            else:
+                c["okay"] += 1
+                if not args.quiet:
+                    self.stdout.write("Successfully parsed {0}\n".format(conf))
+                    self.stdout.flush()
         if True:  # show stats or verbose
             self.stdout.write("Completed checking {0[checked]} files.  rc={1} Breakdown:\n"
                               "   {0[okay]} files were parsed successfully.\n"
@@ -13,9 +13,10 @@ import os
 import re
 from collections import defaultdict
 
-from ksconf.commands import ConfFileProxy
-from ksconf.commands import KsconfCmd, dedent
-from ksconf.conf.delta import show_text_diff
+from ksconf.commands import ConfFileProxy, load_conf_files
+from ksconf.commands import KsconfCmd, dedent, add_jobs_argument
+from ksconf.conf.delta import show_text_diff, TEXT_DIFF_CONTEXT, TEXT_DIFF_MAX_SIZE
+from ksconf.conf.manifest import WriteManifest
 from ksconf.conf.merge import merge_conf_files
 from ksconf.conf.parser import PARSECONF_MID, PARSECONF_STRICT
 from ksconf.consts import EXIT_CODE_MISSING_ARG, EXIT_CODE_COMBINE_MARKER_MISSING, SMART_NOCHANGE
@@ -24,6 +25,7 @@ from ksconf.util.completers import DirectoriesCompleter
 from ksconf.util.file import _expand_glob_list, relwalk, _is_binary_file, smart_copy
 
 CONTROLLED_DIR_MARKER = ".ksconf_controlled"
+CONTROLLED_DIR_MANIFEST = ".ksconf_manifest.json"
 
 
 class CombineCmd(KsconfCmd):
@@ -152,6 +154,7 @@ class CombineCmd(KsconfCmd):
                             default=" **** WARNING: This file is managed by 'ksconf combine', do "
                                     "not edit hand-edit this file! ****",
                             help="A warning banner to discourage manual editing of conf files.")
+        add_jobs_argument(parser)
 
     def run(self, args):
         # Ignores case sensitivity.  If you're on Windows, name your files right.
@@ -199,10 +202,24 @@ class CombineCmd(KsconfCmd):
                 tgt_file = os.path.join(root, fn)
                 if tgt_file not in src_file_index:
                     # Todo:  Add support for additional blacklist wildcards (using fnmatch)
-                    if fn == CONTROLLED_DIR_MARKER or fn.endswith(".bak"):
+                    if fn in (CONTROLLED_DIR_MARKER, CONTROLLED_DIR_MANIFEST) or \
+                            fn.endswith(".bak"):
                         continue  # pragma: no cover (peephole optimization)
                     target_extra_files.add(tgt_file)
 
+        # Digests of previously written conf files, so unchanged targets don't need to be re-read
+        manifest = WriteManifest(os.path.join(args.target, CONTROLLED_DIR_MANIFEST))
+
+        # Source conf files can be parsed up front, in parallel
+        conf_srcs = {}
+        for (dest_fn, src_files) in src_file_index.items():
+            if conf_file_re.search(dest_fn):
+                conf_srcs[dest_fn] = [ConfFileProxy(sf, "r", parse_profile=PARSECONF_STRICT)
+                                      for sf in src_files]
+        if args.jobs != 1:
+            # Parse errors are left to be reported by merge_conf_files()
+            load_conf_files([cfp for srcs in conf_srcs.values() for cfp in srcs], args.jobs)
+
         for (dest_fn, src_files) in sorted(src_file_index.items()):
             dest_path = os.path.join(args.target, dest_fn)
 
@@ -225,7 +242,9 @@ class CombineCmd(KsconfCmd):
                                 # Binary files.  Can't compare...
                                 smart_rc = "DRY-RUN (NO-DIFF=BIN)"
                             else:
-                                show_text_diff(self.stdout, dest_path, src_file)
+                                show_text_diff(self.stdout, dest_path, src_file,
+                                               context=TEXT_DIFF_CONTEXT,
+                                               max_size=TEXT_DIFF_MAX_SIZE)
                                 smart_rc = "DRY-RUN (DIFF)"
                     else:
                         smart_rc = "DRY-RUN (NEW)"
@@ -237,8 +256,8 @@ class CombineCmd(KsconfCmd):
             else:
                 # Handle merging conf files
                 dest = ConfFileProxy(os.path.join(args.target, dest_fn), "r+",
-                                     parse_profile=PARSECONF_MID)
-                srcs = [ConfFileProxy(sf, "r", parse_profile=PARSECONF_STRICT) for sf in src_files]
+                                     parse_profile=PARSECONF_MID, manifest=manifest)
+                srcs = conf_srcs.pop(dest_fn)
                 # self.stderr.write("Considering {0:50}  CONF MERGE from source:  {1!r}\n".format(dest_fn, src_files[0]))
                 smart_rc = merge_conf_files(dest, srcs, dry_run=args.dry_run,
                                             banner_comment=args.banner)
@@ -253,3 +272,7 @@ class CombineCmd(KsconfCmd):
             for dest_fn in target_extra_files:
                 self.stderr.write("Remove unwanted file {0}\n".format(dest_fn))
                 os.unlink(os.path.join(args.target, dest_fn))
+                manifest.discard(os.path.join(args.target, dest_fn))
+
+        if not args.dry_run:
+            manifest.save()
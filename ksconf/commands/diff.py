@@ -1,18 +1,25 @@
 """ SUBCOMMAND:  ksconf diff <CONF> <CONF>
+                ksconf diff --baseline <CONF> <CONF> [ <CONF-n> ... ]
 
 Usage example:
 
     ksconf diff default/props.conf default/props.conf
 
+    ksconf diff --baseline golden/props.conf search-heads/*/props.conf
+
 """
 from __future__ import absolute_import, unicode_literals
 
 import argparse
+import json
 
-from ksconf.commands import KsconfCmd, dedent, ConfFileType
-from ksconf.conf.delta import compare_cfgs, show_diff
+from ksconf.commands import KsconfCmd, dedent, ConfFileType, add_jobs_argument, load_conf_files
+from ksconf.conf.delta import iter_compare_cfgs, show_diff, compare_cfgs_many, show_diff_matrix, \
+    write_diff_jsonl, diff_op_to_dict, iter_diff_stats, show_diff_stat, format_stat_totals, \
+    diff_stat_to_dict
 from ksconf.conf.parser import PARSECONF_MID_NC
-from ksconf.consts import EXIT_CODE_DIFF_EQUAL, EXIT_CODE_DIFF_NO_COMMON
+from ksconf.consts import EXIT_CODE_DIFF_EQUAL, EXIT_CODE_DIFF_NO_COMMON, EXIT_CODE_DIFF_CHANGE, \
+    EXIT_CODE_MISSING_ARG
 from ksconf.util.completers import conf_files_completer
 
 
@@ -26,15 +33,30 @@ class DiffCmd(KsconfCmd):
     within any given value will be compared.  Multiline fields are compared in are
     compared in a more traditional 'diff' output so that long savedsearches and
     macros can be compared more easily.
+
+    With '--baseline', each CONF is compared to the baseline file instead, and a
+    compact matrix shows which files differ on which stanzas and keys.
+
+    Use '--format jsonl' for machine-readable output:  one JSON object for each
+    difference, per line, with the keys 'tag' (insert, delete, replace, or
+    equal), 'type' (global, stanza, key, or comments), 'stanza', 'key', 'a',
+    and 'b' (the values from the first and second file).  With '--baseline',
+    each object also includes the 'file' it's from.  Renamed stanzas (with
+    '--detect-renames') have the type 'rename' and the new name in 'new_stanza'.
     """)
     format = "manual"
 
     def register_args(self, parser):
-        parser.add_argument("conf1", metavar="CONF1", help="Left side of the comparison",
+        parser.add_argument("conf", metavar="CONF", nargs="+", help="""
+            The two files to compare (left and right side of the comparison), or with
+            '--baseline', one or more files to compare to the baseline.""",
                             type=ConfFileType("r", "load", parse_profile=PARSECONF_MID_NC)
                             ).completer = conf_files_completer
-        parser.add_argument("conf2", metavar="CONF2", help="Right side of the comparison",
-                            type=ConfFileType("r", "load", parse_profile=PARSECONF_MID_NC)
+        parser.add_argument("--baseline", "-b", metavar="CONF",
+                            type=ConfFileType("r", "load", parse_profile=PARSECONF_MID_NC),
+                            help="""
+            Compare every CONF to this file and summarize the differences as a matrix,
+            with one row for each stanza or key that differs in any file.""",
                             ).completer = conf_files_completer
         parser.add_argument("-o", "--output", metavar="FILE",
                             type=argparse.FileType('w'), default=self.stdout,
@@ -42,19 +64,119 @@ class DiffCmd(KsconfCmd):
         parser.add_argument("--comments", "-C",
                             action="store_true", default=False,
                             help="Enable comparison of comments.  (Unlikely to work consistently)")
+        parser.add_argument("--line-numbers", "-n",
+                            action="store_true", default=False,
+                            help="Show where each stanza is found (file:line) in both files.")
+        parser.add_argument("--format", "-f", choices=["text", "jsonl"], default="text",
+                            help="Output format.  'jsonl' writes one JSON object per line.")
+        parser.add_argument("--skip-equal", action="store_true", default=False, help="""
+            Leave out stanzas and keys that are the same in both files.""")
+        parser.add_argument("--stat", action="store_true", default=False, help="""
+            Only show how many keys were added, removed, or changed in each stanza that
+            differs (or with '--baseline', in each file).  Much faster for large files.""")
+        parser.add_argument("--detect-renames", "-R", action="store_true", default=False,
+                            help="""
+            Report a stanza that's only in one file, but has (nearly) the same keys and
+            values as a stanza that's only in the other file, as renamed.""")
+        add_jobs_argument(parser)
 
     def run(self, args):
         ''' Compare two configuration files. '''
-        args.conf1.set_parser_option(keep_comments=args.comments)
-        args.conf2.set_parser_option(keep_comments=args.comments)
+        if args.baseline:
+            return self.run_baseline(args)
+        if len(args.conf) != 2:
+            self.stderr.write("Must provide exactly two files to compare, or use '--baseline'.\n")
+            return EXIT_CODE_MISSING_ARG
+        (conf1, conf2) = args.conf
+        conf1.set_parser_option(keep_comments=args.comments)
+        conf2.set_parser_option(keep_comments=args.comments)
+        if args.line_numbers:
+            conf1.set_parser_option(keep_positions=True)
+            conf2.set_parser_option(keep_positions=True)
 
-        cfg1 = args.conf1.data
-        cfg2 = args.conf2.data
+        cfg1 = conf1.data
+        cfg2 = conf2.data
 
-        diffs = compare_cfgs(cfg1, cfg2)
-        rc = show_diff(args.output, diffs, headers=(args.conf1.name, args.conf2.name))
+        if args.stat:
+            stats = iter_diff_stats(cfg1, cfg2)
+            if args.format == "jsonl":
+                return self._write_jsonl(args.output, (diff_stat_to_dict(stat) for stat in stats))
+            rc = show_diff_stat(args.output, stats)
+        elif args.format == "jsonl":
+            diffs = iter_compare_cfgs(cfg1, cfg2, comments=args.comments,
+                                      skip_equal=args.skip_equal, renames=args.detect_renames)
+            return write_diff_jsonl(args.output, diffs, skip_equal=args.skip_equal)
+        else:
+            diffs = iter_compare_cfgs(cfg1, cfg2, comments=args.comments, skip_identical=True,
+                                      skip_equal=args.skip_equal, renames=args.detect_renames)
+            positions = None
+            if args.line_numbers:
+                positions = (getattr(cfg1, "positions", None), getattr(cfg2, "positions", None))
+            rc = show_diff(args.output, diffs, headers=(conf1.name, conf2.name),
+                           positions=positions)
         if rc == EXIT_CODE_DIFF_EQUAL:
             self.stderr.write("Files are the same.\n")
         elif rc == EXIT_CODE_DIFF_NO_COMMON:
             self.stderr.write("No common stanzas between files.\n")
         return rc
+
+    def run_baseline(self, args):
+        ''' Compare many configuration files to one baseline. '''
+        if args.stat:
+            return self.run_baseline_stat(args)
+        confs = [args.baseline] + args.conf
+        if args.comments:
+            for conf in confs:
+                conf.set_parser_option(keep_comments=True)
+            # Re-parse (in parallel) with the new option
+            load_conf_files(confs, args.jobs)
+        deltas = compare_cfgs_many(args.baseline.data, (conf.data for conf in args.conf),
+                                   comments=args.comments)
+        if args.format == "jsonl":
+            def iter_dicts():
+                for (conf, delta) in zip(args.conf, deltas):
+                    for op in delta:
+                        d = diff_op_to_dict(op)
+                        d["file"] = conf.name
+                        yield d
+            return self._write_jsonl(args.output, iter_dicts())
+        changed = show_diff_matrix(args.output, args.baseline.name,
+                                   [conf.name for conf in args.conf], deltas)
+        return EXIT_CODE_DIFF_CHANGE if changed else EXIT_CODE_DIFF_EQUAL
+
+    def run_baseline_stat(self, args):
+        ''' Count the differences between many configuration files and one baseline. '''
+        # Parsed stanzas have digests on both sides, so identical ones are skipped quickly
+        base = args.baseline.data
+        if args.format == "jsonl":
+            def iter_dicts():
+                for conf in args.conf:
+                    for stat in iter_diff_stats(base, conf.data):
+                        d = diff_stat_to_dict(stat)
+                        d["file"] = conf.name
+                        yield d
+            return self._write_jsonl(args.output, iter_dicts())
+        changed = 0
+        width = max(len(conf.name) for conf in args.conf)
+        for conf in args.conf:
+            stats = list(iter_diff_stats(base, conf.data))
+            if stats:
+                changed += 1
+                summary = format_stat_totals(stats)
+            else:
+                summary = "(same)"
+            args.output.write("{0:{1}}  {2}\n".format(conf.name, width, summary))
+        args.output.write("{0} of {1} files differ from {2}\n".format(
+            changed, len(args.conf), args.baseline.name))
+        return EXIT_CODE_DIFF_CHANGE if changed else EXIT_CODE_DIFF_EQUAL
+
+    @staticmethod
+    def _write_jsonl(stream, dicts):
+        ''' Write each dict as a line of JSON.  Returns EXIT_CODE_DIFF_CHANGE if there were
+        any, otherwise EXIT_CODE_DIFF_EQUAL. '''
+        rc = EXIT_CODE_DIFF_EQUAL
+        for d in dicts:
+            stream.write(json.dumps(d, sort_keys=True, ensure_ascii=False))
+            stream.write("\n")
+            rc = EXIT_CODE_DIFF_CHANGE
+        return rc
@@ -0,0 +1,46 @@
+""" SUBCOMMAND:  ksconf hash <CONF> [ <CONF-n> ... ]
+
+Usage example:  (Find .conf files with the same content, in any order)
+
+    ksconf hash etc/apps/*/default/props.conf | sort
+
+"""
+from __future__ import absolute_import, unicode_literals
+
+from ksconf.commands import KsconfCmd, dedent, ConfFileType, add_jobs_argument
+from ksconf.conf.parser import PARSECONF_MID_NC, _format_stanza
+from ksconf.consts import EXIT_CODE_SUCCESS
+from ksconf.util.completers import conf_files_completer
+
+
+class HashCmd(KsconfCmd):
+    help = "Show a content digest for .conf files, ignoring order, comments, and whitespace"
+    description = dedent("""\
+    Show a digest of the parsed content of each .conf file.  Files that contain
+    the same stanzas, keys, and values have the same digest, no matter how the
+    stanzas and keys are ordered, or what comments or blank lines they contain.
+
+    The output format is similar to 'sha256sum', but the digest is of the
+    parsed content, not of the file itself.
+    """)
+    format = "manual"
+
+    def register_args(self, parser):
+        parser.add_argument("conf", metavar="FILE", nargs="+",
+                            type=ConfFileType("r", "load", parse_profile=PARSECONF_MID_NC),
+                            help="One or more configuration files to hash."
+                            ).completer = conf_files_completer
+        parser.add_argument("--stanzas", "-s", default=False, action="store_true", help="""
+            Also show the digest of each stanza, so that files can be compared stanza by
+            stanza.""")
+        add_jobs_argument(parser)
+
+    def run(self, args):
+        for conf in args.conf:
+            data = conf.data
+            self.stdout.write("{0}  {1}\n".format(data.hexdigest(), conf.name))
+            if args.stanzas:
+                for stanza in sorted(data):
+                    self.stdout.write("    {0}  [{1}]\n".format(data[stanza].hexdigest(),
+                                                                _format_stanza(stanza)))
+        return EXIT_CODE_SUCCESS
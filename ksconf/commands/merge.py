@@ -8,7 +8,7 @@ Usage example:
 """
 from __future__ import absolute_import, unicode_literals
 
-from ksconf.commands import KsconfCmd, dedent, ConfFileProxy, ConfFileType
+from ksconf.commands import KsconfCmd, dedent, ConfFileProxy, ConfFileType, add_jobs_argument
 from ksconf.conf.merge import merge_conf_files
 from ksconf.conf.parser import PARSECONF_STRICT, PARSECONF_MID
 from ksconf.consts import EXIT_CODE_SUCCESS
@@ -44,6 +44,7 @@ class MergeCmd(KsconfCmd):
         parser.add_argument("--banner", "-b", default="", help="""
             A banner or warning comment added to the top of the TARGET file.
             This is pften used to warn Splunk admins from editing an auto-generated file.""")
+        add_jobs_argument(parser)
 
     def run(self, args):
         ''' Merge multiple configuration files into one '''
@@ -0,0 +1,73 @@
+"""
+SUBCOMMAND:  ksconf merge3 <BASE> <OURS> <THEIRS> [--target=<CONF>]
+
+Usage example:  (Upgrade an app's local settings to a new default)
+
+    ksconf merge3 old/default/props.conf local/props.conf new/default/props.conf
+
+"""
+from __future__ import absolute_import, unicode_literals
+
+from ksconf.commands import KsconfCmd, dedent, ConfFileProxy, ConfFileType, add_jobs_argument
+from ksconf.conf.merge import merge3, MERGE3_OURS, MERGE3_THEIRS
+from ksconf.conf.parser import PARSECONF_MID, PARSECONF_STRICT, _format_stanza
+from ksconf.consts import EXIT_CODE_SUCCESS, EXIT_CODE_MERGE_CONFLICT
+from ksconf.util.completers import conf_files_completer
+
+
+def _format_value(value):
+    if value is None:
+        return "(missing)"
+    if isinstance(value, dict):
+        return "(stanza with {0} keys)".format(len(value))
+    # Not repr(), which shows u'...' for text on Python 2
+    return "'{0}'".format(value)
+
+
+class Merge3Cmd(KsconfCmd):
+    help = "Three-way merge of the changes made to a .conf file in two other copies"
+    description = dedent("""\
+    Merge the changes made to BASE in both OURS and THEIRS.  For example, to
+    upgrade an app, use the previous version's default file as BASE, the local
+    copy as OURS, and the new version's default file as THEIRS.
+
+    Changes made on only one side are merged automatically.  A key (or stanza)
+    that was changed differently on both sides is reported as a conflict, and
+    the value from OURS is kept unless '--prefer theirs' is given.
+    """)
+    format = "manual"
+
+    def register_args(self, parser):
+        for (name, text) in (("base", "The common ancestor of OURS and THEIRS."),
+                             ("ours", "The first modified copy of BASE."),
+                             ("theirs", "The second modified copy of BASE.")):
+            parser.add_argument(name, metavar=name.upper(), help=text,
+                                type=ConfFileType("r", "load", parse_profile=PARSECONF_MID)
+                                ).completer = conf_files_completer
+        parser.add_argument("--target", "-t", metavar="FILE",
+                            type=ConfFileType("r+", "none", parse_profile=PARSECONF_STRICT),
+                            default=ConfFileProxy("<stdout>", "w", self.stdout), help="""
+            Save the merged configuration to this file.
+            If not provided, the merged conf is written to standard output.""",
+                            ).completer = conf_files_completer
+        parser.add_argument("--prefer", choices=[MERGE3_OURS, MERGE3_THEIRS],
+                            default=MERGE3_OURS, help="""
+            Which side's value to keep when there's a conflict.  The default is 'ours'.""")
+        add_jobs_argument(parser)
+
+    def run(self, args):
+        (merged, conflicts) = merge3(args.base.data, args.ours.data, args.theirs.data,
+                                     prefer=args.prefer)
+        for conflict in conflicts:
+            location = "[{0}]".format(_format_stanza(conflict.stanza))
+            if conflict.key is not None:
+                location += " " + conflict.key
+            self.stderr.write("Conflict {0}:  base={1}  ours={2}  theirs={3}\n".format(
+                location, _format_value(conflict.base), _format_value(conflict.ours),
+                _format_value(conflict.theirs)))
+        args.target.dump(merged)
+        if conflicts:
+            self.stderr.write("{0} conflicts;  kept the value from '{1}'.\n".format(
+                len(conflicts), args.prefer))
+            return EXIT_CODE_MERGE_CONFLICT
+        return EXIT_CODE_SUCCESS
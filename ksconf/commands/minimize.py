@@ -16,11 +16,11 @@ from __future__ import absolute_import, unicode_literals
 
 import six
 
-from ksconf.commands import KsconfCmd, dedent, ConfFileType
-from ksconf.conf.delta import compare_cfgs, DIFF_OP_DELETE, DIFF_OP_EQUAL, DiffStanza, \
-    DIFF_OP_INSERT, DIFF_OP_REPLACE, show_diff
-from ksconf.conf.merge import merge_conf_dicts
-from ksconf.conf.parser import GLOBAL_STANZA, _drop_stanza_comments
+from ksconf.commands import KsconfCmd, dedent, ConfFileType, add_jobs_argument
+from ksconf.conf.delta import iter_compare_cfgs, DIFF_OP_DELETE, DIFF_OP_EQUAL, \
+    DiffStanza, DIFF_OP_INSERT, DIFF_OP_REPLACE, show_diff
+from ksconf.conf.merge import LayeredConf
+from ksconf.conf.parser import GLOBAL_STANZA, Conf, Stanza
 from ksconf.conf.parser import PARSECONF_STRICT, PARSECONF_LOOSE
 from ksconf.util.completers import conf_files_completer
 from ksconf.util.file import match_bwlist
@@ -33,11 +33,11 @@ def explode_default_stanza(conf, default_stanza=None):
         default_stanza = conf.get(GLOBAL_STANZA, conf.get("default"))
         if not default_stanza:
             return conf
-    default_stanza = _drop_stanza_comments(default_stanza)
-    n = {}
+    n = Conf()
     for (stanza, content) in six.iteritems(conf):
-        new_content = dict(default_stanza)
+        new_content = Stanza(default_stanza)
         new_content.update(content)
+        new_content.comments.extend(getattr(content, "comments", ()))
         n[stanza] = new_content
     return n
 
@@ -126,6 +126,7 @@ class MinimizeCmd(KsconfCmd):
             Specify a key that should be allowed to be a duplication but should be preserved
             within the minimized output.  For example, it may be esirable keep the
             'disabled' settings in the local file, even if it's enabled by default.""")
+        add_jobs_argument(parser)
 
     def run(self, args):
         if args.explode_default:
@@ -135,7 +136,7 @@ class MinimizeCmd(KsconfCmd):
         else:
             cfgs = [conf.data for conf in args.conf]
         # Merge all config files:
-        default_cfg = merge_conf_dicts(*cfgs)
+        default_cfg = LayeredConf(*cfgs)
         del cfgs
         local_cfg = args.target.data
         orig_cfg = dict(args.target.data)
@@ -145,20 +146,21 @@ class MinimizeCmd(KsconfCmd):
             default_stanza = default_cfg.get(GLOBAL_STANZA, default_cfg.get("default"))
             skeleton_default = dict([(k, {}) for k in args.target.data])
             skeleton_default = explode_default_stanza(skeleton_default, default_stanza)
-            default_cfg = merge_conf_dicts(skeleton_default, default_cfg)
+            default_cfg = LayeredConf(skeleton_default, default_cfg)
 
             local_cfg = explode_default_stanza(local_cfg)
             local_cfg = explode_default_stanza(local_cfg, default_stanza)
 
         minz_cfg = dict(local_cfg)
+        # Stanzas are copied before their first key is removed, since local_cfg is still being
+        # compared (iter_compare_cfgs() is a generator) and shares them with minz_cfg
+        copied = set()
 
         # This may be a bit too simplistic.  Weird interplay may exit between if [default] stanza
         # and ocal [Upstream] stanza line up, but [Upstream] in our default file does not.
         # XXX:  Add a unit test!
 
-        diffs = compare_cfgs(default_cfg, local_cfg, allow_level0=False)
-
-        for op in diffs:
+        for op in iter_compare_cfgs(default_cfg, local_cfg, allow_level0=False):
             if op.tag == DIFF_OP_DELETE:
                 # This is normal.  Don't expect all default content to be mirrored into local
                 continue
@@ -173,9 +175,12 @@ class MinimizeCmd(KsconfCmd):
                                      "".format(op.location.stanza, op.location.key, op.a))
                         '''
                         continue  # pragma: no cover  (peephole optimization)
+                    if op.location.stanza not in copied:
+                        minz_cfg[op.location.stanza] = minz_cfg[op.location.stanza].copy()
+                        copied.add(op.location.stanza)
                     del minz_cfg[op.location.stanza][op.location.key]
                     # If that was the last remaining key in the stanza, delete the entire stanza
-                    if not _drop_stanza_comments(minz_cfg[op.location.stanza]):
+                    if not minz_cfg[op.location.stanza]:
                         del minz_cfg[op.location.stanza]
             elif op.tag == DIFF_OP_INSERT:
                 '''
@@ -192,10 +197,12 @@ class MinimizeCmd(KsconfCmd):
 
         if args.dry_run:
             if args.explode_default:
-                rc = show_diff(self.stdout, compare_cfgs(orig_cfg, minz_cfg),
+                rc = show_diff(self.stdout, iter_compare_cfgs(orig_cfg, minz_cfg,
+                                                              skip_identical=True),
                                headers=(args.target.name, args.target.name + "-new"))
             else:
-                rc = show_diff(self.stdout, compare_cfgs(local_cfg, default_cfg),
+                rc = show_diff(self.stdout, iter_compare_cfgs(local_cfg, default_cfg,
+                                                              skip_identical=True),
                                headers=(args.target.name, args.target.name + "-new"))
             return rc
 
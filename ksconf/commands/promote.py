@@ -16,8 +16,8 @@ from six.moves import input
 
 from ksconf.commands import ConfDirProxy
 from ksconf.commands import KsconfCmd, dedent, ConfFileType
-from ksconf.conf.delta import compare_cfgs, DIFF_OP_DELETE, summarize_cfg_diffs, show_diff, \
-    DIFF_OP_EQUAL, DiffStanza
+from ksconf.conf.delta import iter_compare_cfgs, iter_diff_stats, show_diff_stat, show_diff, \
+    DIFF_OP_DELETE, DIFF_OP_EQUAL, DiffStanza
 from ksconf.conf.merge import merge_conf_dicts
 from ksconf.conf.parser import PARSECONF_STRICT_NC, PARSECONF_STRICT
 from ksconf.consts import EXIT_CODE_FAILED_SAFETY_CHECK, EXIT_CODE_NOTHING_TO_DO, \
@@ -198,9 +198,11 @@ class PromoteCmd(KsconfCmd):
         if args.mode == "ask":
             # Show a summary of how many new stanzas would be copied across; how many key changes.
             # ANd either accept all (batch) or pick selectively (batch)
-            delta = compare_cfgs(cfg_tgt, cfg_src, allow_level0=False)
-            delta = [op for op in delta if op.tag != DIFF_OP_DELETE]
-            summarize_cfg_diffs(delta, self.stderr)
+            # Only counts are needed here;  the full delta is only worked out if it's shown.
+            # (Content only in the target is never removed, so deletes aren't counted.)
+            stats = [stat._replace(deleted=0) for stat in iter_diff_stats(cfg_tgt, cfg_src)
+                     if stat.tag != DIFF_OP_DELETE and (stat.inserted or stat.changed)]
+            show_diff_stat(self.stderr, stats)
 
             while True:
                 resp = input("Would you like to apply ALL changes?  (y/n/d/q)")
@@ -208,6 +210,8 @@ class PromoteCmd(KsconfCmd):
                 if resp == 'q':
                     return EXIT_CODE_USER_QUIT
                 elif resp == 'd':
+                    delta = [op for op in iter_compare_cfgs(cfg_tgt, cfg_src, allow_level0=False)
+                             if op.tag != DIFF_OP_DELETE]
                     show_diff(self.stdout, delta, headers=(args.source.name, args.target.name))
                 elif resp == 'y':
                     args.mode = "batch"
@@ -319,8 +323,7 @@ class PromoteCmd(KsconfCmd):
         ###  Todo:  IMPLEMENT A MANUAL MERGE/DIFF HERE:
         # What ever is migrated, move it OUT of cfg_src, and into cfg_tgt
 
-        diff = compare_cfgs(cfg_tgt, cfg_src, allow_level0=False)
-        for op in diff:
+        for op in iter_compare_cfgs(cfg_tgt, cfg_src, allow_level0=False):
             if op.tag == DIFF_OP_DELETE:
                 # This is normal.   Not all default entries will be updated in local.
                 continue
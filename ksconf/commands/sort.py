@@ -9,19 +9,12 @@ from __future__ import absolute_import, unicode_literals
 
 from ksconf.commands import KsconfCmd, dedent
 from ksconf.conf.parser import parse_conf, PARSECONF_STRICT, smart_write_conf, write_conf, \
-    ConfParserException
+    ConfBuffer, ConfParserException
 from ksconf.consts import SMART_NOCHANGE, EXIT_CODE_BAD_CONF_FILE, EXIT_CODE_SORT_APPLIED, \
     EXIT_CODE_SUCCESS
 from ksconf.util.completers import conf_files_completer
 
 
-def _has_nosort_marker(path):
-    # KISS:  Look for the KSCONF-NO-SORT string in the first 4k of this file.
-    with open(path, "rb") as stream:
-        prefix = stream.read(4096)
-    return b"KSCONF-NO-SORT" in prefix
-
-
 class SortCmd(KsconfCmd):
     help = "Sort a Splunk .conf file creating a normalized format appropriate for version control"
     description = dedent("""\
@@ -80,14 +73,17 @@ class SortCmd(KsconfCmd):
             changes = 0
             for conf in args.conf:
                 try:
-                    if not args.force and _has_nosort_marker(conf.name):
+                    # Read the file just once; the same buffer is used to look for the
+                    # KSCONF-NO-SORT marker, for parsing, and to detect if anything changed.
+                    conf.close()
+                    buf = ConfBuffer.read(conf.name)
+                    if not args.force and buf.has_marker():
                         if not args.quiet:
                             self.stderr.write("Skipping blacklisted file {}\n".format(conf.name))
                         continue
-                    data = parse_conf(conf, profile=PARSECONF_STRICT)
-                    conf.close()
+                    data = buf.parse(PARSECONF_STRICT)
                     smart_rc = smart_write_conf(conf.name, data, stanza_delim=stanza_delims,
-                                                sort=True)
+                                                sort=True, original=buf)
                 except ConfParserException as e:
                     smart_rc = None
                     self.stderr.write("Error trying to process file {0}.  "
@@ -10,13 +10,13 @@ from __future__ import absolute_import, print_function, unicode_literals
 
 import os
 import re
-from io import StringIO
 from subprocess import list2cmdline
 
 from ksconf.archive import extract_archive, gaf_filter_name_like, sanity_checker, \
     gen_arch_file_remapper
 from ksconf.commands import KsconfCmd, dedent
-from ksconf.conf.parser import parse_conf, PARSECONF_LOOSE, ConfParserException, default_encoding
+from ksconf.conf.lazy import LazyConf
+from ksconf.conf.parser import parse_conf, PARSECONF_LOOSE, ConfParserException
 from ksconf.consts import EXIT_CODE_FAILED_SAFETY_CHECK, EXIT_CODE_GIT_FAILURE
 from ksconf.util.compare import _cmp_sets
 from ksconf.util.completers import DirectoriesCompleter, FilesCompleter
@@ -134,10 +134,9 @@ class UnarchiveCmd(KsconfCmd):
             gaf_app, gaf_relpath = gaf.path.split("/", 1)
             files += 1
             if gaf.path.endswith("app.conf") and gaf.payload:
-                conffile = StringIO(gaf.payload.decode(default_encoding))
-                conffile.name = os.path.join(args.tarball, gaf.path)
-                app_conf = parse_conf(conffile, profile=PARSECONF_LOOSE)
-                del conffile
+                # Only a few stanzas are needed; skip parsing the rest
+                app_conf = LazyConf(gaf.payload, os.path.join(args.tarball, gaf.path),
+                                    profile=PARSECONF_LOOSE)
             elif gaf_relpath.startswith("local") or gaf_relpath.endswith("local.meta"):
                 local_files.add(gaf_relpath)
             app_name.add(gaf.path.split("/", 1)[0])
@@ -0,0 +1,256 @@
+""" Persistent on-disk cache of parsed .conf files.
+
+Entries are keyed on the file's real path, modification time, size, inode, and the parse profile,
+so any change to the file (or to how it's parsed) results in a cache miss.  Parsed content is
+stored as a pickle.  Caching is opt-in:  use the global '--cache-dir' option (or set the
+KSCONF_CACHE_DIR environment variable) to enable it.
+
+For large files, a stanza index is also stored (keyed on just the path and profile) with a digest
+of each stanza's raw content.  When such a file changes, only the stanzas whose content changed
+are parsed again;  the rest are taken from the previously cached result.
+
+The content digest (see Conf.digest()) of each file and stanza is computed before it's stored.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+import logging
+import os
+import sys
+import time
+from tempfile import mkstemp
+
+from six.moves import cPickle as pickle
+
+import ksconf
+from ksconf.conf.lazy import LazyConf
+from ksconf.conf.parser import Conf, ConfParserException
+from ksconf.util.file import atomic_replace
+
+# Bump this whenever the structure returned by parse_conf() changes
+CACHE_FORMAT = 5
+
+CACHE_MAX_SIZE = 256 * 1024 * 1024
+CACHE_MAX_AGE = 30 * 24 * 60 * 60
+
+# Files at least this big get a stanza index, for incremental re-parsing
+CACHE_INDEX_MIN_SIZE = 1024 * 1024
+
+# Active cache used by ConfFileProxy.load();  set by the '--cache-dir' CLI option
+PARSE_CACHE = None
+
+_ENTRY_SUFFIX = ".pickle"
+
+logger = logging.getLogger(__name__)
+
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "ksconf")
+
+
+class ParseCache(object):
+    """ Directory of pickled parse_conf() results.  The cache is purely an optimization, so any
+    problem reading or writing an entry is treated as a cache miss rather than an error. """
+
+    def __init__(self, path, max_size=CACHE_MAX_SIZE, max_age=CACHE_MAX_AGE,
+                 index_min_size=CACHE_INDEX_MIN_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.index_min_size = index_min_size
+        self.hits = 0
+        self.misses = 0
+        # Number of stanzas reused (and re-parsed) by incremental parsing
+        self.stanzas_reused = 0
+        self.stanzas_parsed = 0
+        self._pruned = False
+
+    def key(self, filename, profile):
+        """ Return the cache key for parsing `filename` with `profile`, or None if the file
+        can't be stat()ed. """
+        path = os.path.realpath(filename)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        mtime_ns = getattr(st, "st_mtime_ns", None)
+        if mtime_ns is None:  # pragma: no cover  (Python 2)
+            mtime_ns = int(st.st_mtime * 1e9)
+        parts = (CACHE_FORMAT, ksconf.__version__, sys.version_info[:2], path, mtime_ns,
+                 st.st_size, st.st_ino, sorted(profile.items()))
+        return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+    def index_key(self, filename, profile):
+        """ Return the key of the stanza index for `filename`, which (unlike key()) doesn't change
+        when the file is modified. """
+        parts = (CACHE_FORMAT, "index", ksconf.__version__, sys.version_info[:2],
+                 os.path.realpath(filename), sorted(profile.items()))
+        return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key + _ENTRY_SUFFIX)
+
+    def _read(self, key):
+        entry = self._entry_path(key)
+        try:
+            with open(entry, "rb") as stream:
+                data = pickle.load(stream)
+        except (IOError, OSError):
+            return None
+        except Exception:
+            # Unreadable entry (truncated, or from an incompatible version);  drop it
+            self._remove(entry)
+            return None
+        # Keep recently used entries from being evicted
+        try:
+            os.utime(entry, None)
+        except OSError:  # pragma: no cover
+            pass
+        return data
+
+    def get(self, key):
+        """ Return the cached parse result for `key`, or None """
+        data = self._read(key)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """ Store a parse result.  Writes are atomic, so concurrent runs never see a partial
+        entry.  Returns True if the entry was written;  a warning is logged if it couldn't be. """
+        if isinstance(data, Conf):
+            # Store the content digests too, so they're free to use on a cache hit
+            data.digest()
+        entry = self._entry_path(key)
+        entry_dir = os.path.dirname(entry)
+        temp = None
+        try:
+            if not os.path.isdir(entry_dir):
+                os.makedirs(entry_dir)
+            fd, temp = mkstemp(suffix=".tmp", dir=entry_dir)
+            with os.fdopen(fd, "wb") as stream:
+                pickle.dump(data, stream, pickle.HIGHEST_PROTOCOL)
+            atomic_replace(temp, entry)
+            temp = None
+        except (IOError, OSError, pickle.PicklingError, TypeError, AttributeError) as e:
+            # Not fatal (the content was parsed fine), but a cache that never stores anything
+            # shouldn't go unnoticed
+            logger.warning("Unable to write parse cache entry %s:  %s", entry, e)
+            return False
+        finally:
+            if temp:
+                self._remove(temp)
+        # Enforce size and age limits once per run, not on every write
+        if not self._pruned:
+            self.prune()
+        return True
+
+    def load(self, filename, profile, parse):
+        """ Return the parsed content of `filename`.  On a cache miss, `parse()` is called and
+        its result is stored. """
+        key = self.key(filename, profile)
+        if key is None:
+            return parse()
+        data = self.get(key)
+        if data is not None:
+            return data
+        if os.path.getsize(filename) < self.index_min_size or profile.get("keep_positions"):
+            # Line numbers of reused stanzas could be out of date, so positions need a full parse
+            data = parse()
+        else:
+            data = self._load_indexed(filename, profile, key, parse)
+        self.put(key, data)
+        return data
+
+    def _load_indexed(self, filename, profile, key, parse):
+        """ Parse a large file, reusing any unchanged stanzas from the last cached parse.  The
+        stanza index is updated to point to the new entry (stored under `key`).  The file is only
+        read once;  `parse()` is only called to report errors. """
+        with open(filename, "rb") as stream:
+            raw = stream.read()
+        index_key = self.index_key(filename, profile)
+        index = self._read(index_key)
+        previous = self._read(index["entry"]) if index else None
+        old_digests = index["stanzas"] if previous is not None else {}
+        data = Conf()
+        try:
+            conf = LazyConf(raw, filename, profile=profile)
+            digests = conf.digests()
+            for stanza in conf:
+                if previous is not None and old_digests.get(stanza) == digests[stanza] and \
+                        stanza in previous:
+                    data[stanza] = previous[stanza]
+                    self.stanzas_reused += 1
+                else:
+                    data[stanza] = conf[stanza]
+                    if previous is not None:
+                        self.stanzas_parsed += 1
+        except ConfParserException:
+            # Let the full parser report the error, so it's exactly the same
+            return parse()
+        self.put(index_key, {"entry": key, "stanzas": digests})
+        return data
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.unlink(path)
+            return True
+        except OSError:
+            return False
+
+    def entries(self):
+        """ Yield (path, size, mtime) for each cache entry """
+        if not os.path.isdir(self.path):
+            return
+        for entry_dir in os.listdir(self.path):
+            entry_dir = os.path.join(self.path, entry_dir)
+            if not os.path.isdir(entry_dir):
+                continue
+            for fn in os.listdir(entry_dir):
+                if not fn.endswith(_ENTRY_SUFFIX):
+                    continue
+                path = os.path.join(entry_dir, fn)
+                try:
+                    st = os.stat(path)
+                except OSError:  # pragma: no cover  (removed by a concurrent process)
+                    continue
+                yield (path, st.st_size, st.st_mtime)
+
+    def stats(self):
+        """ Return a dict summarizing the cache contents """
+        entries = list(self.entries())
+        mtimes = [mtime for (_, _, mtime) in entries]
+        return {
+            "path": self.path,
+            "entries": len(entries),
+            "size": sum(size for (_, size, _) in entries),
+            "oldest": min(mtimes) if mtimes else None,
+            "newest": max(mtimes) if mtimes else None,
+        }
+
+    def prune(self, max_size=None, max_age=None):
+        """ Evict entries older than `max_age` seconds, and then the least recently used entries
+        until the cache is no larger than `max_size` bytes.  Returns (entries, bytes) removed. """
+        if max_size is None:
+            max_size = self.max_size
+        if max_age is None:
+            max_age = self.max_age
+        self._pruned = True
+        now = time.time()
+        total = removed = removed_size = 0
+        for (path, size, mtime) in sorted(self.entries(), key=lambda e: e[2], reverse=True):
+            if now - mtime > max_age or total + size > max_size:
+                if self._remove(path):
+                    removed += 1
+                    removed_size += size
+            else:
+                total += size
+        return (removed, removed_size)
+
+    def clear(self):
+        """ Remove all cache entries.  Returns (entries, bytes) removed. """
+        return self.prune(max_size=0, max_age=0)
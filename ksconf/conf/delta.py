@@ -1,17 +1,20 @@
 from __future__ import absolute_import, unicode_literals
 
 import datetime
-import difflib
+import json
 import os
-from collections import namedtuple, defaultdict, Counter
+from collections import namedtuple, defaultdict, deque, Counter
 from io import open
+from itertools import chain
 
 import six
 
-from ksconf.conf.parser import GLOBAL_STANZA, _format_stanza, default_encoding
+from ksconf.conf.parser import GLOBAL_STANZA, _format_stanza, default_encoding, same_content
 from ksconf.consts import EXIT_CODE_DIFF_EQUAL, EXIT_CODE_DIFF_CHANGE, EXIT_CODE_DIFF_NO_COMMON
-from ksconf.util.compare import _cmp_sets
-from ksconf.util.terminal import ANSI_RESET, ANSI_GREEN, ANSI_RED, tty_color, ANSI_YELLOW, ANSI_BOLD
+from ksconf.util.compare import _cmp_sets, diff_lines, line_opcodes, similar_pairs
+from ksconf.util.file import file_hash
+from ksconf.util.terminal import ANSI_RESET, ANSI_GREEN, ANSI_RED, ANSI_YELLOW, ANSI_BOLD, \
+    TermWriter
 
 ####################################################################################################
 ## Diff logic
@@ -20,14 +23,25 @@ DIFF_OP_INSERT = "insert"
 DIFF_OP_DELETE = "delete"
 DIFF_OP_REPLACE = "replace"
 DIFF_OP_EQUAL = "equal"
+DIFF_OP_RENAME = "rename"
 
 DiffOp = namedtuple("DiffOp", ("tag", "location", "a", "b"))
 DiffGlobal = namedtuple("DiffGlobal", ("type",))
 DiffStanza = namedtuple("DiffStanza", ("type", "stanza"))
 DiffStzKey = namedtuple("DiffStzKey", ("type", "stanza", "key"))
+DiffStzComments = namedtuple("DiffStzComments", ("type", "stanza"))
+DiffStzRename = namedtuple("DiffStzRename", ("type", "stanza", "new_stanza"))
 
+# Minimum similarity (Jaccard index of the keys and key/value pairs) of a stanza that's only in
+# one file and a stanza that's only in the other, for them to be reported as a rename.
+RENAME_THRESHOLD = 0.7
 
-def compare_cfgs(a, b, allow_level0=True):
+
+def _comment_text(stanza):
+    return [text for (_, text) in getattr(stanza, "comments", ())]
+
+
+def compare_cfgs(a, b, allow_level0=True, comments=False):
     '''
     Opcode tags borrowed from difflib.SequenceMatcher
 
@@ -50,70 +64,366 @@ def compare_cfgs(a, b, allow_level0=True):
     (1, stanza)         Stanzas are the same, or completely different (no shared keys)
     (2, stanza, key)    Key level, indicating
 
+    Comments are ignored unless `comments` is True, in which case each stanza's comments are
+    compared as a whole and reported with a DiffStzComments location.
+
+    Files and stanzas with the same (already computed) content digest, like freshly parsed
+    content, are reported as equal without comparing them key by key.
+
+    See iter_compare_cfgs() to process the differences one at a time.
 
     Possible alternatives:
 
     https://dictdiffer.readthedocs.io/en/latest/#dictdiffer.patch
 
     '''
-
-    delta = []
+    return list(iter_compare_cfgs(a, b, allow_level0, comments))
+
+
+def _stanza_tokens(stanza):
+    """ Set of the keys and key/value pairs of a stanza, for similarity comparisons """
+    tokens = set(stanza)
+    tokens.update("{0}\0{1}".format(key, value) for (key, value) in six.iteritems(stanza))
+    return tokens
+
+
+def find_stanza_renames(a, b, threshold=None):
+    """ Find stanzas that appear to have been renamed between confs `a` and `b`:  a stanza found
+    only in `a` with (nearly) the same content as a stanza found only in `b`.  Returns a dict
+    mapping each stanza name in `a` to the new name in `b`.
+
+    Stanzas with the same content are paired up first;  the others are matched by similarity
+    (see similar_pairs()), if at least `threshold` (default RENAME_THRESHOLD).  Each stanza is
+    only part of one rename, the most similar one.  Empty stanzas, and the global stanza, are
+    never reported as renamed. """
+    if threshold is None:
+        threshold = RENAME_THRESHOLD
+    deleted = dict((stanza, _stanza_tokens(a[stanza])) for stanza in set(a).difference(b)
+                   if stanza is not GLOBAL_STANZA and a[stanza])
+    inserted = dict((stanza, _stanza_tokens(b[stanza])) for stanza in set(b).difference(a)
+                    if stanza is not GLOBAL_STANZA and b[stanza])
+    renames = {}
+    if not deleted or not inserted:
+        return renames
+    # Same content:  pair them up in order
+    by_content = defaultdict(lambda: ([], []))
+    for (side, stanzas) in enumerate((deleted, inserted)):
+        for (stanza, tokens) in six.iteritems(stanzas):
+            by_content[frozenset(tokens)][side].append(stanza)
+    for (old, new) in six.itervalues(by_content):
+        for (stanza_a, stanza_b) in zip(sorted(old), sorted(new)):
+            renames[stanza_a] = stanza_b
+            del deleted[stanza_a]
+            del inserted[stanza_b]
+    # Similar content
+    matched = set()
+    for (_, stanza_a, stanza_b) in similar_pairs(deleted, inserted, threshold):
+        if stanza_a not in renames and stanza_b not in matched:
+            renames[stanza_a] = stanza_b
+            matched.add(stanza_b)
+    return renames
+
+
+def iter_compare_cfgs(a, b, allow_level0=True, comments=False, skip_equal=False,
+                      skip_identical=False, renames=False):
+    """ Generator version of compare_cfgs().  Yields the same DiffOp tuples, in the same
+    order (stanza by stanza), but only works out the differences of each stanza as it's needed.
+
+    If `skip_equal` is True, no DIFF_OP_EQUAL ops are produced at all (except for the single
+    global op when the files are the same).  If `skip_identical` is True, stanzas that are
+    exactly the same are skipped, but unchanged keys within a modified stanza are still
+    reported.
+
+    If `renames` is True, stanzas that appear to have been renamed (see find_stanza_renames())
+    are reported as a single DIFF_OP_RENAME op with a DiffStzRename location (in the position of
+    the old name), rather than as a delete and an insert.  The op's `a` and `b` are the old and
+    new stanza.
+    """
+    skip_identical = skip_identical or skip_equal
 
     # Level 0 - Compare entire file
     if allow_level0:
-        stanza_a, stanza_common, stanza_b = _cmp_sets(list(a.keys()), list(b.keys()))
-        if a == b:
-            return [DiffOp(DIFF_OP_EQUAL, DiffGlobal("global"), a, b)]
-        if not stanza_common:
-            # Q:  Does this specific output make the consumer's job more difficult?
-            # Nothing in common between these two files
-            # Note:  Stanza renames are not detected and are out of scope.
-            return [DiffOp(DIFF_OP_REPLACE, DiffGlobal("global"), a, b)]
-
-    # Level 1 - Compare stanzas
-
-    # Make sure GLOBAL stanza is output first
-    all_stanzas = set(a.keys()).union(list(b.keys()))
-    if GLOBAL_STANZA in all_stanzas:
-        all_stanzas.remove(GLOBAL_STANZA)
-        all_stanzas = [GLOBAL_STANZA] + list(all_stanzas)
+        if (same_content(a, b) or a == b) and (not comments or
+                                               all(_comment_text(a[s]) == _comment_text(b[s])
+                                                   for s in a)):
+            yield DiffOp(DIFF_OP_EQUAL, DiffGlobal("global"), a, b)
+            return
+    renamed = find_stanza_renames(a, b) if renames else {}
+    if allow_level0 and not renamed and not any(stanza in b for stanza in a):
+        # Q:  Does this specific output make the consumer's job more difficult?
+        # Nothing in common between these two files
+        yield DiffOp(DIFF_OP_REPLACE, DiffGlobal("global"), a, b)
+        return
+    renamed_to = set(six.itervalues(renamed))
+
+    # Level 1 - Compare stanzas  (GLOBAL stanza sorts first)
+    for stanza in sorted(set(a).union(b)):
+        if stanza in a and stanza in b:
+            for op in _compare_stanzas(stanza, a[stanza], b[stanza], comments, skip_equal,
+                                       skip_identical):
+                yield op
+        elif stanza in renamed:
+            new_stanza = renamed[stanza]
+            yield DiffOp(DIFF_OP_RENAME, DiffStzRename("rename", stanza, new_stanza),
+                         a[stanza], b[new_stanza])
+        elif stanza in a:
+            # A only
+            yield DiffOp(DIFF_OP_DELETE, DiffStanza("stanza", stanza), None, a[stanza])
+        elif stanza not in renamed_to:
+            # B only
+            yield DiffOp(DIFF_OP_INSERT, DiffStanza("stanza", stanza), b[stanza], None)
+
+
+def _compare_stanzas(stanza, a_, b_, comments, skip_equal, skip_identical, keys_a=None):
+    """ Yield the DiffOps for a stanza found on both sides.  `keys_a` may be given as a
+    pre-built set of a_'s keys. """
+    if comments:
+        comments_a = _comment_text(a_)
+        comments_b = _comment_text(b_)
     else:
-        all_stanzas = list(all_stanzas)
-    all_stanzas = sorted(all_stanzas)
+        comments_a = comments_b = None
+    # Note: make sure that '==' operator continues work with custom conf parsing classes.
+    if (same_content(a_, b_) or a_ == b_) and comments_a == comments_b:
+        if not skip_identical:
+            yield DiffOp(DIFF_OP_EQUAL, DiffStanza("stanza", stanza), a_, b_)
+        return
+    if keys_a is None:
+        keys_a = set(a_)
+    kv_a, kv_common, kv_b = _cmp_sets(keys_a, b_.keys())
+    if not kv_common:
+        # No keys in common, just swap
+        yield DiffOp(DIFF_OP_REPLACE, DiffStanza("stanza", stanza), a_, b_)
+        return
+
+    # Level 2 - Key comparisons
+    for key in kv_a:
+        yield DiffOp(DIFF_OP_DELETE, DiffStzKey("key", stanza, key), None, a_[key])
+    for key in kv_b:
+        yield DiffOp(DIFF_OP_INSERT, DiffStzKey("key", stanza, key), b_[key], None)
+    for key in kv_common:
+        a__ = a_[key]
+        b__ = b_[key]
+        if a__ != b__:
+            yield DiffOp(DIFF_OP_REPLACE, DiffStzKey("key", stanza, key), a__, b__)
+        elif not skip_equal:
+            yield DiffOp(DIFF_OP_EQUAL, DiffStzKey("key", stanza, key), a__, b__)
+    if comments_a != comments_b:
+        location = DiffStzComments("comments", stanza)
+        if not comments_b:
+            yield DiffOp(DIFF_OP_DELETE, location, None, comments_a)
+        elif not comments_a:
+            yield DiffOp(DIFF_OP_INSERT, location, comments_b, None)
+        else:
+            yield DiffOp(DIFF_OP_REPLACE, location, comments_a, comments_b)
 
-    for stanza in all_stanzas:
-        if stanza in a and stanza in b:
+
+def compare_cfgs_many(base, others, comments=False):
+    """ Compare one baseline conf against many others (for example, the same file taken from
+    every member of a cluster).  Yields a list of DiffOps for each conf in `others`, in order,
+    in the same form as iter_compare_cfgs(base, other, allow_level0=False, skip_equal=True).
+    The list is empty when the content is the same.
+
+    The baseline is only indexed once:  its stanza names and the keys of each stanza are
+    collected up front, and its content digests are computed, so any conf that already has
+    digests (like parsed or cached content) can be matched without comparing it.
+    """
+    if hasattr(base, "digest"):
+        base.digest()
+    base_stanzas = set(base)
+    base_keys = {}
+    for other in others:
+        if (same_content(base, other) or base == other) and \
+                (not comments or all(_comment_text(base[s]) == _comment_text(other[s])
+                                     for s in base)):
+            yield []
+            continue
+        delta = []
+        for stanza in sorted(base_stanzas.union(other)):
+            if stanza not in other:
+                delta.append(DiffOp(DIFF_OP_DELETE, DiffStanza("stanza", stanza), None,
+                                    base[stanza]))
+            elif stanza not in base_stanzas:
+                delta.append(DiffOp(DIFF_OP_INSERT, DiffStanza("stanza", stanza), other[stanza],
+                                    None))
+            else:
+                a_ = base[stanza]
+                keys_a = base_keys.get(stanza)
+                if keys_a is None:
+                    keys_a = base_keys[stanza] = set(a_)
+                delta.extend(_compare_stanzas(stanza, a_, other[stanza], comments, True, True,
+                                              keys_a))
+        yield delta
+
+
+def _json_text(value):
+    """ Native (byte) strings are decoded, so that on Python 2 they serialize and sort exactly
+    like the same unicode text """
+    if isinstance(value, bytes):
+        return value.decode(default_encoding)
+    return value
+
+
+def _json_stanza_name(stanza):
+    return None if stanza is GLOBAL_STANZA else _json_text(stanza)
+
+
+def _json_stanza_key(stanza):
+    return stanza if stanza is GLOBAL_STANZA else _json_text(stanza)
+
+
+def _json_keys(stanza):
+    return dict((_json_text(k), _json_text(v)) for (k, v) in six.iteritems(stanza))
+
+
+def _json_value(value):
+    if isinstance(value, dict):
+        if value and all(isinstance(v, dict) for v in six.itervalues(value)):
+            # Entire conf:  stanzas as a list, since the global stanza has no name
+            return [{"stanza": _json_stanza_name(stanza), "keys": _json_keys(value[stanza])}
+                    for stanza in sorted(value, key=_json_stanza_key)]
+        return _json_keys(value)
+    if isinstance(value, (list, tuple)):
+        return [_json_text(v) for v in value]
+    return _json_text(value)
+
+
+def diff_op_to_dict(op):
+    """ Convert a DiffOp into a plain dict (for JSON output) like:
+
+        {"tag": "replace", "type": "key", "stanza": "sourcetype", "key": "TZ",
+         "a": "GMT", "b": "UTC"}
+
+    'type' is the location type ('global', 'stanza', 'key', 'comments', or 'rename');  'stanza'
+    (None for the global stanza), 'key', and 'new_stanza' (for a rename) are only included when
+    part of the location.  Unlike the
+    DiffOp itself, 'a' and 'b' are always the values from the first and second conf given to
+    compare_cfgs(), and are None when missing on that side.  Stanzas are given as dicts of their
+    keys, comments as a list of lines, and entire confs as a list of {"stanza": .., "keys": ..}.
+    """
+    location = op.location
+    d = {"tag": op.tag, "type": location.type}
+    if not isinstance(location, DiffGlobal):
+        d["stanza"] = _json_stanza_name(location.stanza)
+    if isinstance(location, DiffStzKey):
+        d["key"] = _json_text(location.key)
+    elif isinstance(location, DiffStzRename):
+        d["new_stanza"] = _json_text(location.new_stanza)
+    if op.tag == DIFF_OP_DELETE:
+        (a, b) = (op.b, None)
+    elif op.tag == DIFF_OP_INSERT:
+        (a, b) = (None, op.a)
+    else:
+        (a, b) = (op.a, op.b)
+    d["a"] = _json_value(a)
+    d["b"] = _json_value(b)
+    return d
+
+
+def write_diff_jsonl(stream, diffs, skip_equal=False):
+    """ Write `diffs` (from compare_cfgs() or iter_compare_cfgs()) as JSON Lines:  one object,
+    as returned by diff_op_to_dict(), per line.  Ops are written as they're read, so a generator
+    can be given.  If `skip_equal` is True, DIFF_OP_EQUAL ops are left out.
+
+    Returns the same exit codes as show_diff(). """
+    rc = EXIT_CODE_DIFF_EQUAL
+    for op in diffs:
+        if op.tag != DIFF_OP_EQUAL:
+            if isinstance(op.location, DiffGlobal):
+                rc = EXIT_CODE_DIFF_NO_COMMON
+            else:
+                rc = EXIT_CODE_DIFF_CHANGE
+        elif skip_equal:
+            continue
+        stream.write(json.dumps(diff_op_to_dict(op), sort_keys=True, ensure_ascii=False))
+        stream.write("\n")
+    return rc
+
+
+# Key counts for a stanza that differs between two confs (see iter_diff_stats).  `tag` is
+# DIFF_OP_DELETE or DIFF_OP_INSERT if the stanza is only in the first or second conf, otherwise
+# DIFF_OP_REPLACE.
+StanzaStat = namedtuple("StanzaStat", ("stanza", "tag", "inserted", "deleted", "changed"))
+
+
+def iter_diff_stats(a, b):
+    """ Count the differences between confs `a` and `b`, without producing any DiffOps.  Yields
+    a StanzaStat for each stanza that differs, in the same order as compare_cfgs():  the number
+    of keys only in `b` (inserted), only in `a` (deleted), and with a different value (changed).
+    Stanzas with the same content are skipped without looking at their keys when their digests
+    are known, which they always are for parsed (and unmodified) content.  Comments are
+    ignored. """
+    for stanza in sorted(set(a).union(b)):
+        if stanza not in b:
+            yield StanzaStat(stanza, DIFF_OP_DELETE, 0, len(a[stanza]), 0)
+        elif stanza not in a:
+            yield StanzaStat(stanza, DIFF_OP_INSERT, len(b[stanza]), 0, 0)
+        else:
             a_ = a[stanza]
             b_ = b[stanza]
-            # Note: make sure that '==' operator continues work with custom conf parsing classes.
-            if a_ == b_:
-                delta.append(DiffOp(DIFF_OP_EQUAL, DiffStanza("stanza", stanza), a_, b_))
-                continue
-            kv_a, kv_common, kv_b = _cmp_sets(list(a_.keys()), list(b_.keys()))
-            if not kv_common:
-                # No keys in common, just swap
-                delta.append(DiffOp(DIFF_OP_REPLACE, DiffStanza("stanza", stanza), a_, b_))
+            if same_content(a_, b_):
                 continue
-
-            # Level 2 - Key comparisons
-            for key in kv_a:
-                delta.append(DiffOp(DIFF_OP_DELETE, DiffStzKey("key", stanza, key), None, a_[key]))
-            for key in kv_b:
-                delta.append(DiffOp(DIFF_OP_INSERT, DiffStzKey("key", stanza, key), b_[key], None))
-            for key in kv_common:
-                a__ = a_[key]
-                b__ = b_[key]
-                if a__ == b__:
-                    delta.append(DiffOp(DIFF_OP_EQUAL, DiffStzKey("key", stanza, key), a__, b__))
-                else:
-                    delta.append(DiffOp(DIFF_OP_REPLACE, DiffStzKey("key", stanza, key), a__, b__))
-        elif stanza in a:
-            # A only
-            delta.append(DiffOp(DIFF_OP_DELETE, DiffStanza("stanza", stanza), None, a[stanza]))
-        else:
-            # B only
-            delta.append(DiffOp(DIFF_OP_INSERT, DiffStanza("stanza", stanza), b[stanza], None))
-    return delta
+            inserted = changed = 0
+            for (key, value) in six.iteritems(b_):
+                value_a = a_.get(key)
+                if value_a is None:
+                    inserted += 1
+                elif value_a != value:
+                    changed += 1
+            deleted = len(a_) - len(b_) + inserted
+            if inserted or deleted or changed:
+                yield StanzaStat(stanza, DIFF_OP_REPLACE, inserted, deleted, changed)
+
+
+def diff_stat_to_dict(stat):
+    """ Convert a StanzaStat into a plain dict (for JSON output), with None for the global
+    stanza's name. """
+    d = stat._asdict()
+    d["stanza"] = _json_stanza_name(stat.stanza)
+    return dict(d)
+
+
+def _stat_totals(stats):
+    """ Returns a tuple of (stanzas, added, removed, keys inserted, deleted, changed) """
+    totals = [0] * 6
+    for stat in stats:
+        totals[0] += 1
+        totals[1] += stat.tag == DIFF_OP_INSERT
+        totals[2] += stat.tag == DIFF_OP_DELETE
+        totals[3] += stat.inserted
+        totals[4] += stat.deleted
+        totals[5] += stat.changed
+    return tuple(totals)
+
+
+def format_stat_totals(stats):
+    """ One line summary of a list of StanzaStat, like:
+
+        3 stanzas differ (1 added, 1 removed);  keys:  5 added, 2 removed, 1 changed
+    """
+    (stanzas, added, removed, inserted, deleted, changed) = _stat_totals(stats)
+    return "{0} stanzas differ ({1} added, {2} removed);  keys:  {3} added, {4} removed, " \
+           "{5} changed".format(stanzas, added, removed, inserted, deleted, changed)
+
+
+def show_diff_stat(stream, stats):
+    """ Write one line per StanzaStat (from iter_diff_stats()), with the stanza name and key
+    counts ('+' inserted, '-' deleted, '~' changed), followed by a summary line.  Stanzas only
+    found on one side are marked with '+' or '-' in the first column.
+
+    Returns EXIT_CODE_DIFF_CHANGE if anything differs, otherwise EXIT_CODE_DIFF_EQUAL. """
+    stats = list(stats)
+    if not stats:
+        return EXIT_CODE_DIFF_EQUAL
+    names = ["[{0}]".format(_format_stanza(stat.stanza)) for stat in stats]
+    width = max(len(name) for name in names)
+    for (name, stat) in zip(names, stats):
+        sign = {DIFF_OP_INSERT: "+", DIFF_OP_DELETE: "-"}.get(stat.tag, " ")
+        counts = " ".join("{0}{1}".format(symbol, count) for (symbol, count) in
+                          (("+", stat.inserted), ("-", stat.deleted), ("~", stat.changed))
+                          if count)
+        stream.write("{0} {1:{2}}  {3}\n".format(sign, name, width, counts).rstrip() + "\n")
+    stream.write(format_stat_totals(stats) + "\n")
+    return EXIT_CODE_DIFF_CHANGE
 
 
 def summarize_cfg_diffs(delta, stream):
@@ -127,6 +437,9 @@ def summarize_cfg_diffs(delta, stream):
         c[op.tag] += 1
         if isinstance(op.location, DiffStanza):
             stanza_stats[op.tag].add(op.location.stanza)
+        elif isinstance(op.location, DiffStzRename):
+            stanza_stats[op.tag].add("{0}] -> [{1}".format(op.location.stanza,
+                                                          op.location.new_stanza))
         elif isinstance(op.location, DiffStzKey):
             key_stats[op.tag][op.location.stanza][op.location.key].add(op.location.key)
 
@@ -140,6 +453,54 @@ def summarize_cfg_diffs(delta, stream):
         stream.write("\n")
 
 
+_matrix_symbols = {
+    DIFF_OP_DELETE: "-",
+    DIFF_OP_INSERT: "+",
+    DIFF_OP_REPLACE: "~",
+}
+
+
+def show_diff_matrix(stream, baseline, names, deltas):
+    """ Write a compact matrix of which files differ from `baseline` on which stanzas and keys.
+    `deltas` has the list of DiffOps (from compare_cfgs_many()) for each file in `names`.  There
+    is one row per stanza or key that differs in any file, and one column per file.  Returns the
+    number of files that differ. """
+    rows = defaultdict(dict)
+    changed = []
+    for (i, delta) in enumerate(deltas):
+        if delta:
+            changed.append(i)
+        for op in delta:
+            location = op.location
+            if isinstance(location, DiffStzKey):
+                row = (location.stanza, 1, location.key)
+            elif isinstance(location, DiffStzComments):
+                row = (location.stanza, 2, None)
+            else:
+                row = (location.stanza, 0, None)
+            rows[row][i] = _matrix_symbols[op.tag]
+    stream.write("Baseline:  {0}\n".format(baseline))
+    for (i, name) in enumerate(names):
+        stream.write("  {0:4d}  {1}{2}\n".format(i + 1, name,
+                                                 "" if i in changed else "  (same)"))
+    stream.write("{0} of {1} files differ from the baseline.\n".format(len(changed), len(names)))
+    if not rows:
+        return 0
+    stream.write("\n")
+    for row in sorted(rows, key=lambda r: (r[0], r[1], r[2] or "")):
+        (stanza, level, key) = row
+        cells = "".join(rows[row].get(i, ".") for i in range(len(names)))
+        label = "[{0}]".format(_format_stanza(stanza))
+        if level == 1:
+            label += " " + key
+        elif level == 2:
+            label += " (comments)"
+        stream.write("  {0}  {1}\n".format(cells, label))
+    stream.write("\n  '-' missing from the file, '+' only in the file, '~' changed, "
+                 "'.' same as the baseline\n")
+    return len(changed)
+
+
 # Color mapping
 _diff_color_mapping = {
     " ": ANSI_RESET,
@@ -148,54 +509,99 @@ _diff_color_mapping = {
 }
 
 
-def _show_diff_header(stream, files, diff_line=None):
+def _show_diff_header(out, files, diff_line=None):
     def header(sign, filename):
         try:
             mtime = os.stat(filename).st_mtime
             ts = datetime.datetime.fromtimestamp(mtime)
         except OSError:
             ts = "1970-01-01 00:00:00"
-        stream.write("{0} {1:50} {2}\n".format(sign * 3, filename, ts))
-        tty_color(stream, ANSI_RESET)
+        out.write("{0} {1:50} {2}\n".format(sign * 3, filename, ts))
+        out.color(ANSI_RESET)
 
-    tty_color(stream, ANSI_YELLOW, ANSI_BOLD)
+    out.color(ANSI_YELLOW, ANSI_BOLD)
     if diff_line:
-        stream.write("diff {} {} {}\n".format(diff_line, files[0], files[1]))
-    tty_color(stream, ANSI_RESET)
+        out.write("diff {} {} {}\n".format(diff_line, files[0], files[1]))
+    out.color(ANSI_RESET)
     header("-", files[0])
     header("+", files[1])
 
 
-def show_diff(stream, diffs, headers=None):
+def show_diff(stream, diffs, headers=None, positions=None):
+    """ Write `diffs` (from compare_cfgs() or iter_compare_cfgs()) in a diff-like format.  Ops
+    are written as they're read, so a generator can be given.  If `positions` is given as a pair
+    of ConfPositions (or None) for each side of the comparison, each changed stanza is preceded
+    by a '@@ file:line @@' line citing where it's found.
+
+    Output is buffered (see TermWriter), and `stream` is only flushed once done. """
+    out = TermWriter(stream)
+
     def write_key(key, value, prefix_=" "):
         if "\n" in value:
             write_multiline_key(key, value, prefix_)
         else:
-            if key.startswith("#-"):
-                template = "{0}{2}\n"
-            else:
-                template = "{0}{1} = {2}\n"
-            stream.write(template.format(prefix_, key, value))
+            out.write("{0}{1} = {2}\n".format(prefix_, key, value))
+
+    def write_comments(comments, prefix_=" "):
+        for comment in comments:
+            out.write("{0}{1}\n".format(prefix_, comment))
 
     def write_multiline_key(key, value, prefix_=" "):
         lines = value.replace("\n", "\\\n").split("\n")
-        tty_color(stream, _diff_color_mapping.get(prefix_))
-        stream.write("{0}{1} = {2}\n".format(prefix_, key, lines.pop(0)))
+        out.color(_diff_color_mapping.get(prefix_))
+        out.write("{0}{1} = {2}\n".format(prefix_, key, lines.pop(0)))
         for line in lines:
-            stream.write("{0}{1}\n".format(prefix_, line))
-        tty_color(stream, ANSI_RESET)
+            out.write("{0}{1}\n".format(prefix_, line))
+        out.color(ANSI_RESET)
 
     def show_value(value, stanza_, key, prefix_=""):
-        tty_color(stream, _diff_color_mapping.get(prefix_))
+        out.color(_diff_color_mapping.get(prefix_))
         if isinstance(value, dict):
             if stanza_ is not GLOBAL_STANZA:
-                stream.write("{0}[{1}]\n".format(prefix_, stanza_))
+                out.write("{0}[{1}]\n".format(prefix_, stanza_))
+            comments = _comment_text(value)
             for x, y in sorted(six.iteritems(value)):
+                # Comments are shown where they'll be written (see write_conf)
+                if comments and x > "#":
+                    write_comments(comments, prefix_)
+                    comments = None
                 write_key(x, y, prefix_)
-            stream.write("\n")
+            if comments:
+                write_comments(comments, prefix_)
+            out.write("\n")
         else:
             write_key(key, value, prefix_)
-        tty_color(stream, ANSI_RESET)
+        out.color(ANSI_RESET)
+
+    def show_location(stanza_):
+        if not positions or stanza_ is GLOBAL_STANZA:
+            return
+        locations = ["{0}{1}".format(sign, pos.location(stanza_))
+                     for (sign, pos) in zip("-+", positions)
+                     if pos is not None and pos.line(stanza_) is not None]
+        if locations:
+            out.color(ANSI_YELLOW)
+            out.write("@@ {0} @@\n".format(" ".join(locations)))
+            out.color(ANSI_RESET)
+
+    def show_rename(op_):
+        show_location(op_.location.stanza)
+        out.color(ANSI_RED)
+        out.write("-[{0}]\n".format(op_.location.stanza))
+        out.color(ANSI_GREEN)
+        out.write("+[{0}]\n".format(op_.location.new_stanza))
+        out.color(ANSI_RESET)
+        for key in sorted(set(op_.a).union(op_.b)):
+            value_a = op_.a.get(key)
+            value_b = op_.b.get(key)
+            if value_a == value_b:
+                write_key(key, value_a)
+            else:
+                if value_a is not None:
+                    show_value(value_a, None, key, "-")
+                if value_b is not None:
+                    show_value(value_b, None, key, "+")
+        out.write("\n")
 
     def show_multiline_diff(value_a, value_b, key):
         def f(v):
@@ -205,56 +611,74 @@ def show_diff(stream, diffs, headers=None):
 
         a = f(value_a)
         b = f(value_b)
-        differ = difflib.Differ()
-        for d in differ.compare(a, b):
+        for d in diff_lines(a, b):
             # Someday add "?" highlighting.  Trick is this should change color mid-line on the
             # previous (one or two) lines.  (Google and see if somebody else solved this one already)
             # https://stackoverflow.com/questions/774316/python-difflib-highlighting-differences-inline
-            tty_color(stream, _diff_color_mapping.get(d[0], 0))
+            out.color(_diff_color_mapping.get(d[0], 0))
             # Differences in how difflib returns bytes/unicode?
             if not isinstance(d, six.text_type):
                 d = d.decode(default_encoding)
-            stream.write(d)
-            tty_color(stream, ANSI_RESET)
-            stream.write("\n")
+            out.write(d)
+            out.color(ANSI_RESET)
+            out.write("\n")
 
     # Global result:  no changes between files or no commonality between files
-    if len(diffs) == 1 and isinstance(diffs[0].location, DiffGlobal):
-        op = diffs[0]
+    diffs = iter(diffs)
+    op = next(diffs, None)
+    if op is None:
+        return EXIT_CODE_DIFF_EQUAL
+    if isinstance(op.location, DiffGlobal):
         if op.tag == DIFF_OP_EQUAL:
             return EXIT_CODE_DIFF_EQUAL
         else:
             if headers:
-                _show_diff_header(stream, headers, "--ksconf -global")
+                _show_diff_header(out, headers, "--ksconf -global")
             # This is the only place where a gets '-' and b gets '+'
             for (prefix, data) in [("-", op.a), ("+", op.b)]:
                 for (stanza, keys) in sorted(data.items()):
                     show_value(keys, stanza, None, prefix)
-            stream.flush()
+            out.flush()
             return EXIT_CODE_DIFF_NO_COMMON
 
     if headers:
-        _show_diff_header(stream, headers, "--ksconf")
+        _show_diff_header(out, headers, "--ksconf")
 
     last_stanza = None
-    for op in diffs:
+    for op in chain((op,), diffs):
         if isinstance(op.location, DiffStanza):
+            if op.tag == DIFF_OP_EQUAL:
+                continue
+            show_location(op.location.stanza)
             if op.tag in (DIFF_OP_DELETE, DIFF_OP_REPLACE):
                 show_value(op.b, op.location.stanza, None, "-")
             if op.tag in (DIFF_OP_INSERT, DIFF_OP_REPLACE):
                 show_value(op.a, op.location.stanza, None, "+")
             continue  # pragma: no cover  (peephole optimization)
 
+        if isinstance(op.location, DiffStzRename):
+            show_rename(op)
+            last_stanza = None
+            continue
+
         if op.location.stanza != last_stanza:
             if last_stanza is not None:
                 # Line break after last stanza
-                stream.write("\n")
-                stream.flush()
+                out.write("\n")
+            show_location(op.location.stanza)
             if op.location.stanza is not GLOBAL_STANZA:
-                stream.write(" [{0}]\n".format(op.location.stanza))
+                out.write(" [{0}]\n".format(op.location.stanza))
             last_stanza = op.location.stanza
 
-        if op.tag == DIFF_OP_INSERT:
+        if isinstance(op.location, DiffStzComments):
+            out.color(ANSI_RED)
+            if op.tag in (DIFF_OP_DELETE, DIFF_OP_REPLACE):
+                write_comments(op.b, "-")
+            out.color(ANSI_GREEN)
+            if op.tag in (DIFF_OP_INSERT, DIFF_OP_REPLACE):
+                write_comments(op.a, "+")
+            out.color(ANSI_RESET)
+        elif op.tag == DIFF_OP_INSERT:
             show_value(op.a, op.location.stanza, op.location.key, "+")
         elif op.tag == DIFF_OP_DELETE:
             show_value(op.b, op.location.stanza, op.location.key, "-")
@@ -266,19 +690,130 @@ def show_diff(stream, diffs, headers=None):
                 show_value(op.a, op.location.stanza, op.location.key, "+")
         elif op.tag == DIFF_OP_EQUAL:
             show_value(op.b, op.location.stanza, op.location.key, " ")
-    stream.flush()
+    out.flush()
     return EXIT_CODE_DIFF_CHANGE
 
 
-def show_text_diff(stream, a, b):
-    _show_diff_header(stream, (a, b), "--text")
-    differ = difflib.Differ()
-    lines_a = open(a, "r", encoding=default_encoding).readlines()
-    lines_b = open(b, "r", encoding=default_encoding).readlines()
-    for d in differ.compare(lines_a, lines_b):
-        # Someday add "?" highlighting.  Trick is this should change color mid-line on the
-        # previous (one or two) lines.  (Google and see if somebody else solved this one already)
-        # https://stackoverflow.com/questions/774316/python-difflib-highlighting-differences-inline
-        tty_color(stream, _diff_color_mapping.get(d[0], 0))
-        stream.write(d)
-        tty_color(stream, ANSI_RESET)
+# Defaults for unified text diffs (see show_text_diff)
+TEXT_DIFF_CONTEXT = 3
+TEXT_DIFF_MAX_SIZE = 1024 * 1024
+
+
+def _group_opcodes(opcodes, context):
+    """ Same as difflib.SequenceMatcher.get_grouped_opcodes(), for any list of opcodes """
+    if not opcodes:
+        return
+    codes = list(opcodes)
+    (tag, i1, i2, j1, j2) = codes[0]
+    if tag == "equal":
+        codes[0] = (tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2)
+    (tag, i1, i2, j1, j2) = codes[-1]
+    if tag == "equal":
+        codes[-1] = (tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context))
+    group = []
+    for (tag, i1, i2, j1, j2) in codes:
+        if tag == "equal" and i2 - i1 > context * 2:
+            group.append((tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+            yield group
+            group = []
+            (i1, j1) = (max(i1, i2 - context), max(j1, j2 - context))
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        yield group
+
+
+def _format_range(start, stop):
+    """ Line range of a unified diff hunk (same as difflib) """
+    length = stop - start
+    if length == 1:
+        return "{0}".format(start + 1)
+    return "{0},{1}".format(start + 1 if length else start, length)
+
+
+def _read_after_common_lines(file_a, file_b, context):
+    """ Read two (open) text files, skipping the lines they start with in common without keeping
+    them in memory, except for the last `context` lines.  Returns (skipped, lines_a, lines_b),
+    where `skipped` is the number of leading lines not included in lines_a or lines_b. """
+    kept = deque(maxlen=context)
+    skipped = 0
+    while True:
+        line_a = file_a.readline()
+        line_b = file_b.readline()
+        if line_a != line_b or not line_a:
+            break
+        if context:
+            kept.append(line_a)
+        skipped += 1
+    skipped -= len(kept)
+    lines_a = list(kept)
+    lines_b = list(kept)
+    if line_a:
+        lines_a.append(line_a)
+        lines_a.extend(file_a)
+    if line_b:
+        lines_b.append(line_b)
+        lines_b.extend(file_b)
+    return (skipped, lines_a, lines_b)
+
+
+def _show_text_summary(out, files, max_size):
+    out.write("Files differ (not compared:  larger than {0} bytes)\n".format(max_size))
+    for (sign, filename) in zip("-+", files):
+        out.color(_diff_color_mapping[sign])
+        out.write("{0} {1:>12} bytes  sha256:{2}\n".format(
+            sign, os.path.getsize(filename), file_hash(filename)))
+        out.color(ANSI_RESET)
+
+
+def show_text_diff(stream, a, b, context=None, max_size=None):
+    """ Show the differences between the text files `a` and `b`.  By default, every line is shown
+    (in the format of difflib.Differ).  If `context` is given, a unified diff with that many lines
+    of context around each change is shown instead;  the lines that both files start with are
+    then skipped as they're read.  If `max_size` is given and either file is larger than that
+    (in bytes), only the size and hash of each file are shown. """
+    out = TermWriter(stream)
+    _show_diff_header(out, (a, b), "--text")
+    if max_size is not None and max(os.path.getsize(a), os.path.getsize(b)) > max_size:
+        _show_text_summary(out, (a, b), max_size)
+        out.flush()
+        return
+    with open(a, "r", encoding=default_encoding) as file_a, \
+            open(b, "r", encoding=default_encoding) as file_b:
+        if context is None:
+            skipped = None
+            lines_a = file_a.readlines()
+            lines_b = file_b.readlines()
+        else:
+            (skipped, lines_a, lines_b) = _read_after_common_lines(file_a, file_b, context)
+    if skipped is None:
+        for d in diff_lines(lines_a, lines_b):
+            # Someday add "?" highlighting.  Trick is this should change color mid-line on the
+            # previous (one or two) lines.  (Google and see if somebody else solved this one already)
+            # https://stackoverflow.com/questions/774316/python-difflib-highlighting-differences-inline
+            out.color(_diff_color_mapping.get(d[0], 0))
+            out.write(d)
+            out.color(ANSI_RESET)
+        out.flush()
+        return
+
+    def write_lines(prefix, lines):
+        out.color(_diff_color_mapping[prefix])
+        for line in lines:
+            out.write(prefix + line)
+            if not line.endswith("\n"):
+                out.write("\n\\ No newline at end of file\n")
+        out.color(ANSI_RESET)
+
+    for group in _group_opcodes(line_opcodes(lines_a, lines_b), context):
+        out.color(ANSI_YELLOW)
+        out.write("@@ -{0} +{1} @@\n".format(
+            _format_range(skipped + group[0][1], skipped + group[-1][2]),
+            _format_range(skipped + group[0][3], skipped + group[-1][4])))
+        out.color(ANSI_RESET)
+        for (tag, i1, i2, j1, j2) in group:
+            if tag == "equal":
+                write_lines(" ", lines_a[i1:i2])
+            else:
+                write_lines("-", lines_a[i1:i2])
+                write_lines("+", lines_b[j1:j2])
+    out.flush()
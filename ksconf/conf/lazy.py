@@ -0,0 +1,272 @@
+""" Lazy, stanza-indexed access to .conf files.
+
+A LazyConf only scans for stanza headers when opened.  Each stanza's body is parsed the first
+time it's accessed.  Apart from being read-only, it behaves like the dict-of-dicts returned by
+parse_conf(), so it can be passed to compare_cfgs(), merge_conf_dicts(), and friends.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+import re
+from copy import deepcopy
+from io import open, BytesIO, StringIO
+from itertools import chain
+
+from ksconf.conf.parser import GLOBAL_STANZA, PARSECONF_MID, DUP_EXCEPTION, DUP_OVERWRITE, \
+    DUP_MERGE, Conf, DuplicateStanzaException, Stanza, default_encoding, _detect_bom, \
+    _format_stanza, _has_text_only_space, _lone_cr_re, _parse_conf_tokens, _replace_comments, \
+    _tokenize, _BYTES_SYNTAX, _TEXT_SYNTAX
+
+# Lines that may be stanza headers, and actual headers (as matched by the tokenizer), for content
+# that has no '\r'
+_bracket_line = br"([ \t\v\f]*\[[^\n]*)"
+_bracket_line_re = re.compile(b"\n" + _bracket_line)
+_first_bracket_line_re = re.compile(_bracket_line)
+_header_re = re.compile(br"[ \t\v\f]*\[(.*)\][ \t\v\f]*$")
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # pragma: no cover  (Python 2)
+    from collections import Mapping
+
+
+def parse_conf_lazy(stream, profile=PARSECONF_MID, encoding=None):
+    """ Lazy version of parse_conf().  Accepts either an open (text) stream or a filename. """
+    if hasattr(stream, "read"):
+        name = getattr(stream, "name", repr(stream))
+        return LazyConf(stream.read(), name, profile=profile)
+    with open(stream, "rb") as f:
+        raw = f.read()
+    return LazyConf(raw, stream, encoding=encoding, profile=profile)
+
+
+class LazyConf(Mapping):
+    """ Read-only mapping of stanza name to a dict of keys.
+
+    On creation only the location (offset and length) of each stanza body is recorded.  `data`
+    may be bytes (the raw file content) or text.  The bytes-level scan is used for UTF-8 content;
+    other encodings are decoded up front and indexed by character offsets instead.
+
+    Parser errors within a stanza body (for example, strict mode violations) are raised when
+    that stanza is first accessed, not on creation.  Duplicate stanzas are detected on creation.
+    Content before the first stanza header is the one exception:  whether there's a global
+    stanza at all depends on parsing it, so its errors are raised as soon as the list of stanzas
+    is used (iteration, len(), ...).
+    """
+
+    def __init__(self, data, name="<string>", encoding=None, profile=PARSECONF_MID):
+        self.name = name
+        self._profile = profile
+        self._encoding = None
+        self._crlf = False
+        if isinstance(data, bytes):
+            encoding = encoding or _detect_bom(data[:4], default_encoding)
+            if encoding in ("utf-8", "utf-8-sig") and not _lone_cr_re.search(data) and \
+                    not _has_text_only_space(data):
+                self._encoding = "utf-8"
+                self._crlf = b"\r" in data
+                if encoding == "utf-8-sig":
+                    data = data[3:]
+            else:
+                # Translate line endings the same way a text-mode file object would
+                data = data.decode(encoding).replace("\r\n", "\n").replace("\r", "\n")
+        self._data = data
+        self._index = self._scan()
+        self._stanzas = {}
+        self._global_checked = GLOBAL_STANZA not in self._index
+
+    def _check_global(self):
+        """ The global stanza is dropped when empty, which can only be known by parsing it.  This
+        is put off until the list of stanzas is needed. """
+        if self._global_checked:
+            return
+        content = self._stanzas.get(GLOBAL_STANZA)
+        if content is None:
+            content = self._stanzas[GLOBAL_STANZA] = self._parse_stanza(GLOBAL_STANZA)
+        self._global_checked = True
+        if not content and not content.comments:
+            del self._index[GLOBAL_STANZA]
+            del self._stanzas[GLOBAL_STANZA]
+
+    def _lines(self):
+        if self._encoding:
+            return iter(BytesIO(self._data))
+        return iter(StringIO(self._data))
+
+    def _add(self, index, stanza, start, end, dup_stanza):
+        if stanza in index:
+            if dup_stanza == DUP_EXCEPTION:
+                raise DuplicateStanzaException("Stanza [{0}] found more than once in config "
+                                               "file {1}".format(_format_stanza(stanza), self.name))
+            index[stanza].append((start, end))
+        else:
+            index[stanza] = [(start, end)]
+
+    def _scan(self):
+        """ Find the body location of each stanza.  Continuation lines and the rules for dropping
+        stanzas without any content mirror the tokenizer exactly. """
+        if self._encoding and not self._crlf:
+            index = self._scan_headers()
+            if index is not None:
+                return index
+        syntax = _BYTES_SYNTAX if self._encoding else _TEXT_SYNTAX
+        section_match = syntax.section_re.match
+        cont_eol = syntax.cont_eol
+        cont_ends = syntax.cont_ends
+        eol_chars = syntax.eol_chars
+        newline = syntax.newline
+        lbracket = syntax.lbracket
+        handle_conts = self._profile.get("handle_conts", True)
+        dup_stanza = self._profile.get("dup_stanza", DUP_EXCEPTION)
+        index = {}
+
+        def add(stanza, start, end):
+            self._add(index, stanza, start, end, dup_stanza)
+
+        pending = GLOBAL_STANZA
+        pending_start = 0
+        current = None
+        cont = []
+        cont_start = 0
+        offset = 0
+        for line in chain(self._lines(), (syntax.empty,)):
+            start = offset
+            offset += len(line)
+            if self._crlf and line.endswith(eol_chars):
+                line = line[:-2] + newline
+            if handle_conts:
+                if line.endswith(cont_ends):
+                    if not cont:
+                        cont_start = start
+                    cont.append(line[:-2] if line.endswith(cont_eol) else line[:-1])
+                    continue
+                if cont:
+                    cont.append(line)
+                    line = newline.join(cont)
+                    del cont[:]
+                    start = cont_start
+                elif not line:
+                    break
+            elif not line:
+                break
+            if line.lstrip()[:1] == lbracket:
+                mo = section_match(line.rstrip(eol_chars))
+                if mo:
+                    if current:
+                        add(current[0], current[1], start)
+                        current = None
+                    pending = mo.group(1)
+                    if self._encoding:
+                        pending = pending.decode(self._encoding)
+                    pending_start = offset
+                    continue
+            if pending is not None:
+                current = (pending, pending_start)
+                pending = None
+        if current:
+            add(current[0], current[1], offset)
+        elif pending is not None and pending is not GLOBAL_STANZA and pending:
+            # Trailing stanza header with no content
+            add(pending, offset, offset)
+        return index
+
+    def _scan_headers(self):
+        """ Faster version of _scan() that only looks at lines starting with '['.  Returns None
+        if any of those lines are part of a continued line, as that requires a full scan. """
+        data = self._data
+        handle_conts = self._profile.get("handle_conts", True)
+        dup_stanza = self._profile.get("dup_stanza", DUP_EXCEPTION)
+        index = {}
+        pending = GLOBAL_STANZA
+        pending_start = 0
+        end = len(data)
+        first = _first_bracket_line_re.match(data)
+        for mo in chain((first,) if first else (), _bracket_line_re.finditer(data)):
+            (start, line_end) = mo.span(1)
+            line = mo.group(1)
+            if handle_conts and (line.endswith(b"\\") or data[start - 2:start] == b"\\\n"):
+                return None
+            header = _header_re.match(line)
+            if not header:
+                continue
+            if start > pending_start:
+                self._add(index, pending, pending_start, start, dup_stanza)
+            pending = header.group(1).decode(self._encoding)
+            pending_start = min(line_end + 1, end)
+        if end > pending_start:
+            self._add(index, pending, pending_start, end, dup_stanza)
+        elif pending is not GLOBAL_STANZA and pending:
+            self._add(index, pending, end, end, dup_stanza)
+        return index
+
+    def _parse_stanza(self, stanza):
+        profile = self._profile
+        dup_stanza = profile.get("dup_stanza", DUP_EXCEPTION)
+        content = None
+        for (start, end) in self._index[stanza]:
+            body = self._data[start:end]
+            if self._encoding:
+                body = body.decode(self._encoding)
+                if self._crlf:
+                    body = body.replace("\r\n", "\n")
+            tokens = _tokenize(StringIO(body), profile.get("keep_comments", False),
+                               profile.get("strict", False), profile.get("handle_conts", True),
+                               _TEXT_SYNTAX, stanza=stanza)
+            parsed = _parse_conf_tokens(tokens, self.name, profile.get("keys_lower", False),
+                                        dup_stanza, profile.get("dup_key", DUP_OVERWRITE))
+            parsed = parsed.get(stanza)
+            if parsed is None:
+                parsed = Stanza()
+            if content is None or dup_stanza == DUP_OVERWRITE:
+                content = parsed
+            elif dup_stanza == DUP_MERGE:
+                content.update(parsed)
+                # Comments of the later stanza replace the earlier ones (see _restore_comments)
+                content.comments = _replace_comments(content.comments, parsed.comments)
+        return content
+
+    def digests(self):
+        """ Return a dict of stanza name to a digest of the stanza's raw (unparsed) content.  With
+        the same parse profile, a stanza with the same name and digest always parses the same. """
+        self._check_global()
+        digests = {}
+        for (stanza, ranges) in self._index.items():
+            h = hashlib.sha1()
+            for (start, end) in ranges:
+                body = self._data[start:end]
+                h.update(body if isinstance(body, bytes) else body.encode("utf-8"))
+                # Keep the bodies of duplicate stanzas distinct
+                h.update(b"\0")
+            digests[stanza] = h.hexdigest()
+        return digests
+
+    def __getitem__(self, stanza):
+        if stanza is GLOBAL_STANZA:
+            self._check_global()
+        try:
+            return self._stanzas[stanza]
+        except KeyError:
+            if stanza not in self._index:
+                raise
+        content = self._stanzas[stanza] = self._parse_stanza(stanza)
+        return content
+
+    def __iter__(self):
+        self._check_global()
+        return iter(self._index)
+
+    def __len__(self):
+        self._check_global()
+        return len(self._index)
+
+    def __contains__(self, stanza):
+        if stanza is GLOBAL_STANZA:
+            self._check_global()
+        return stanza in self._index
+
+    def __deepcopy__(self, memo):
+        # A copy is always a plain (fully parsed) dict, which callers are free to modify
+        return deepcopy(Conf(self.items()), memo)
+
+    def __repr__(self):
+        return "<{0} {1!r} stanzas={2}>".format(self.__class__.__name__, self.name, len(self))
@@ -0,0 +1,112 @@
+""" Digests of files written by ksconf, stored beside the files themselves.
+
+smart_write_conf() normally has to read the destination file to find out if the newly rendered
+content is any different.  A WriteManifest remembers the digest of the content last written to
+each file (along with the file's size, modification time, and inode) so that an unchanged file
+can be skipped without reading it.  If a file has been modified by some other means, the stat
+information won't match and the normal full comparison is used instead.
+
+A key built from the content digest of the conf that was rendered can be recorded too, which
+lets smart_write_conf() skip rendering an unchanged conf entirely.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import json
+import os
+from io import open
+from tempfile import mkstemp
+
+import six
+
+from ksconf.util.file import atomic_replace
+
+MANIFEST_FORMAT = 2
+
+
+def _stat_info(path):
+    st = os.stat(path)
+    mtime_ns = getattr(st, "st_mtime_ns", None)
+    if mtime_ns is None:  # pragma: no cover  (Python 2)
+        mtime_ns = int(st.st_mtime * 1e9)
+    return [st.st_size, mtime_ns, st.st_ino]
+
+
+class WriteManifest(object):
+    """ JSON file mapping each written file (relative to the manifest's directory) to the digest
+    of its content.  A missing or unreadable manifest is simply treated as empty. """
+
+    def __init__(self, path):
+        self.path = path
+        self._base = os.path.dirname(os.path.abspath(path))
+        self._files = {}
+        self._dirty = False
+        self.load()
+
+    def _relpath(self, filename):
+        return os.path.relpath(os.path.abspath(filename), self._base).replace(os.path.sep, "/")
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as stream:
+                data = json.load(stream)
+        except (IOError, OSError, ValueError):
+            return
+        if isinstance(data, dict) and data.get("format") == MANIFEST_FORMAT:
+            self._files = data.get("files", {})
+
+    def save(self):
+        """ Write the manifest (atomically), if anything has changed. """
+        if not self._dirty:
+            return
+        data = {"format": MANIFEST_FORMAT, "files": self._files}
+        fd, temp = mkstemp(suffix=".tmp", dir=self._base)
+        try:
+            with open(fd, "w", encoding="utf-8") as stream:
+                stream.write(six.text_type(json.dumps(data, indent=1, sort_keys=True)))
+            atomic_replace(temp, self.path)
+        except Exception:
+            os.unlink(temp)
+            raise
+        self._dirty = False
+
+    def check(self, filename, digest):
+        """ Returns True if `filename` is known to contain content with `digest`, False if it's
+        known to contain something else, or None if it's unknown (no entry, or the file has been
+        changed since it was recorded). """
+        entry = self._entry(filename)
+        if entry is None:
+            return None
+        return entry[0] == digest
+
+    def check_content(self, filename, content_key):
+        """ Returns True if `filename` is known to be the rendered output of a conf with
+        `content_key`, otherwise None (as the output could still be the same). """
+        entry = self._entry(filename)
+        if entry is None or entry[4] is None or entry[4] != content_key:
+            return None
+        return True
+
+    def _entry(self, filename):
+        # Returns the entry for `filename`, but only if the file hasn't been changed since
+        entry = self._files.get(self._relpath(filename))
+        if not entry:
+            return None
+        try:
+            if entry[1:4] != _stat_info(filename):
+                return None
+        except OSError:
+            return None
+        return entry
+
+    def record(self, filename, digest, content_key=None):
+        """ Record that `filename` (as it is right now) contains content with `digest`, which
+        was rendered from a conf with `content_key` (if known). """
+        entry = [digest] + _stat_info(filename) + [content_key]
+        relpath = self._relpath(filename)
+        if self._files.get(relpath) != entry:
+            self._files[relpath] = entry
+            self._dirty = True
+
+    def discard(self, filename):
+        if self._files.pop(self._relpath(filename), None) is not None:
+            self._dirty = True
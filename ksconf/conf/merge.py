@@ -3,14 +3,21 @@ from __future__ import unicode_literals
 
 import os
 import sys
+from collections import namedtuple
 from copy import deepcopy
 
 import six
 
-from ksconf.conf.delta import compare_cfgs, show_diff
-from ksconf.conf.parser import GLOBAL_STANZA, _extract_comments, inject_section_comments
+from ksconf.conf.delta import iter_compare_cfgs, show_diff
+from ksconf.conf.parser import GLOBAL_STANZA, Conf, Stanza, inject_section_comments, same_content, \
+    _cached_digest
 from ksconf.consts import SMART_UPDATE
 
+try:
+    from collections.abc import MutableMapping
+except ImportError:  # pragma: no cover  (Python 2)
+    from collections import MutableMapping
+
 ####################################################################################################
 ## Merging logic
 
@@ -33,9 +40,14 @@ def _merge_conf_dicts(base, new_layer):
                 continue  # pragma: no cover  (peephole optimization)
         if section in base:
             # TODO:  Support other magic here...
-            # Rip all the comments out of the new_layer, and prepend them (sequentially) to base
-            comments = _extract_comments(items)
+            # Prepend all the comments from the new_layer to base
+            comments = getattr(items, "comments", None)
+            if not comments and same_content(base[section], items):
+                # Identical stanza (by digest);  updating would only discard the base's digest
+                continue
             if comments:
+                if not isinstance(base[section], Stanza):
+                    base[section] = Stanza(base[section])
                 inject_section_comments(base[section], prepend=comments)
             base[section].update(items)
         else:
@@ -44,9 +56,18 @@ def _merge_conf_dicts(base, new_layer):
     # Nothing to return, base is updated in-place
 
 
+def _has_comments(conf):
+    return any(getattr(stanza, "comments", None) for stanza in six.itervalues(conf))
+
+
 def merge_conf_dicts(*dicts):
     result = {}
+    previous = None
     for d in dicts:
+        if result and same_content(d, previous) and not _has_comments(d):
+            # Same content as the last layer, so merging it again changes nothing
+            continue
+        previous = d
         d = deepcopy(d)
         if not result:
             result = d
@@ -56,15 +77,120 @@ def merge_conf_dicts(*dicts):
     return result
 
 
+def _merge_stanza_layers(stanzas):
+    """ Merge the versions of one stanza (lowest precedence first) into a new Stanza, the same
+    way _merge_conf_dicts() does. """
+    result = _copy_stanza(stanzas[0])
+    for items in stanzas[1:]:
+        comments = getattr(items, "comments", None)
+        if not comments and same_content(result, items):
+            continue
+        if comments:
+            inject_section_comments(result, prepend=comments)
+        result.update(items)
+    return result
+
+
+class LayeredConf(MutableMapping):
+    """ Copy-on-write view of several conf layers (lowest precedence first), with the same
+    content as merge_conf_dicts(*layers).  The layers are never modified.
+
+    On creation, only the layers that contribute to each stanza are recorded (which is where a
+    stanza is dropped by ``_stanza = <<DROP>>``).  A stanza found in a single layer is returned
+    as is, without copying it, so it must not be modified through this view;  a stanza found in
+    several layers is merged into a new Stanza on first access.  Use materialize() to get a
+    stanza that can be modified.  Assigning or deleting a stanza only changes this view.
+    """
+
+    def __init__(self, *layers):
+        self.layers = layers
+        self._index = self._build_index(layers)
+        # Stanzas owned by this view (merged, materialized, or assigned)
+        self._stanzas = {}
+
+    @staticmethod
+    def _build_index(layers):
+        """ Map each stanza name to the list of its versions in `layers`, following the same
+        steps as merge_conf_dicts() and _merge_conf_dicts(). """
+        index = {}
+        previous = None
+        for layer in layers:
+            if index and same_content(layer, previous) and not _has_comments(layer):
+                continue
+            previous = layer
+            if not index:
+                index = dict((section, [items]) for (section, items) in six.iteritems(layer))
+                continue
+            for (section, items) in six.iteritems(layer):
+                if STANZA_MAGIC_KEY in items and STANZA_OP_DROP in items[STANZA_MAGIC_KEY]:
+                    index.pop(section, None)
+                elif section in index:
+                    index[section].append(items)
+                else:
+                    index[section] = [items]
+        return index
+
+    def materialize(self, stanza):
+        """ Return a copy of `stanza` owned by this view, which may be modified.  A stanza that
+        isn't present is added as an empty Stanza. """
+        try:
+            return self._stanzas[stanza]
+        except KeyError:
+            pass
+        if stanza in self._index:
+            content = _merge_stanza_layers(self._index[stanza])
+        else:
+            content = Stanza()
+            self._index[stanza] = [content]
+        self._stanzas[stanza] = content
+        return content
+
+    def __getitem__(self, stanza):
+        try:
+            return self._stanzas[stanza]
+        except KeyError:
+            layers = self._index[stanza]
+        if len(layers) == 1:
+            return layers[0]
+        content = self._stanzas[stanza] = _merge_stanza_layers(layers)
+        return content
+
+    def __setitem__(self, stanza, content):
+        self._index[stanza] = [content]
+        self._stanzas[stanza] = content
+
+    def __delitem__(self, stanza):
+        del self._index[stanza]
+        self._stanzas.pop(stanza, None)
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, stanza):
+        return stanza in self._index
+
+    def __deepcopy__(self, memo):
+        # A copy is always a plain (fully merged) Conf, which callers are free to modify
+        return deepcopy(Conf(self.items()), memo)
+
+    def __repr__(self):
+        return "<{0} layers={1} stanzas={2}>".format(self.__class__.__name__, len(self.layers),
+                                                     len(self))
+
+
 def merge_conf_files(dest, configs, dry_run=False, banner_comment=None):
     # Parse all config files
     cfgs = [conf.data for conf in configs]
-    # Merge all config files:
-    merged_cfg = merge_conf_dicts(*cfgs)
+    # Merge all config files (stanzas are only copied when they're modified)
+    merged_cfg = LayeredConf(*cfgs)
     if banner_comment:
         if not banner_comment.startswith("#"):
             banner_comment = "#" + banner_comment
-        inject_section_comments(merged_cfg.setdefault(GLOBAL_STANZA, {}), prepend=[banner_comment])
+        global_stanza = merged_cfg.materialize(GLOBAL_STANZA)
+        inject_section_comments(global_stanza, prepend=[banner_comment])
 
     # Either show the diff (dry-run mode) or write to the destination file
     if dry_run and dest.is_file():
@@ -72,7 +198,104 @@ def merge_conf_files(dest, configs, dry_run=False, banner_comment=None):
             dest_cfg = dest.data
         else:
             dest_cfg = {}
-        show_diff(sys.stdout, compare_cfgs(merged_cfg, dest_cfg),
+        show_diff(sys.stdout, iter_compare_cfgs(merged_cfg, dest_cfg, comments=True,
+                                                skip_identical=True),
                   headers=(dest.name, dest.name + "-new"))
         return SMART_UPDATE
     return dest.dump(merged_cfg)
+
+
+####################################################################################################
+## Three-way merge
+
+MERGE3_OURS = "ours"
+MERGE3_THEIRS = "theirs"
+
+# A change made on both sides that can't be merged.  `key` is None when the conflict is about the
+# entire stanza (for example, modified on one side but removed on the other).  Each of `base`,
+# `ours`, and `theirs` is the value (or stanza) on that side, or None if it's missing.
+MergeConflict = namedtuple("MergeConflict", ("stanza", "key", "base", "ours", "theirs"))
+
+
+def _same(a, b):
+    """ True if `a` and `b` (stanzas, confs, or values) have the same content.  Digests are
+    used when they are already known for both. """
+    if a is b:
+        return True
+    if a is None or b is None:
+        return False
+    digest_a = _cached_digest(a)
+    if digest_a is not None:
+        digest_b = _cached_digest(b)
+        if digest_b is not None:
+            return digest_a == digest_b
+    return a == b
+
+
+def _copy_stanza(stanza):
+    if isinstance(stanza, Stanza):
+        return stanza.copy()
+    return Stanza(stanza)
+
+
+def _merge3_stanza(name, base, ours, theirs, prefer, conflicts):
+    """ Merge a stanza that was changed on both sides, key by key.  Returns the merged stanza. """
+    result = Stanza()
+    if ours is not None and getattr(ours, "comments", None):
+        result.comments = list(ours.comments)
+    elif theirs is not None and getattr(theirs, "comments", None):
+        result.comments = list(theirs.comments)
+    base = base or {}
+    ours = ours or {}
+    theirs = theirs or {}
+    for key in sorted(set(base).union(ours, theirs)):
+        value_b = base.get(key)
+        value_o = ours.get(key)
+        value_t = theirs.get(key)
+        if value_o == value_t or value_t == value_b:
+            value = value_o
+        elif value_o == value_b:
+            value = value_t
+        else:
+            conflicts.append(MergeConflict(name, key, value_b, value_o, value_t))
+            value = value_t if prefer == MERGE3_THEIRS else value_o
+        if value is not None:
+            result[key] = value
+    return result
+
+
+def merge3(base, ours, theirs, prefer=MERGE3_OURS):
+    """ Three-way merge of the changes made to `base` in `ours` and in `theirs` (for example, the
+    old default, the local copy, and the new default of an app).
+
+    Returns a tuple (merged, conflicts).  `merged` is a new Conf.  Changes made on only one side
+    are taken as is.  `conflicts` is a list of MergeConflict for each key (or stanza) changed
+    differently on both sides;  `prefer` (MERGE3_OURS or MERGE3_THEIRS) picks the side used in
+    `merged` in that case.
+
+    Each stanza is handled in a single pass over the three versions.  Stanzas that are the same
+    on any two sides are resolved without looking at their keys, using their content digests if
+    they're already known (for example, when loaded from the parse cache).
+    Comments aren't merged;  they're taken from the side that the stanza came from (`ours`, for a
+    stanza merged key by key).
+    """
+    merged = Conf()
+    conflicts = []
+    for name in sorted(set(base).union(ours, theirs)):
+        stanza_b = base.get(name)
+        stanza_o = ours.get(name)
+        stanza_t = theirs.get(name)
+        if _same(stanza_o, stanza_t) or _same(stanza_b, stanza_t):
+            stanza = stanza_o
+        elif _same(stanza_b, stanza_o):
+            stanza = stanza_t
+        elif stanza_o is None or (stanza_t is None and stanza_b is not None):
+            # Removed on one side, but modified on the other
+            conflicts.append(MergeConflict(name, None, stanza_b, stanza_o, stanza_t))
+            stanza = stanza_t if prefer == MERGE3_THEIRS else stanza_o
+        else:
+            merged[name] = _merge3_stanza(name, stanza_b, stanza_o, stanza_t, prefer, conflicts)
+            continue
+        if stanza is not None:
+            merged[name] = _copy_stanza(stanza)
+    return (merged, conflicts)
@@ -1,17 +1,33 @@
 from __future__ import absolute_import, unicode_literals
 
+import binascii
 import codecs
+import hashlib
+import json
+import mmap
+import multiprocessing
 import os
 import re
-from io import open, StringIO
+import sys
+from array import array
+from collections import namedtuple
+from io import open, BytesIO, StringIO
+from itertools import chain
 
 import six
 
 from ..consts import SMART_NOCHANGE, SMART_UPDATE, SMART_CREATE
 from ..util.compare import fileobj_compare
+from ..util.file import atomic_replace
 
 default_encoding = "utf-8"
 
+# Files at least this big are parsed with the memory-mapped bytes-level parser by default
+MMAP_PARSE_THRESHOLD = 32 * 1024 * 1024
+
+# Number of rendered lines write_conf_stream() buffers before writing to the output stream
+WRITE_BUFFER_SIZE = 4096
+
 class Token(object):
     """ Immutable token object.  deepcopy returns the same object """
 
@@ -19,18 +35,374 @@ class Token(object):
         memo[id(self)] = self
         return self
 
-    # Always sort to the top of the list (should only ever be GLOBAL stanza)
+    def __reduce__(self):
+        # Unpickle as a reference to the module-level singleton, so 'is GLOBAL_STANZA' still works.
+        # Python 2's pickle only accepts a native str here, not unicode.
+        return str("GLOBAL_STANZA")
+
+    # Always sort to the top of the list (should only ever be GLOBAL stanza).  Native byte strings
+    # count too (on Python 2), otherwise the order depends on the type of the other names.
     def __lt__(self, other):
-        return isinstance(other, six.text_type)
+        return isinstance(other, six.string_types)
 
     def __gt__(self, other):
-        return not isinstance(other, six.text_type)
+        return not isinstance(other, six.string_types)
 
 DUP_OVERWRITE = "overwrite"
 DUP_MERGE = "merge"
 
 GLOBAL_STANZA = Token()
 
+
+class Stanza(dict):
+    """ Key/value content of a single stanza.  Behaves exactly like a dict of the stanza's
+    settings;  comments are stored out-of-band so they never show up as keys.
+
+    `comments` is a list of (anchor, text) tuples in file order.  The anchor is the key that the
+    comment precedes, or None for comments at the end of the stanza.  Comments are written out as
+    a block just before the first key that sorts after '#', which is where comments have always
+    ended up in ksconf's sorted output.
+
+    Most stanzas have no comments, so the list is only allocated the first time it's accessed.
+
+    digest() returns an order-insensitive digest of the stanza's keys and values (comments are
+    not included).  The parser computes it for every stanza;  otherwise it's computed on first
+    use.  Either way it's kept until the stanza is modified.
+    """
+    __slots__ = ("_comments", "_digest")
+
+    # Incremented whenever any Stanza is modified;  see Conf.digest()
+    _generation = 0
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._comments = None
+        self._digest = None
+
+    @property
+    def comments(self):
+        if self._comments is None:
+            self._comments = []
+        return self._comments
+
+    @comments.setter
+    def comments(self, value):
+        self._comments = value
+
+    def digest(self):
+        if self._digest is None:
+            self._digest = _stanza_digest(self)
+        return self._digest
+
+    def hexdigest(self):
+        return binascii.hexlify(self.digest()).decode("ascii")
+
+    def _changed(self):
+        self._digest = None
+        Stanza._generation += 1
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._changed()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._changed()
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._changed()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def pop(self, *args):
+        value = dict.pop(self, *args)
+        self._changed()
+        return value
+
+    def popitem(self):
+        item = dict.popitem(self)
+        self._changed()
+        return item
+
+    def clear(self):
+        dict.clear(self)
+        self._changed()
+
+    def copy(self):
+        s = Stanza(self)
+        if self._comments:
+            s._comments = list(self._comments)
+        s._digest = self._digest
+        return s
+
+    def __reduce__(self):
+        # Needed for pickle/deepcopy support with __slots__ (on Python 2 especially)
+        return (self.__class__, (dict(self),), (self._comments, self._digest))
+
+    def __setstate__(self, state):
+        (self._comments, self._digest) = state
+
+    def __repr__(self):
+        if self._comments:
+            return "Stanza({0}, comments={1!r})".format(dict.__repr__(self), self._comments)
+        return "Stanza({0})".format(dict.__repr__(self))
+
+
+class Conf(dict):
+    """ Parsed content of a .conf file:  a dict of stanza name to Stanza.
+
+    Stanza names and keys are interned as they are parsed, so the same name is only stored once
+    no matter how many files (or layers) it appears in.
+
+    `positions` is a ConfPositions object with the line number of each stanza and key when the
+    file was parsed with the 'keep_positions' option, otherwise None.
+
+    digest() returns an order-insensitive digest of the entire content, built from the digest of
+    each stanza.  It's computed by the parser, and kept until the Conf or any Stanza is modified.
+    """
+    __slots__ = ("positions", "_digest")
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.positions = None
+        self._digest = None
+
+    def digest(self):
+        if self._digest is not None and self._digest[1] == Stanza._generation:
+            return self._digest[0]
+        digest = _conf_digest(self)
+        # Changes to plain dict stanzas can't be detected, so only cache if they're all Stanzas
+        if all(isinstance(stanza, Stanza) for stanza in self.values()):
+            self._digest = (digest, Stanza._generation)
+        return digest
+
+    def hexdigest(self):
+        return binascii.hexlify(self.digest()).decode("ascii")
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._digest = None
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._digest = None
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._digest = None
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def pop(self, *args):
+        self._digest = None
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._digest = None
+        return dict.popitem(self)
+
+    def clear(self):
+        dict.clear(self)
+        self._digest = None
+
+    def __reduce__(self):
+        digest = _cached_digest(self)
+        return (self.__class__, (dict(self),), (self.positions, digest))
+
+    def __setstate__(self, state):
+        (self.positions, digest) = state
+        if digest is not None:
+            self._digest = (digest, Stanza._generation)
+
+
+def _digest_default(value):
+    # Values that aren't text (which can be given to write_conf()) are tagged, so that they
+    # don't have the same digest as the equivalent string.
+    return ["~", repr(value)]
+
+
+_digest_encode = json.JSONEncoder(sort_keys=True, ensure_ascii=False, separators=(",", ":"),
+                                  default=_digest_default).encode
+
+
+if six.PY2:  # pragma: no cover
+    def _digest_text(value):
+        """ Native (byte) strings are decoded, so they have the same digest as the same text """
+        if isinstance(value, bytes):
+            return value.decode(default_encoding)
+        return value
+else:
+    def _digest_text(value):
+        return value
+
+
+def _stanza_digest(stanza):
+    """ Order-insensitive digest of a stanza's keys and values (any dict).
+
+    Since this is done for every stanza that's parsed, the sorted keys and values are simply
+    joined with NUL characters, which is much faster than a JSON encoding.  Content where that
+    would be ambiguous (text containing NULs) or impossible (values that aren't text) is JSON
+    encoded instead.  JSON never contains a raw NUL, so the two can't produce the same input.
+    """
+    if six.PY2:  # pragma: no cover
+        stanza = dict((_digest_text(k), _digest_text(v)) for (k, v) in six.iteritems(stanza))
+    items = sorted(stanza.items())
+    try:
+        text = "\0".join(chain.from_iterable(items))
+    except TypeError:
+        text = None
+    if text is None or text.count("\0") != 2 * len(items) - 1:
+        text = _digest_encode(stanza)
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+def _conf_digest(conf):
+    """ Order-insensitive digest of an entire conf (any dict of dicts) """
+    h = hashlib.sha256()
+    for (text, name) in sorted((_digest_text(name), name) for name in conf):
+        stanza = conf[name]
+        h.update(b"*" if name is GLOBAL_STANZA else _digest_encode(text).encode("utf-8"))
+        h.update(stanza.digest() if isinstance(stanza, Stanza) else _stanza_digest(stanza))
+    return h.digest()
+
+
+def stanza_digest(stanza):
+    """ Return the digest of a stanza.  The digest of a Stanza is cached. """
+    if isinstance(stanza, Stanza):
+        return stanza.digest()
+    return _stanza_digest(stanza)
+
+
+def conf_digest(conf):
+    """ Return the digest of an entire conf.  The digest of a Conf is cached. """
+    if isinstance(conf, Conf):
+        return conf.digest()
+    return _conf_digest(conf)
+
+
+def _cached_digest(value):
+    """ Digest of a Stanza or Conf, but only if it's already known (otherwise None) """
+    digest = getattr(value, "_digest", None)
+    if isinstance(value, Conf) and digest is not None:
+        return digest[0] if digest[1] == Stanza._generation else None
+    return digest
+
+
+def same_content(a, b):
+    """ Quick check if `a` and `b` (stanzas or confs) are known to have the same keys and values,
+    without comparing them.  True if they're the same object or have the same (already
+    computed) digest;  parsed content always has one until it's modified.  False means
+    "unknown", not different. """
+    if a is b:
+        return True
+    digest = _cached_digest(a)
+    return digest is not None and digest == _cached_digest(b)
+
+
+class ConfPositions(object):
+    """ Source line numbers of the stanzas and keys of a parsed file.
+
+    Positions are stored in a few flat integer arrays (plus a list referencing the already
+    interned key names) in the order they were parsed, rather than as an object per key.  Line
+    numbers are 1-based;  GLOBAL_STANZA is at line 0.  For duplicate keys, the last one (which
+    is the one that's kept) is reported.
+    """
+    __slots__ = ("name", "_stanzas", "_stanza_lines", "_key_start", "_key_end", "_keys",
+                 "_key_lines", "_key_stanzas")
+
+    def __init__(self, name):
+        self.name = name
+        # Stanza name to stanza number (the index into the other stanza arrays)
+        self._stanzas = {}
+        self._stanza_lines = array("I")
+        # Range of entries in the key arrays that belong to each stanza
+        self._key_start = array("I")
+        self._key_end = array("I")
+        self._keys = []
+        self._key_lines = array("I")
+        self._key_stanzas = array("I")
+
+    def add_stanza(self, stanza, lineno, reset=False):
+        """ Record a stanza header and return the stanza number.  If `reset` is True, positions
+        from an earlier stanza of the same name are forgotten (its content was overwritten). """
+        i = self._stanzas.get(stanza)
+        if i is None:
+            i = self._stanzas[stanza] = len(self._stanza_lines)
+            self._stanza_lines.append(lineno)
+            self._key_start.append(len(self._keys))
+            self._key_end.append(len(self._keys))
+        elif reset:
+            self._stanza_lines[i] = lineno
+            self._key_start[i] = self._key_end[i] = len(self._keys)
+        return i
+
+    def add_key(self, i, key, lineno):
+        """ Record `key` within stanza number `i` """
+        self._keys.append(key)
+        self._key_lines.append(lineno)
+        self._key_stanzas.append(i)
+        self._key_end[i] = len(self._keys)
+
+    def line(self, stanza, key=None):
+        """ Return the line number of `stanza` (its header), or of `key` within that stanza.
+        Returns None if not known. """
+        i = self._stanzas.get(stanza)
+        if i is None:
+            return None
+        if key is None:
+            return self._stanza_lines[i]
+        keys = self._keys
+        key_stanzas = self._key_stanzas
+        for j in range(self._key_end[i] - 1, self._key_start[i] - 1, -1):
+            if key_stanzas[j] == i and keys[j] == key:
+                return self._key_lines[j]
+        return None
+
+    def location(self, stanza, key=None):
+        """ Return 'file:line' for a stanza or key, or just the file name if it's not known """
+        lineno = self.line(stanza, key)
+        if lineno is None:
+            return self.name
+        return "{0}:{1}".format(self.name, lineno)
+
+    def __getstate__(self):
+        return [getattr(self, attr) for attr in self.__slots__]
+
+    def __setstate__(self, state):
+        for (attr, value) in zip(self.__slots__, state):
+            setattr(self, attr, value)
+
+    def __deepcopy__(self, memo):
+        # Positions are never modified once parsing is done
+        memo[id(self)] = self
+        return self
+
+
+try:
+    _intern = sys.intern
+except AttributeError:  # pragma: no cover  (Python 2)
+    # The builtin intern() only accepts byte strings.  Entries are never released; this is only
+    # used for stanza names and keys, which come from a fairly small vocabulary.
+    _interned = {}
+
+    def _intern(value):
+        return _interned.setdefault(value, value)
+
 # Parsing configuration profiles
 
 DUP_EXCEPTION = "exception"
@@ -77,6 +449,39 @@ class DuplicateStanzaException(ConfParserException):
     pass
 
 
+class ConfParserErrors(ConfParserException):
+    """ All the errors found in a file by check_conf(), when it's asked to collect more than one.
+    `errors` is a list of EVENT_ERROR ConfEvents, so each error comes with its line number. """
+
+    def __init__(self, errors):
+        super(ConfParserErrors, self).__init__(errors)
+        self.errors = errors
+
+    def __str__(self):
+        return "\n".join("{0}  (line {1})".format(e.value, e.lineno) for e in self.errors)
+
+
+# Parser backends.  The fused tokenizer is the default; the legacy generator chain
+# (cont_handler -> section_reader -> splitup_kvpairs) is kept around for comparison and debugging.
+PARSER_BACKEND_FUSED = "fused"
+PARSER_BACKEND_LEGACY = "legacy"
+
+# Token types produced by tokenize_conf()
+TOKEN_STANZA = "stanza"
+TOKEN_KEY = "key"
+TOKEN_COMMENT = "comment"
+TOKEN_ERROR = "error"
+
+# Event types produced by parse_conf_events()
+EVENT_STANZA = TOKEN_STANZA
+EVENT_KEY = TOKEN_KEY
+EVENT_COMMENT = TOKEN_COMMENT
+EVENT_CONTINUATION = "continuation"
+EVENT_ERROR = TOKEN_ERROR
+
+ConfEvent = namedtuple("ConfEvent", ("type", "lineno", "stanza", "key", "value"))
+
+
 ####################################################################################################
 ## Core parsing / conf file writing logic
 
@@ -109,6 +514,10 @@ def detect_by_bom(path, default):
     # https://stackoverflow.com/a/24370596/315892
     with open(path, 'rb') as f:
         raw = f.read(4)    # will read less if the file is smaller
+    return _detect_bom(raw, default)
+
+
+def _detect_bom(raw, default):
     for (enc, boms) in (
             ('utf-8-sig', (codecs.BOM_UTF8,)),\
             ('utf-16', (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)),\
@@ -119,6 +528,54 @@ def detect_by_bom(path, default):
     return default
 
 
+class ConfBuffer(object):
+    """ The raw content of a .conf file, read with a single open().  The encoding (from the BOM),
+    the KSCONF-NO-SORT marker, parsing, and checking if new content is any different can all be
+    handled from the same buffer. """
+
+    def __init__(self, name, raw, encoding=None):
+        self.name = name
+        self.raw = raw
+        self.encoding = encoding or _detect_bom(raw[:4], default_encoding)
+
+    @classmethod
+    def read(cls, path, encoding=None):
+        with open(path, "rb") as stream:
+            return cls(path, stream.read(), encoding)
+
+    def has_marker(self, marker=b"KSCONF-NO-SORT", limit=4096):
+        """ Check for `marker` in the first `limit` bytes of the file """
+        return marker in self.raw[:limit]
+
+    def text(self):
+        """ Decoded content, with line endings translated the same way as a text-mode file """
+        return self.raw.decode(self.encoding).replace("\r\n", "\n").replace("\r", "\n")
+
+    def parse(self, profile=PARSECONF_MID):
+        conf = _parse_conf_bytes(self.raw, self.name, self.encoding, **profile)
+        if conf is not None:
+            return conf
+        stream = StringIO(self.text())
+        stream.name = self.name
+        return parse_conf_stream(stream, **profile)
+
+    def matches(self, content):
+        """ Return True if the file contains exactly `content` (text).  Like smart_write_conf()
+        always has, this compares against the file decoded as UTF-8 with universal newlines. """
+        if "\r" in content:
+            # Never present after newline translation
+            return False
+        if self.raw == content.encode(default_encoding):
+            return True
+        if b"\r" not in self.raw:
+            return False
+        try:
+            text = self.raw.decode(default_encoding)
+        except UnicodeDecodeError:
+            return False
+        return text.replace("\r\n", "\n").replace("\r", "\n") == content
+
+
 def cont_handler(iterable, continue_re=re.compile(r"^(.*)\\$"), breaker="\n"):
     buf = ""
     for line in iterable:
@@ -152,26 +609,517 @@ def splitup_kvpairs(lines, comments_re=re.compile(r"^\s*[#;]"), keep_comments=Fa
             raise ConfParserException("Unexpected entry:  {0}".format(entry))
 
 
-def parse_conf(stream, profile=PARSECONF_MID, encoding=None):
+class _TokenSyntax(object):
+    """ Literals used by the tokenizer.  Allows the same code to run over text or bytes lines. """
+
+    def __init__(self, literal, decode):
+        self.section_re = re.compile(literal(r'^[\s\t]*\[(.*)\]\s*$'))
+        self.backslash = literal("\\")
+        self.cont_eol = literal("\\\n")
+        self.cont_ends = (self.cont_eol, self.backslash)
+        self.eol_chars = literal("\r\n")
+        self.newline = literal("\n")
+        self.empty = literal("")
+        self.lbracket = literal("[")
+        self.rbracket = literal("]")
+        self.comment_chars = (literal("#"), literal(";"))
+        self.equals = literal("=")
+        # Only used to build error messages (rare), so no need to be fast
+        self.decode = decode
+
+
+_TEXT_SYNTAX = _TokenSyntax(lambda l: l, lambda l: l)
+_BYTES_SYNTAX = _TokenSyntax(lambda l: l.encode("ascii"),
+                             lambda l: l.decode(default_encoding, "replace"))
+
+
+def tokenize_conf(stream, keep_comments=False, strict=False, handle_conts=True):
+    """
+    Single-pass tokenizer that combines the work of cont_handler(), section_reader(), and
+    splitup_kvpairs() into one loop.  Each logical line is classified using plain string
+    operations; the stanza regex is only consulted for lines that actually start with '['.
+
+    Yields 4-tuples in the form (token, lineno, a, b):
+
+        (TOKEN_STANZA, lineno, stanza_name, None)
+        (TOKEN_KEY, lineno, key, value)
+        (TOKEN_COMMENT, lineno, comment_line, None)
+        (TOKEN_ERROR, lineno, message, None)
+
+    Line numbers are 1-based and refer to the first physical line of a logical (possibly
+    continued) line.  Errors are yielded, not raised, so the caller decides how to handle them.
+    The grammar accepted (including the dropping of stanzas that have no lines at all) is
+    identical to the legacy generator chain.
+    """
+    return _tokenize(stream, keep_comments, strict, handle_conts, _TEXT_SYNTAX)
+
+
+def _tokenize(stream, keep_comments, strict, handle_conts, syntax, decode=None,
+              stanza=GLOBAL_STANZA):
+    """ Implementation of tokenize_conf().  Lines may be either text or bytes.  In bytes mode,
+    stanza names, keys, values, and comments are passed through `decode` as they are emitted
+    (or yielded as bytes if no `decode` function is given).  Lines before the first stanza
+    header belong to `stanza`, which allows a single stanza body to be tokenized on its own. """
+    section_match = syntax.section_re.match
+    cont_eol = syntax.cont_eol
+    cont_ends = syntax.cont_ends
+    eol_chars = syntax.eol_chars
+    newline = syntax.newline
+    lbracket = syntax.lbracket
+    rbracket = syntax.rbracket
+    comment1, comment2 = syntax.comment_chars
+    equals = syntax.equals
+    # A stanza header isn't emitted until the first line following it is seen.  This mirrors
+    # section_reader() which only yields sections containing at least one line.
+    pending = stanza
+    pending_line = 0
+    cont = []
+    cont_line = 0
+    lineno = 0
+    # An empty string can't come from a stream, so it marks EOF (flushes a dangling continuation)
+    for line in chain(stream, (syntax.empty,)):
+        lineno += 1
+        if handle_conts:
+            # Note:  'in' tests are avoided here; they are slow for bytes lines on Python 3
+            if line.endswith(cont_ends):
+                if not cont:
+                    cont_line = lineno
+                if line.endswith(cont_eol):
+                    cont.append(line[:-2])
+                else:
+                    # Continuation on the very last line of the file (no trailing newline)
+                    cont.append(line[:-1])
+                continue
+            if cont:
+                cont.append(line)
+                line = newline.join(cont)
+                del cont[:]
+                entry_line = cont_line
+            elif not line:
+                break
+            else:
+                entry_line = lineno
+        elif not line:
+            break
+        else:
+            entry_line = lineno
+        line = line.rstrip(eol_chars)
+        stripped = line.lstrip()
+        first = stripped[:1]
+        if first == lbracket:
+            mo = section_match(line)
+            if mo:
+                pending = mo.group(1)
+                if decode:
+                    pending = decode(pending)
+                pending_line = entry_line
+                continue
+        if pending is not None:
+            yield (TOKEN_STANZA, pending_line, pending, None)
+            pending = None
+        if not first:
+            continue
+        if first == comment1 or first == comment2:
+            if keep_comments:
+                yield (TOKEN_COMMENT, entry_line, decode(line) if decode else line, None)
+        else:
+            kv = line.split(equals, 1)
+            if len(kv) == 2:
+                if decode:
+                    # Bytes-level stripping only covers ASCII whitespace; strip again once
+                    # decoded to match the text-mode parser
+                    yield (TOKEN_KEY, entry_line, decode(kv[0]).rstrip(), decode(kv[1]).lstrip())
+                else:
+                    yield (TOKEN_KEY, entry_line, kv[0].rstrip(), kv[1].lstrip())
+            elif first == lbracket or line.rstrip().endswith(rbracket):
+                # ToDo:  There should be a 'loose' mode that allows this to be ignored...
+                yield (TOKEN_ERROR, entry_line,
+                       "Dangling stanza header:  {0}".format(syntax.decode(line)), None)
+            elif strict:
+                yield (TOKEN_ERROR, entry_line,
+                       "Unexpected entry:  {0}".format(syntax.decode(line)), None)
+    if pending is not None and pending is not GLOBAL_STANZA and pending:
+        # Trailing stanza header with no content
+        yield (TOKEN_STANZA, pending_line, pending, None)
+
+
+def parse_conf(stream, profile=PARSECONF_MID, encoding=None, use_mmap=None):
+    """ Parse a .conf file from an open stream or a filename.
+
+    For filenames, `use_mmap` controls the memory-mapped bytes-level parser.  The default
+    (None) uses mmap for files of MMAP_PARSE_THRESHOLD bytes or larger.  Files that can't be
+    handled at the bytes level (UTF-16/32 BOMs, old Mac line endings, ...) always fall back to
+    the normal text-mode parser.
+    """
     # Placeholder stub for an eventual migration to proper class-oriented parser
     if hasattr(stream, "read"):
         return parse_conf_stream(stream, **profile)
     else:
+        # Assume it's a filename
+        if use_mmap is None:
+            use_mmap = os.path.getsize(stream) >= MMAP_PARSE_THRESHOLD
+        if use_mmap:
+            conf = _parse_conf_mmap(stream, encoding or detect_by_bom(stream, default_encoding),
+                                    **profile)
+            if conf is not None:
+                return conf
+        return ConfBuffer.read(stream, encoding).parse(profile)
+
+
+def parse_conf_events(stream, profile=PARSECONF_MID, encoding=None):
+    """ Streaming (event-based) version of parse_conf().  Nothing is retained apart from the
+    names of stanzas seen so far and the keys of the current stanza (for duplicate detection), so
+    files of any size can be processed in constant memory.  The same tokenizer is used as
+    parse_conf_stream(), so exactly the same content is accepted.
+
+    Yields ConfEvent(type, lineno, stanza, key, value) tuples:
+
+        EVENT_STANZA        Start of `stanza`  (`key` and `value` are None).  Any content before
+                            the first stanza header belongs to GLOBAL_STANZA, at line 0.
+        EVENT_KEY           `key` = `value` within `stanza`
+        EVENT_COMMENT       Comment line `value`  (only when the profile keeps comments)
+        EVENT_CONTINUATION  Follows a multi-line key (or comment), once for each continued line;
+                            `value` is the text of that line.  Purely informational.
+        EVENT_ERROR         `value` is the ConfParserException that parse_conf() would raise
+
+    Unlike parse_conf(), errors don't stop processing;  that's up to the caller.
+    """
+    return _conf_events(stream, encoding, **profile)
+
+
+def _conf_events(stream, encoding=None, keys_lower=False, handle_conts=True, keep_comments=False,
+                 dup_stanza=DUP_EXCEPTION, dup_key=DUP_OVERWRITE, strict=False,
+                 keep_positions=False):
+    # Events always include line numbers, so 'keep_positions' has nothing to do here
+    if hasattr(stream, "read"):
+        close = None
+    else:
+        # Assume it's a filename.  Closed once the generator finishes (or is discarded).
         if not encoding:
             encoding = detect_by_bom(stream, default_encoding)
-        # Assume it's a filename
-        with open(stream, "r", encoding=encoding) as stream:
-            return parse_conf_stream(stream, **profile)
+        stream = close = open(stream, "r", encoding=encoding)
+    stream_name = stream.name if hasattr(stream, "name") else repr(stream)
+    tokens = tokenize_conf(stream, keep_comments=keep_comments, strict=strict,
+                           handle_conts=handle_conts)
+    # Skip the (relatively slow) namedtuple constructor for the common event types
+    new = tuple.__new__
+    seen_stanzas = set()
+    local_stanza = set()
+    section = None
+    try:
+        for (token, lineno, a, b) in tokens:
+            if token == TOKEN_KEY:
+                if keys_lower:
+                    a = a.lower()
+                if a in local_stanza:
+                    if dup_key == DUP_EXCEPTION:
+                        yield ConfEvent(EVENT_ERROR, lineno, section, a, DuplicateKeyException(
+                            "Stanza [{0}] has duplicate key '{1}' in file {2}".format(
+                                _format_stanza(section), a, stream_name)))
+                else:
+                    local_stanza.add(a)
+                yield new(ConfEvent, (EVENT_KEY, lineno, section, a, b))
+                text = b
+            elif token == TOKEN_STANZA:
+                section = a
+                if section in seen_stanzas:
+                    if dup_stanza == DUP_EXCEPTION:
+                        yield ConfEvent(EVENT_ERROR, lineno, section, None,
+                                        DuplicateStanzaException(
+                                            "Stanza [{0}] found more than once in config file "
+                                            "{1}".format(_format_stanza(section), stream_name)))
+                else:
+                    seen_stanzas.add(section)
+                local_stanza = set()
+                yield new(ConfEvent, (EVENT_STANZA, lineno, section, None, None))
+                continue
+            elif token == TOKEN_COMMENT:
+                yield new(ConfEvent, (EVENT_COMMENT, lineno, section, None, a))
+                text = a
+            else:
+                yield ConfEvent(EVENT_ERROR, lineno, section, None, ConfParserException(a))
+                continue
+            if "\n" in text:
+                key = a if token == TOKEN_KEY else None
+                for (i, line) in enumerate(text.split("\n")[1:], 1):
+                    yield new(ConfEvent, (EVENT_CONTINUATION, lineno + i, section, key, line))
+    finally:
+        if close:
+            close.close()
+
+
+def check_conf(stream, profile=PARSECONF_MID, encoding=None, max_errors=None):
+    """ Raise the same ConfParserException as parse_conf() would for the given content, if any,
+    but without building the parsed result.  Uses parse_conf_events().
+
+    To find more than one problem in a single pass, set `max_errors` to the number of errors to
+    collect before stopping (0 for no limit).  Any errors found are then raised together as a
+    ConfParserErrors exception.
+    """
+    errors = []
+    for event in parse_conf_events(stream, profile, encoding):
+        if event.type == EVENT_ERROR:
+            if max_errors is None:
+                raise event.value
+            errors.append(event)
+            if max_errors and len(errors) >= max_errors:
+                break
+    if errors:
+        raise ConfParserErrors(errors)
+
+
+def _parse_conf_job(job):
+    (path, profile, encoding, check_only, max_errors) = job
+    try:
+        if check_only:
+            return check_conf(path, profile, encoding, max_errors)
+        return parse_conf(path, profile, encoding)
+    except ConfParserException as e:
+        return e
+
+
+def parse_conf_many(paths, profile=PARSECONF_MID, jobs=None, encoding=None, check_only=False,
+                    max_errors=None):
+    """ Parse several .conf files, using a pool of `jobs` worker processes.  `jobs` defaults to
+    the number of CPUs;  with 1 job, files are parsed one at a time in the current process.
+
+    Yields (path, result) tuples in the same order as `paths`.  Each tuple is yielded as soon as
+    that file (and all those before it) are done.  `result` is either the parsed conf or the
+    ConfParserException raised while parsing the file.  Other errors (like a missing file) are
+    raised.  If `check_only` is True, files are only validated (see check_conf(), which is also
+    given `max_errors`), and the result for a valid file is None.
+    """
+    if not jobs:
+        jobs = multiprocessing.cpu_count()
+    if not isinstance(paths, (list, tuple)):
+        paths = list(paths)
+    work = [(path, profile, encoding, check_only, max_errors) for path in paths]
+    if jobs == 1 or len(work) < 2:
+        for (path, job) in zip(paths, work):
+            yield (path, _parse_conf_job(job))
+        return
+    pool = multiprocessing.Pool(min(jobs, len(work)))
+    try:
+        for (path, result) in six.moves.zip(paths, pool.imap(_parse_conf_job, work)):
+            yield (path, result)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _parse_conf_mmap(path, encoding, **profile):
+    """ Parse a file by memory mapping it and tokenizing raw bytes.  Only stanza names, keys,
+    values, and comments are decoded, and only as they are emitted.  Returns None if the file
+    must be handled by the text-mode parser instead. """
+    if _bytes_encoding(encoding) is None:
+        return None
+    with open(path, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            return None
+    try:
+        return _parse_conf_bytes(mm, path, encoding, **profile)
+    finally:
+        mm.close()
+
+
+def _bytes_encoding(encoding):
+    """ Return (encoding, bom_length) for content that can be tokenized at the bytes level, or
+    None.  Multi-byte encodings (UTF-16/32) can't be scanned for b"[", b"=" and b"\n". """
+    if encoding == "utf-8-sig":
+        return ("utf-8", len(codecs.BOM_UTF8))
+    elif codecs.lookup(encoding).name == "utf-8":
+        return (encoding, 0)
+    return None
+
+
+def _parse_conf_bytes(buf, name, encoding, keys_lower=False, handle_conts=True,
+                      keep_comments=False, dup_stanza=DUP_EXCEPTION, dup_key=DUP_OVERWRITE,
+                      strict=False, backend=PARSER_BACKEND_FUSED, keep_positions=False):
+    """ Tokenize raw (bytes or mmap) content.  Returns None if the content must be handled by the
+    text-mode parser instead. """
+    if backend != PARSER_BACKEND_FUSED:
+        return None
+    bytes_encoding = _bytes_encoding(encoding)
+    if bytes_encoding is None:
+        return None
+    (encoding, skip) = bytes_encoding
+    if buf.find(b"\r") != -1 and _lone_cr_re.search(buf):
+        # Text mode treats a bare CR as a line break; let the text parser deal with it.
+        return None
+    if _has_text_only_space(buf, skip):
+        # Unicode whitespace (e.g., a non-breaking space before a '#') changes how lines
+        # are classified, so leave these to the text parser too.
+        return None
+    if isinstance(buf, mmap.mmap):
+        buf.seek(skip)
+        lines = iter(buf.readline, b"")
+    else:
+        lines = BytesIO(buf)
+        lines.seek(skip)
+    if buf.find(b"\r", skip) != -1:
+        lines = _crlf_to_lf(lines)
+    # Always decode, even pure ASCII content:  on Python 2, native (byte) str names and keys
+    # don't sort or compare like the text that every other code path produces.
+    def decode(value):
+        return value.decode(encoding)
+    tokens = _tokenize(lines, keep_comments, strict, handle_conts, _BYTES_SYNTAX, decode)
+    return _parse_conf_tokens(tokens, name, keys_lower, dup_stanza, dup_key, keep_positions)
+
+
+_lone_cr_re = re.compile(b"\r(?!\n)")
+# Whitespace (as UTF-8) that text-mode string methods and regexes recognize, but bytes don't
+_text_only_space_re = re.compile(b"[\x1c-\x1f]|\xc2[\x85\xa0]|\xe1\x9a\x80|"
+                                 b"\xe2\x80[\x80-\x8a\xa8\xa9\xaf]|\xe2\x81\x9f|\xe3\x80\x80")
+_text_only_space_leads = (b"\x1c", b"\x1d", b"\x1e", b"\x1f", b"\xc2", b"\xe1", b"\xe2", b"\xe3")
+
+
+def _has_text_only_space(buf, start=0):
+    """ Check for whitespace that would make bytes-level line classification (comments, stanza
+    headers) differ from text mode.  Quick scans for the leading bytes rule out most content
+    before the (much slower) regex is needed. """
+    if any(buf.find(lead, start) != -1 for lead in _text_only_space_leads):
+        return _text_only_space_re.search(buf, start) is not None
+    return False
+
+
+def _crlf_to_lf(lines):
+    # Match the universal newline translation done by text-mode file objects
+    for line in lines:
+        if line.endswith(b"\r\n"):
+            line = line[:-2] + b"\n"
+        yield line
 
 
 def parse_conf_stream(stream, keys_lower=False, handle_conts=True, keep_comments=False,
-                dup_stanza=DUP_EXCEPTION, dup_key=DUP_OVERWRITE, strict=False):
+                dup_stanza=DUP_EXCEPTION, dup_key=DUP_OVERWRITE, strict=False,
+                backend=PARSER_BACKEND_FUSED, keep_positions=False):
+    """ Parse an open stream.  If `keep_positions` is True, the line number of every stanza and
+    key is recorded in the returned Conf's `positions` (not supported by the legacy backend). """
     if hasattr(stream, "name"):
         stream_name = stream.name
     else:
         stream_name = repr(stream)
 
-    sections = {}
+    if backend == PARSER_BACKEND_LEGACY:
+        return _parse_conf_stream_legacy(stream, stream_name, keys_lower, handle_conts,
+                                         keep_comments, dup_stanza, dup_key, strict)
+    tokens = tokenize_conf(stream, keep_comments=keep_comments, strict=strict,
+                           handle_conts=handle_conts)
+    return _parse_conf_tokens(tokens, stream_name, keys_lower, dup_stanza, dup_key,
+                              keep_positions)
+
+
+def _parse_conf_tokens(tokens, stream_name, keys_lower=False, dup_stanza=DUP_EXCEPTION,
+                       dup_key=DUP_OVERWRITE, keep_positions=False):
+    """ Build the sections dictionary from a tokenize_conf() token stream. """
+    sections = Conf()
+    # Nothing has a digest yet, so skip the change tracking of Conf/Stanza.__setitem__()
+    set_item = dict.__setitem__
+    if keep_positions:
+        positions = sections.positions = ConfPositions(stream_name)
+    else:
+        positions = None
+    s = local_stanza = section = None
+    # Comments are anchored to the next key, so hold onto them until it's seen
+    comments = []
+    # (stanza, comments) set aside while a duplicate stanza is merged into an earlier one
+    merged_comments = None
+    for (token, lineno, a, b) in tokens:
+        if token == TOKEN_KEY:
+            if keys_lower:
+                a = a.lower()
+            a = _intern(a)
+            if comments:
+                s.comments.extend([(a, comment) for comment in comments])
+                del comments[:]
+            if a in local_stanza:
+                if dup_key == DUP_EXCEPTION:
+                    raise DuplicateKeyException("Stanza [{0}] has duplicate key '{1}' in file "
+                                                "{2}".format(_format_stanza(section),
+                                                             a, stream_name))
+            else:
+                local_stanza.add(a)
+            set_item(s, a, b)
+            if positions is not None:
+                positions.add_key(stanza_number, a, lineno)
+        elif token == TOKEN_STANZA:
+            if comments:
+                s.comments.extend([(None, comment) for comment in comments])
+                del comments[:]
+            if merged_comments is not None:
+                _restore_comments(*merged_comments)
+                merged_comments = None
+            section = a if a is GLOBAL_STANZA else _intern(a)
+            if section in sections:
+                if dup_stanza == DUP_OVERWRITE:
+                    s = Stanza()
+                    set_item(sections, section, s)
+                elif dup_stanza == DUP_EXCEPTION:
+                    raise DuplicateStanzaException("Stanza [{0}] found more than once in config "
+                                                   "file {1}".format(_format_stanza(section),
+                                                                     stream_name))
+                elif dup_stanza == DUP_MERGE:
+                    s = sections[section]
+                    if s._comments:
+                        merged_comments = (s, s._comments)
+                        s._comments = None
+            else:
+                s = Stanza()
+                set_item(sections, section, s)
+            local_stanza = set()
+            if positions is not None:
+                stanza_number = positions.add_stanza(section, lineno,
+                                                     reset=dup_stanza == DUP_OVERWRITE)
+        elif token == TOKEN_COMMENT:
+            comments.append(a)
+        elif token == TOKEN_ERROR:
+            raise ConfParserException(a)
+    if comments:
+        s.comments.extend([(None, comment) for comment in comments])
+    if merged_comments is not None:
+        _restore_comments(*merged_comments)
+    # If the global entry is just a blank line, drop it
+    if GLOBAL_STANZA in sections:
+        g = sections[GLOBAL_STANZA]
+        if not g and not g.comments:
+            del sections[GLOBAL_STANZA]
+    _set_digests(sections)
+    return sections
+
+
+def _set_digests(conf):
+    """ Compute the content digests of a freshly parsed Conf, so that same_content() can match
+    identical stanzas and files right away (not only those loaded from the parse cache). """
+    for stanza in conf.values():
+        stanza._digest = _stanza_digest(stanza)
+    conf.digest()
+
+
+def _restore_comments(stanza, comments):
+    """ Done merging a duplicate stanza (DUP_MERGE) into `stanza`, which held `comments` before.
+    Just like when comments were stored as numbered keys, the later stanza's comments replace the
+    earlier ones position by position:  comment i replaces earlier comment i, and any earlier
+    comments beyond the last of the new ones are kept. """
+    stanza._comments = _replace_comments(comments, stanza._comments)
+
+
+def _replace_comments(earlier, later):
+    """ Comment list of a stanza merged under DUP_MERGE;  see _restore_comments() """
+    if not later:
+        return earlier
+    return later + earlier[len(later):]
+
+
+def _parse_conf_stream_legacy(stream, stream_name, keys_lower, handle_conts, keep_comments,
+                              dup_stanza, dup_key, strict):
+    """ Original generator-chain based parser.  Kept for comparison with the fused tokenizer. """
+    sections = Conf()
+    # Nothing has a digest yet, so skip the change tracking of Stanza.__setitem__()
+    set_item = dict.__setitem__
     # Q: What's the value of allowing line continuations to be disabled?
     if handle_conts:
         reader = section_reader(cont_handler(stream))
@@ -180,9 +1128,11 @@ def parse_conf_stream(stream, keys_lower=False, handle_conts=True, keep_comments
     for section, entry in reader:
         if section is None:
             section = GLOBAL_STANZA
+        else:
+            section = _intern(section)
         if section in sections:
             if dup_stanza == DUP_OVERWRITE:
-                s = sections[section] = {}
+                s = sections[section] = Stanza()
             elif dup_stanza == DUP_EXCEPTION:
                 raise DuplicateStanzaException("Stanza [{0}] found more than once in config "
                                                "file {1}".format(_format_stanza(section),
@@ -190,14 +1140,25 @@ def parse_conf_stream(stream, keys_lower=False, handle_conts=True, keep_comments
             elif dup_stanza == DUP_MERGE:
                 s = sections[section]
         else:
-            s = sections[section] = {}
+            s = sections[section] = Stanza()
+        # Only set for DUP_MERGE;  see _restore_comments()
+        merged_comments = s._comments
+        s._comments = None
         local_stanza = {}
+        comments = []
         for key, value in splitup_kvpairs(entry, keep_comments=keep_comments, strict=strict):
+            if key.startswith("#-"):
+                comments.append(value)
+                continue
             if keys_lower:
                 key = key.lower()
+            key = _intern(key)
+            if comments:
+                s.comments.extend([(key, comment) for comment in comments])
+                comments = []
             if key in local_stanza:
                 if dup_key in (DUP_OVERWRITE, DUP_MERGE):
-                    s[key] = value
+                    set_item(s, key, value)
                     local_stanza[key] = value
                 elif dup_key == DUP_EXCEPTION:
                     raise DuplicateKeyException("Stanza [{0}] has duplicate key '{1}' in file "
@@ -205,79 +1166,158 @@ def parse_conf_stream(stream, keys_lower=False, handle_conts=True, keep_comments
                                                              key, stream_name))
             else:
                 local_stanza[key] = value
-                s[key] = value
+                set_item(s, key, value)
+        if comments:
+            s.comments.extend([(None, comment) for comment in comments])
+        if merged_comments:
+            _restore_comments(s, merged_comments)
     # If the global entry is just a blank line, drop it
     if GLOBAL_STANZA in sections:
         g = sections[GLOBAL_STANZA]
-        if not g:
+        if not g and not g.comments:
             # if len(g) == 1 and not g[0]:
             del sections[GLOBAL_STANZA]
+    _set_digests(sections)
     return sections
 
 
-def write_conf(stream, conf, stanza_delim="\n", sort=True):
+def write_conf(stream, conf, stanza_delim="\n", sort=True, presorted=False):
     if not hasattr(stream, "write"):
         # Assume it's a filename
         with open(stream, "w", encoding=default_encoding) as stream:
-            write_conf_stream(stream, conf, stanza_delim, sort)
+            write_conf_stream(stream, conf, stanza_delim, sort, presorted)
     else:
-        write_conf_stream(stream, conf, stanza_delim, sort)
+        write_conf_stream(stream, conf, stanza_delim, sort, presorted)
 
 
-def write_conf_stream(stream, conf, stanza_delim="\n", sort=True):
-    conf = dict(conf)
+def _render_stanza(out, items, presorted=False):
+    """ Call `out()` with the rendered lines of one stanza body """
+    comments = items._comments if isinstance(items, Stanza) else None
+    for key in (items if presorted else sorted(items)):
+        value = items[key]
+        if comments and key > "#":
+            for (_, comment) in comments:
+                out(comment + "\n")
+            comments = None
+        if value is None:
+            value = ""
+        elif not isinstance(value, six.text_type):
+            value = str(value)
+        if value:
+            out("%s = %s\n" % (key, value.replace("\n", "\\\n")))
+        else:
+            # Avoid a trailing whitespace to keep the git gods happy
+            out("%s =\n" % key)
+    if comments:
+        for (_, comment) in comments:
+            out(comment + "\n")
 
-    if sort:
-        sorter = sorted
-    else:
-        sorter = list
 
-    def write_stanza_body(items):
-        for (key, value) in sorted(items.items()):
-            if value is None:
-                value = ""
-            else:
-                value = str(value)
-            if key.startswith("#"):
-                stream.write("{0}\n".format(value))
-            elif value:
-                stream.write("{0} = {1}\n".format(key, value.replace("\n", "\\\n")))
-            else:
-                # Avoid a trailing whitespace to keep the git gods happy
-                stream.write("{0} =\n".format(key))
+def write_conf_stream(stream, conf, stanza_delim="\n", sort=True, presorted=False):
+    """ Write `conf` to `stream`.  Stanzas and keys are written in sorted order.  Output is
+    rendered into a buffer and written out in chunks of roughly WRITE_BUFFER_SIZE lines.
 
-    keys = sorted(conf)
-    while keys:
-        section = keys.pop(0)
-        cfg = conf[section]
+    If `presorted` is True, `conf` and each of its stanzas must already iterate in sorted order
+    (for example, content that was built from sorted input), and sorting is skipped.  That's only
+    possible where dicts keep insertion order (Python 3.6+).  The global stanza is always written
+    first either way.
+    """
+    buf = []
+    out = buf.append
+    # The global stanza always goes first, no matter how the names sort
+    if presorted:
+        sections = [name for name in conf if name is not GLOBAL_STANZA]
+    else:
+        sections = sorted(name for name in conf if name is not GLOBAL_STANZA)
+    if GLOBAL_STANZA in conf:
+        sections.insert(0, GLOBAL_STANZA)
+    last = len(sections) - 1
+    for (i, section) in enumerate(sections):
         if section is not GLOBAL_STANZA:
-            stream.write("[{0}]\n".format(section))
-        write_stanza_body(cfg)
-        if keys:
-            stream.write(stanza_delim)
-
-
-def smart_write_conf(filename, conf, stanza_delim="\n", sort=True, temp_suffix=".tmp"):
-    if os.path.isfile(filename):
-        temp = StringIO()
-        write_conf_stream(temp, conf, stanza_delim, sort)
-        with open(filename, encoding=default_encoding) as dest:
-            file_diff = fileobj_compare(temp, dest)
-        if file_diff:
+            out("[%s]\n" % (section,))
+        _render_stanza(out, conf[section], presorted)
+        if i != last:
+            out(stanza_delim)
+        if len(buf) >= WRITE_BUFFER_SIZE:
+            stream.write("".join(buf))
+            del buf[:]
+    if buf:
+        stream.write("".join(buf))
+
+
+class _DigestBuffer(object):
+    """ Write-only text buffer that computes a digest of its content as it's written. """
+
+    def __init__(self, algorithm="sha256"):
+        self._chunks = []
+        self._hash = hashlib.new(algorithm)
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._hash.update(data.encode(default_encoding))
+
+    def getvalue(self):
+        return "".join(self._chunks)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+def _content_key(conf, stanza_delim, sort):
+    """ Digest of everything that determines the output of write_conf():  the content digest,
+    plus comments (which the content digest excludes) and formatting options. """
+    comments = [(name, stanza.comments) for (name, stanza) in six.iteritems(conf)
+                if getattr(stanza, "_comments", None)]
+    comments.sort(key=lambda item: item[0])
+    h = hashlib.sha256(conf_digest(conf))
+    comments = [(None if name is GLOBAL_STANZA else name, c) for (name, c) in comments]
+    h.update(_digest_encode([stanza_delim, sort, comments]).encode("utf-8"))
+    return h.hexdigest()
+
+
+def smart_write_conf(filename, conf, stanza_delim="\n", sort=True, temp_suffix=".tmp",
+                     presorted=False, manifest=None, original=None):
+    """ Write `conf` to `filename`, but only if the content has changed.  Returns SMART_CREATE,
+    SMART_UPDATE, or SMART_NOCHANGE.
+
+    If a WriteManifest (from ksconf.conf.manifest) is given, the digest of the rendered content
+    is compared to the digest recorded when the file was last written, which avoids reading the
+    existing file.  If the conf's content digest (and comments) are also unchanged, it isn't
+    even rendered.  When no trustworthy digest is available the file contents are compared.
+    If the caller has already read the existing file, pass its ConfBuffer as `original` so it
+    doesn't have to be read again.
+    """
+    content_key = None
+    if manifest is not None:
+        content_key = _content_key(conf, stanza_delim, sort)
+        if original is None and manifest.check_content(filename, content_key):
             return SMART_NOCHANGE
-        else:
-            tempfile = filename + temp_suffix
-            with open(tempfile, "w", encoding=default_encoding) as dest:
-                dest.write(temp.getvalue())
-            os.unlink(filename)
-            os.rename(tempfile, filename)
-            return SMART_UPDATE
+    temp = _DigestBuffer()
+    write_conf_stream(temp, conf, stanza_delim, sort, presorted)
+    digest = temp.hexdigest()
+    content = temp.getvalue()
+    if original is not None or os.path.isfile(filename):
+        unchanged = manifest.check(filename, digest) if manifest is not None else None
+        if unchanged is None:
+            if original is not None:
+                unchanged = original.matches(content)
+            else:
+                with open(filename, encoding=default_encoding) as dest:
+                    unchanged = fileobj_compare(StringIO(content), dest)
+        if unchanged:
+            if manifest is not None:
+                manifest.record(filename, digest, content_key)
+            return SMART_NOCHANGE
+        result = SMART_UPDATE
     else:
-        tempfile = filename + temp_suffix
-        with open(tempfile, "w", encoding=default_encoding) as dest:
-            write_conf_stream(dest, conf, stanza_delim, sort)
-        os.rename(tempfile, filename)
-        return SMART_CREATE
+        result = SMART_CREATE
+    tempfile = filename + temp_suffix
+    with open(tempfile, "w", encoding=default_encoding) as dest:
+        dest.write(content)
+    atomic_replace(tempfile, filename)
+    if manifest is not None:
+        manifest.record(filename, digest, content_key)
+    return result
 
 
 def _format_stanza(stanza):
@@ -288,41 +1328,17 @@ def _format_stanza(stanza):
         return stanza
 
 
-def _extract_comments(section):
-    "Return a sequental list of comments REMOVED from a section dictionary"
-    comments = []
-    for key, value in sorted(section.items()):
-        if key.startswith("#-"):
-            comments.append(value)
-            del section[key]
-    return comments
+def inject_section_comments(section, prepend=None, append=None):
+    """ Add comments to a Stanza, skipping any comment text that's already present.  Comments can
+    be given as plain strings or as (anchor, text) tuples. """
+    existing = set(text for (_, text) in section.comments)
 
+    def new_comments(comments):
+        for comment in comments or ():
+            if not isinstance(comment, tuple):
+                comment = (None, comment)
+            if comment[1] not in existing:
+                yield comment
 
-def inject_section_comments(section, prepend=None, append=None):
-    # Extract existing comments from section dict (in order; and remove them)
-    # Add in any prepend/append comments (if that comment isn't already present)
-    # Re-inject comments back into the section dict with fresh numbering
-    #
-    # Yes, this is really hacky, but the only way to make the diffs work correctly ;-(
-    comments = _extract_comments(section)
-    new_comments = []
-    if prepend:
-        for c in prepend:
-            if c not in comments:
-                new_comments.append(c)
-    new_comments.extend(comments)
-    if append:
-        for c in append:
-            if c not in comments:
-                new_comments.append(c)
-    for (i, comment) in enumerate(new_comments, 1):
-        section["#-%06d" % i] = comment
-
-
-def _drop_stanza_comments(stanza):
-    n = {}
-    for (key, value) in six.iteritems(stanza):
-        if key.startswith("#"):
-            continue
-        n[key] = value
-    return n
+    section.comments[:0] = new_comments(prepend)
+    section.comments.extend(new_comments(append))
@@ -20,6 +20,7 @@ EXIT_CODE_MISSING_ARG = 6
 EXIT_CODE_DIFF_EQUAL = 0
 EXIT_CODE_DIFF_CHANGE = 3
 EXIT_CODE_DIFF_NO_COMMON = 4
+EXIT_CODE_MERGE_CONFLICT = 7
 EXIT_CODE_SORT_APPLIED = 9
 
 # Errors caused by users
@@ -23,11 +23,14 @@ _entry_points = {
     ],
     # Custom end_point for ksconf subcommand registration
     "ksconf_cmd" : [
+        Ep("cache",     "ksconf.commands.cache",    "CacheCmd"),
         Ep("check",     "ksconf.commands.check",    "CheckCmd"),
         Ep("combine",   "ksconf.commands.combine",  "CombineCmd"),
         Ep("diff",      "ksconf.commands.diff",     "DiffCmd"),
+        Ep("hash",      "ksconf.commands.hash",     "HashCmd"),
         Ep("promote",   "ksconf.commands.promote",  "PromoteCmd"),
         Ep("merge",     "ksconf.commands.merge",    "MergeCmd"),
+        Ep("merge3",    "ksconf.commands.merge3",   "Merge3Cmd"),
         Ep("minimize",  "ksconf.commands.minimize", "MinimizeCmd"),
         Ep("sort",      "ksconf.commands.sort",     "SortCmd"),
         Ep("unarchive", "ksconf.commands.unarchive","UnarchiveCmd"),
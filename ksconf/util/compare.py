@@ -1,5 +1,14 @@
 from __future__ import unicode_literals
 
+import bisect
+import difflib
+import random
+import zlib
+from collections import defaultdict, Counter
+from itertools import chain
+
+import six
+
 def fileobj_compare(f1, f2):
     # Borrowed from filecmp
     f1.seek(0)
@@ -28,3 +37,279 @@ def _cmp_sets(a, b):
     common = sorted(set_a.intersection(set_b))
     b_only = sorted(set_b.difference(set_a))
     return (a_only, common, b_only)
+
+
+####################################################################################################
+## Line diff
+
+# Inputs with up to this many lines (in total) are compared with difflib.Differ, which gives the
+# nicest output, but gets very slow for long inputs.  Larger inputs use line_opcodes().
+DIFF_LINES_THRESHOLD = 100
+
+# Intra-line hints ('?' lines) are only computed for changed blocks of at most this many line
+# pairs, with lines of at most this many characters.
+INTRALINE_MAX_PAIRS = 64
+INTRALINE_MAX_LENGTH = 200
+
+# Upper bound on the work (roughly lines x edits) for the Myers diff of a region without unique
+# lines;  larger regions are reported as replaced as a whole.
+MYERS_MAX_COST = 4000000
+
+
+def _myers_matches(a, b, alo, ahi, blo, bhi, matches):
+    """ Myers' O((N+M)D) diff of a[alo:ahi] and b[blo:bhi].  Appends (i, j, size) matching blocks
+    to `matches`.  Returns False, without any changes, if the cost limit would be exceeded. """
+    n = ahi - alo
+    m = bhi - blo
+    max_d = min(n + m, MYERS_MAX_COST // (n + m))
+    offset = max_d + 1
+    v = [0] * (2 * max_d + 3)
+    trace = []
+    for d in range(max_d + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                break
+        else:
+            trace.append(v[offset - d:offset + d + 1])
+            continue
+        break
+    else:
+        return False
+    # Walk back through the saved states to find the snakes (runs of matching lines)
+    (x, y) = (n, m)
+    for d in range(len(trace), 0, -1):
+        prev = trace[d - 1]
+        k = x - y
+        if k == -d or (k != d and prev[k - 1 + d - 1] < prev[k + 1 + d - 1]):
+            prev_k = k + 1
+            prev_x = prev[prev_k + d - 1]
+            (mid_x, mid_y) = (prev_x, prev_x - prev_k + 1)
+        else:
+            prev_k = k - 1
+            prev_x = prev[prev_k + d - 1]
+            (mid_x, mid_y) = (prev_x + 1, prev_x - prev_k)
+        if x > mid_x:
+            matches.append((alo + mid_x, blo + mid_y, x - mid_x))
+        (x, y) = (prev_x, prev_x - prev_k)
+    if x > 0:
+        matches.append((alo, blo, x))
+    return True
+
+
+def _unique_anchors(a, b, alo, ahi, blo, bhi):
+    """ Longest sequence of lines found exactly once in both a[alo:ahi] and b[blo:bhi], in the
+    same order on both sides (the 'patience' in patience diff).  Returns [(i, j), ...] """
+    counts = {}
+    for i in range(alo, ahi):
+        line = a[i]
+        if line in counts:
+            counts[line] = None
+        else:
+            counts[line] = [i, None]
+    for j in range(blo, bhi):
+        entry = counts.get(b[j])
+        if entry is not None:
+            if entry[1] is None:
+                entry[1] = j
+            else:
+                counts[b[j]] = None
+    pairs = sorted(tuple(entry) for entry in six.itervalues(counts)
+                   if entry is not None and entry[1] is not None)
+    # Longest increasing subsequence (by position in b), using patience sorting
+    tops = []
+    links = []
+    for (n, (i, j)) in enumerate(pairs):
+        pile = bisect.bisect_left(tops, j)
+        if pile == len(tops):
+            tops.append(j)
+        else:
+            tops[pile] = j
+        links.append((pile, n))
+    anchors = []
+    want = len(tops) - 1
+    for (pile, n) in reversed(links):
+        if pile == want:
+            anchors.append(pairs[n])
+            want -= 1
+    anchors.reverse()
+    return anchors
+
+
+def _matching_blocks(a, b):
+    """ Patience diff, with Myers' algorithm for regions without any unique lines.  Returns a
+    sorted list of (i, j, size) blocks like difflib.SequenceMatcher.get_matching_blocks(), except
+    for the final dummy entry. """
+    matches = []
+    regions = [(0, len(a), 0, len(b))]
+    while regions:
+        (alo, ahi, blo, bhi) = regions.pop()
+        # Common prefix and suffix
+        start = alo
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            alo += 1
+            blo += 1
+        if alo > start:
+            matches.append((start, blo - (alo - start), alo - start))
+        end = ahi
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+        if end > ahi:
+            matches.append((ahi, bhi, end - ahi))
+        if alo == ahi or blo == bhi:
+            continue
+        anchors = _unique_anchors(a, b, alo, ahi, blo, bhi)
+        if anchors:
+            for (i, j) in anchors:
+                regions.append((alo, i, blo, j))
+                matches.append((i, j, 1))
+                (alo, blo) = (i + 1, j + 1)
+            regions.append((alo, ahi, blo, bhi))
+        else:
+            _myers_matches(a, b, alo, ahi, blo, bhi, matches)
+    matches.sort()
+    # Join adjacent blocks
+    blocks = []
+    for (i, j, size) in matches:
+        if blocks:
+            (i0, j0, size0) = blocks[-1]
+            if i0 + size0 == i and j0 + size0 == j:
+                blocks[-1] = (i0, j0, size0 + size)
+                continue
+        blocks.append((i, j, size))
+    return blocks
+
+
+def line_opcodes(a, b):
+    """ Compare two lists of lines (or any hashable items).  Returns a list of 5-tuples
+    (tag, i1, i2, j1, j2) in the same format as difflib.SequenceMatcher.get_opcodes().
+
+    Unlike SequenceMatcher, this takes about linear time for typical inputs (such as two versions
+    of a long search), since it uses patience diff, falling back to Myers' algorithm. """
+    opcodes = []
+    i = j = 0
+    for (ai, bj, size) in _matching_blocks(a, b) + [(len(a), len(b), 0)]:
+        if i < ai and j < bj:
+            opcodes.append(("replace", i, ai, j, bj))
+        elif i < ai:
+            opcodes.append(("delete", i, ai, j, bj))
+        elif j < bj:
+            opcodes.append(("insert", i, ai, j, bj))
+        if size:
+            opcodes.append(("equal", ai, ai + size, bj, bj + size))
+        (i, j) = (ai + size, bj + size)
+    return opcodes
+
+
+def _longest(lines):
+    return max(len(line) for line in lines) if lines else 0
+
+
+def _intraline_ok(a, b):
+    return len(a) * len(b) <= INTRALINE_MAX_PAIRS and \
+        max(_longest(a), _longest(b)) <= INTRALINE_MAX_LENGTH
+
+
+def diff_lines(a, b, threshold=None):
+    """ Generator comparing two lists of lines, with output in the same format as
+    difflib.Differ.compare().  Inputs of up to `threshold` lines in total (default
+    DIFF_LINES_THRESHOLD) with short lines are compared with Differ itself.  Larger inputs use
+    line_opcodes(), and intra-line hints are only given for small blocks of changed lines. """
+    if threshold is None:
+        threshold = DIFF_LINES_THRESHOLD
+    if len(a) + len(b) <= threshold and max(_longest(a), _longest(b)) <= INTRALINE_MAX_LENGTH:
+        for line in difflib.Differ().compare(a, b):
+            yield line
+        return
+    for (tag, i1, i2, j1, j2) in line_opcodes(a, b):
+        if tag == "equal":
+            for line in a[i1:i2]:
+                yield "  " + line
+        elif tag == "replace" and _intraline_ok(a[i1:i2], b[j1:j2]):
+            for line in difflib.Differ().compare(a[i1:i2], b[j1:j2]):
+                yield line
+        else:
+            for line in a[i1:i2]:
+                yield "- " + line
+            for line in b[j1:j2]:
+                yield "+ " + line
+
+
+####################################################################################################
+## Similar sets (MinHash / LSH)
+
+_MERSENNE_PRIME = (1 << 61) - 1
+
+
+def _minhash_params(num_perm, seed=1):
+    rnd = random.Random(seed)
+    return [(rnd.randint(1, _MERSENNE_PRIME - 1), rnd.randint(0, _MERSENNE_PRIME - 1))
+            for _ in range(num_perm)]
+
+
+def jaccard(a, b):
+    """ Jaccard similarity of two sets (0.0 to 1.0) """
+    if not a and not b:
+        return 1.0
+    common = len(a & b)
+    return common / float(len(a) + len(b) - common)
+
+
+def similar_pairs(sets_a, sets_b, threshold=0.7, num_perm=64, bands=32, max_bucket=1000):
+    """ Find pairs of similar sets of strings, one from each of the dicts `sets_a` and `sets_b`
+    (mapping any name to a set).  Returns a list of (similarity, name_a, name_b) for each pair
+    with a Jaccard similarity of at least `threshold`, best matches first.
+
+    Rather than comparing every pair, a MinHash signature of `num_perm` values is computed for
+    each set, and only pairs that have all values in common in at least one of `bands` bands
+    (locality-sensitive hashing) are compared.  Strings found in so many sets that they would
+    put more than `max_bucket` pairs in the same band are left out of the signatures, as they
+    can't tell the sets apart anyway, and would make the run time quadratic. """
+    params = _minhash_params(num_perm)
+    rows = num_perm // bands
+    counts_a = Counter(chain.from_iterable(six.itervalues(sets_a)))
+    counts_b = Counter(chain.from_iterable(six.itervalues(sets_b)))
+    common = set(token for (token, count) in six.iteritems(counts_a)
+                 if count * counts_b.get(token, 0) > max_bucket)
+    token_hashes = {}
+
+    def signature(tokens):
+        hashes = []
+        for token in tokens:
+            h = token_hashes.get(token)
+            if h is None:
+                x = zlib.crc32(token.encode("utf-8")) & 0xffffffff
+                h = token_hashes[token] = [(a * x + b) % _MERSENNE_PRIME for (a, b) in params]
+            hashes.append(h)
+        return [min(values) for values in zip(*hashes)]
+
+    (buckets_a, buckets_b) = buckets = (defaultdict(list), defaultdict(list))
+    for (side, sets) in enumerate((sets_a, sets_b)):
+        for (name, tokens) in six.iteritems(sets):
+            tokens = tokens.difference(common)
+            if not tokens:
+                continue
+            sig = signature(tokens)
+            for band in range(bands):
+                buckets[side][band, tuple(sig[band * rows:(band + 1) * rows])].append(name)
+    candidates = set()
+    for (bucket, names_a) in six.iteritems(buckets_a):
+        names_b = buckets_b.get(bucket)
+        if names_b and len(names_a) * len(names_b) <= max_bucket:
+            candidates.update((name_a, name_b) for name_a in names_a for name_b in names_b)
+    pairs = []
+    for (name_a, name_b) in candidates:
+        similarity = jaccard(sets_a[name_a], sets_b[name_b])
+        if similarity >= threshold:
+            pairs.append((similarity, name_a, name_b))
+    pairs.sort(key=lambda pair: (-pair[0], pair[1], pair[2]))
+    return pairs
@@ -46,6 +46,16 @@ def smart_copy(src, dest):
     return ret
 
 
+def atomic_replace(src, dest):
+    """ Rename `src` to `dest`, replacing `dest` if it exists.  This is atomic on Python 3. """
+    if hasattr(os, "replace"):
+        os.replace(src, dest)
+    else:  # pragma: no cover  (Python 2)
+        if os.name == "nt" and os.path.exists(dest):
+            os.unlink(dest)
+        os.rename(src, dest)
+
+
 def _stdin_iter(stream=None):
     if stream is None:
         stream = sys.stdin
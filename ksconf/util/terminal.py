@@ -9,6 +9,51 @@ ANSI_RESET = 0
 FORCE_TTY_COLOR = False
 
 
+def _ansi_code(codes):
+    return "\x1b[{}m".format(";".join([str(i) for i in codes]))
+
+
 def tty_color(stream, *codes):
     if codes and FORCE_TTY_COLOR or hasattr(stream, "isatty") and stream.isatty():
-        stream.write("\x1b[{}m".format(";".join([str(i) for i in codes])))
+        stream.write(_ansi_code(codes))
+
+
+class TermWriter(object):
+    """ Buffered output with the same color handling as tty_color(), for writing large amounts of
+    (possibly colored) text.  Whether color is used is decided once, when created.  Output is
+    collected in memory and written to `stream` in chunks of about `buffer_size` characters;
+    call flush() once done.  The written text is exactly the same as with direct writes. """
+
+    def __init__(self, stream, buffer_size=64 * 1024):
+        self.stream = stream
+        self._isatty = hasattr(stream, "isatty") and stream.isatty()
+        self.color_enabled = FORCE_TTY_COLOR or self._isatty
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._size = 0
+        self._codes = {}
+
+    def write(self, text):
+        self._buffer.append(text)
+        self._size += len(text)
+        if self._size >= self.buffer_size:
+            self._write_buffer()
+
+    def color(self, *codes):
+        """ Same as tty_color(stream, *codes) """
+        if codes and self.color_enabled or self._isatty:
+            try:
+                text = self._codes[codes]
+            except KeyError:
+                text = self._codes[codes] = _ansi_code(codes)
+            self.write(text)
+
+    def _write_buffer(self):
+        if self._buffer:
+            self.stream.write("".join(self._buffer))
+            self._buffer = []
+            self._size = 0
+
+    def flush(self):
+        self._write_buffer()
+        self.stream.flush()
@@ -0,0 +1,489 @@
+#!/usr/bin/env python
+""" Simple micro-benchmarks for the ksconf internals.  Not part of the unittest suite.
+
+Usage:
+
+    python run_benchmarks.py                # Run all benchmarks
+    python run_benchmarks.py parser         # Run a specific benchmark
+
+Synthetic conf content is generated in memory (loosely modeled on a large merged
+savedsearches.conf file) so that results are comparable between runs and machines.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import difflib
+import gc
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+from io import StringIO, open
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+from ksconf.conf.cache import ParseCache
+from ksconf.conf.delta import compare_cfgs, compare_cfgs_many, iter_compare_cfgs, show_diff, \
+    find_stanza_renames, _stanza_tokens, summarize_cfg_diffs, iter_diff_stats, show_diff_stat, \
+    DIFF_OP_EQUAL
+from ksconf.conf.lazy import parse_conf_lazy
+from ksconf.conf.merge import merge3, merge_conf_dicts, LayeredConf
+from ksconf.conf.parser import parse_conf, parse_conf_many, parse_conf_stream, write_conf, \
+    check_conf, Conf, Stanza, GLOBAL_STANZA, PARSECONF_MID, PARSER_BACKEND_FUSED, \
+    PARSER_BACKEND_LEGACY
+from ksconf.util.compare import diff_lines, jaccard
+from ksconf.util.terminal import TermWriter
+
+
+_stanza_template = """\
+# Saved search number {0}
+[Generated search {0:06d}]
+action.email.useNSSubject = 1
+alert.track = {1}
+cron_schedule = {2} * * * *
+description = Generated search used for benchmarking ksconf
+disabled = {1}
+dispatch.earliest_time = -{2}m@m
+dispatch.latest_time = now
+enableSched = 1
+request.ui_dispatch_app = search
+search = index=main sourcetype=bench_{0} \\
+| stats count by host, source \\
+| where count > {2} \\
+| eval msg="[".host."] ".source
+
+"""
+
+
+def make_conf_text(stanzas=5000):
+    return "".join(_stanza_template.format(i, i % 2, i % 60) for i in range(stanzas))
+
+
+def _time(func, repeat=3, number=1):
+    return min(timeit.repeat(func, repeat=repeat, number=number))
+
+
+class TempConfFile(object):
+    """ Context manager that writes generated conf text to a temporary file. """
+
+    def __init__(self, text, encoding="utf-8"):
+        self.text = text
+        self.encoding = encoding
+
+    def __enter__(self):
+        self._dir = tempfile.mkdtemp("-ksconfbench")
+        self.path = os.path.join(self._dir, "bench.conf")
+        with open(self.path, "w", encoding=self.encoding) as stream:
+            stream.write(self.text)
+        return self.path
+
+    def __exit__(self, *exc_info):
+        shutil.rmtree(self._dir)
+
+
+def report(name, seconds, baseline=None):
+    if baseline:
+        print("  {0:40} {1:8.3f}s   ({2:.2f}x)".format(name, seconds, baseline / seconds))
+    else:
+        print("  {0:40} {1:8.3f}s".format(name, seconds))
+
+
+def bench_parser(stanzas=5000):
+    """ Compare the fused tokenizer against the legacy generator chain """
+    text = make_conf_text(stanzas)
+    print("Parsing {0} stanzas ({1:.1f} MB)".format(stanzas, len(text) / 1048576.0))
+    for keep_comments in (False, True):
+        profile = dict(PARSECONF_MID, keep_comments=keep_comments)
+        print(" keep_comments={0}".format(keep_comments))
+        legacy = _time(lambda: parse_conf_stream(StringIO(text), backend=PARSER_BACKEND_LEGACY,
+                                                 **profile))
+        fused = _time(lambda: parse_conf_stream(StringIO(text), backend=PARSER_BACKEND_FUSED,
+                                                **profile))
+        report("legacy (cont/section/splitup chain)", legacy)
+        report("fused tokenizer", fused, legacy)
+
+
+def bench_mmap(stanzas=20000):
+    """ Compare text-mode parsing of a file against the memory-mapped bytes parser """
+    text = make_conf_text(stanzas)
+    with TempConfFile(text) as path:
+        print("Parsing {0} stanzas ({1:.1f} MB) from disk".format(
+            stanzas, os.path.getsize(path) / 1048576.0))
+        text_mode = _time(lambda: parse_conf(path, PARSECONF_MID, use_mmap=False))
+        mmapped = _time(lambda: parse_conf(path, PARSECONF_MID, use_mmap=True))
+        report("text mode", text_mode)
+        report("mmap bytes (ascii)", mmapped, text_mode)
+    with TempConfFile(text.replace("Generated", "G\u00e9n\u00e9r\u00e9")) as path:
+        text_mode = _time(lambda: parse_conf(path, PARSECONF_MID, use_mmap=False))
+        mmapped = _time(lambda: parse_conf(path, PARSECONF_MID, use_mmap=True))
+        report("text mode (non-ascii)", text_mode)
+        report("mmap bytes (non-ascii)", mmapped, text_mode)
+
+
+def bench_lazy(stanzas=20000):
+    """ Compare a full parse against a lazy parse that only reads a handful of stanzas """
+    text = make_conf_text(stanzas)
+    wanted = ["Generated search {0:06d}".format(i) for i in range(0, stanzas, stanzas // 5)]
+
+    def lazy_lookup(path):
+        conf = parse_conf_lazy(path, PARSECONF_MID)
+        return [conf[stanza] for stanza in wanted]
+
+    def lazy_all(path):
+        return dict(parse_conf_lazy(path, PARSECONF_MID).items())
+
+    with TempConfFile(text) as path:
+        print("Parsing {0} stanzas, accessing {1}".format(stanzas, len(wanted)))
+        full = _time(lambda: parse_conf(path, PARSECONF_MID))
+        report("full parse", full)
+        report("lazy (index + lookups)", _time(lambda: lazy_lookup(path)), full)
+        report("lazy (every stanza)", _time(lambda: lazy_all(path)), full)
+
+
+def bench_cache(stanzas=5000):
+    """ Compare parsing a file against loading it from the parse cache """
+    text = make_conf_text(stanzas)
+    with TempConfFile(text) as path:
+        parse_cache = ParseCache(os.path.join(os.path.dirname(path), "cache"))
+
+        def cached():
+            return parse_cache.load(path, PARSECONF_MID, lambda: parse_conf(path, PARSECONF_MID))
+
+        cached()
+        print("Loading {0} stanzas".format(stanzas))
+        parsed = _time(lambda: parse_conf(path, PARSECONF_MID))
+        report("parse_conf", parsed)
+        report("parse cache hit", _time(cached), parsed)
+
+        # Change one stanza; only that stanza needs to be parsed again
+        parse_cache.index_min_size = 0
+        cached()
+
+        def edit_and_load():
+            with open(path, "w", encoding="utf-8") as stream:
+                stream.write(text.replace("alert.track", "edited = {0}\nalert.track".format(
+                    time.time()), 1))
+            return cached()
+
+        report("parse cache, 1 stanza changed", _time(edit_and_load), parsed)
+
+
+def _write_conf_orig(stream, conf, stanza_delim="\n"):
+    """ write_conf_stream() from ksconf 0.5.2 (one write() per line, quadratic stanza loop) """
+    def write_stanza_body(items):
+        for (key, value) in sorted(items.items()):
+            value = "" if value is None else str(value)
+            if value:
+                stream.write("{0} = {1}\n".format(key, value.replace("\n", "\\\n")))
+            else:
+                stream.write("{0} =\n".format(key))
+
+    keys = sorted(conf)
+    while keys:
+        section = keys.pop(0)
+        if section is not GLOBAL_STANZA:
+            stream.write("[{0}]\n".format(section))
+        write_stanza_body(conf[section])
+        if keys:
+            stream.write(stanza_delim)
+
+
+def bench_writer(stanzas=50000):
+    """ Compare the original line-at-a-time writer against the buffered writer """
+    conf = parse_conf_stream(StringIO(make_conf_text(stanzas)), **PARSECONF_MID)
+    ordered = Conf((stanza, Stanza((key, conf[stanza][key]) for key in sorted(conf[stanza])))
+                   for stanza in sorted(conf))
+    with TempConfFile("") as path:
+        def write(func, conf, **kwargs):
+            with open(path, "w", encoding="utf-8") as stream:
+                func(stream, conf, **kwargs)
+
+        print("Writing {0} stanzas".format(stanzas))
+        orig = _time(lambda: write(_write_conf_orig, ordered))
+        report("original writer", orig)
+        report("buffered writer", _time(lambda: write(write_conf, ordered)), orig)
+        report("buffered writer (presorted)",
+               _time(lambda: write(write_conf, ordered, presorted=True)), orig)
+
+
+def bench_many(files=64, stanzas=2000):
+    """ Compare parsing many files one at a time against parse_conf_many() with a process pool """
+    temp_dir = tempfile.mkdtemp("-ksconfbench")
+    try:
+        text = make_conf_text(stanzas)
+        paths = []
+        for i in range(files):
+            paths.append(os.path.join(temp_dir, "{0}.conf".format(i)))
+            with open(paths[-1], "w", encoding="utf-8") as stream:
+                stream.write(text)
+        print("Parsing {0} files with {1} stanzas each".format(files, stanzas))
+        serial = _time(lambda: [parse_conf(path, PARSECONF_MID) for path in paths], repeat=1)
+        report("parse_conf (one at a time)", serial)
+        for jobs in (2, 4, multiprocessing.cpu_count()):
+            report("parse_conf_many (jobs={0})".format(jobs),
+                   _time(lambda: list(parse_conf_many(paths, PARSECONF_MID, jobs=jobs)),
+                         repeat=1), serial)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def bench_events(stanzas=20000):
+    """ Compare parse_conf() against the streaming check_conf() in time and peak memory """
+    text = make_conf_text(stanzas)
+    with TempConfFile(text) as path:
+        print("Checking {0} stanzas ({1:.1f} MB)".format(stanzas,
+                                                         os.path.getsize(path) / 1048576.0))
+        parsed = _time(lambda: parse_conf(path, PARSECONF_MID, use_mmap=False))
+        report("parse_conf", parsed)
+        report("check_conf (events)", _time(lambda: check_conf(path, PARSECONF_MID)), parsed)
+        if tracemalloc is None:
+            return
+        for (name, func) in (("parse_conf", parse_conf), ("check_conf", check_conf)):
+            tracemalloc.start()
+            try:
+                func(path, PARSECONF_MID)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            print("  {0:40} {1:8.1f} MB peak".format(name, peak / 1048576.0))
+
+
+def bench_compare(stanzas=20000):
+    """ Compare building the full compare_cfgs() list against streaming only the changes """
+    text = make_conf_text(stanzas)
+    a = parse_conf_stream(StringIO(text), **PARSECONF_MID)
+    b = parse_conf_stream(StringIO(text.replace("alert.track = 1", "alert.track = 0")),
+                          **PARSECONF_MID)
+    print("Comparing {0} stanzas ({1} changed)".format(stanzas, stanzas // 2))
+    full = _time(lambda: [op for op in compare_cfgs(a, b) if op.tag != DIFF_OP_EQUAL])
+    report("compare_cfgs (filtered)", full)
+    report("iter_compare_cfgs(skip_equal=True)",
+           _time(lambda: list(iter_compare_cfgs(a, b, skip_equal=True))), full)
+    others = [b] * 10
+    print("Comparing a baseline to {0} files".format(len(others)))
+    separate = _time(lambda: [[op for op in compare_cfgs(a, other) if op.tag != DIFF_OP_EQUAL]
+                              for other in others])
+    report("compare_cfgs for each file", separate)
+    report("compare_cfgs_many", _time(lambda: list(compare_cfgs_many(a, others))), separate)
+
+
+def bench_merge3(stanzas=20000):
+    """ Compare merge3() against the three pairwise comparisons it replaces """
+    text = make_conf_text(stanzas)
+    base = parse_conf_stream(StringIO(text), **PARSECONF_MID)
+    ours = parse_conf_stream(StringIO(text.replace("alert.track = 1", "alert.track = 0")),
+                             **PARSECONF_MID)
+    theirs = parse_conf_stream(StringIO(text.replace("enableSched = 1", "enableSched = 0")),
+                               **PARSECONF_MID)
+    print("Three-way merge of {0} stanzas".format(stanzas))
+    pairwise = _time(lambda: [compare_cfgs(x, y) for (x, y) in
+                              ((base, ours), (base, theirs), (ours, theirs))])
+    report("compare_cfgs x3 (no merging)", pairwise)
+    report("merge3", _time(lambda: merge3(base, ours, theirs)), pairwise)
+
+
+def _copy_str(value):
+    # Build a new (non-interned) string with the same value
+    return (value + " ")[:-1]
+
+
+def _as_plain_dicts(conf):
+    """ Rebuild a parsed conf the way older releases returned it:  plain dicts, with a separate
+    string object for every stanza name and key, and comments stored as '#-NNNNNN' keys. """
+    plain = {}
+    for (stanza, content) in conf.items():
+        d = dict((_copy_str(key), value) for (key, value) in content.items())
+        for (i, (_, comment)) in enumerate(content.comments):
+            d["#-{0:06d}".format(i)] = comment
+        plain[stanza if stanza is GLOBAL_STANZA else _copy_str(stanza)] = d
+    return plain
+
+
+def _traced_size(build):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = build()
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del result
+    return size
+
+
+def bench_memory(files=2000, stanzas=10):
+    """ Memory used by many small parsed files, like a large etc/users tree """
+    if tracemalloc is None:
+        print("  Skipped:  tracemalloc requires Python 3")
+        return
+    text = make_conf_text(stanzas)
+    total = files * stanzas
+
+    def parse_all(**profile):
+        profile = dict(PARSECONF_MID, **profile)
+        return [parse_conf_stream(StringIO(text), **profile) for _ in range(files)]
+
+    def parse_all_plain():
+        return [_as_plain_dicts(conf) for conf in parse_all()]
+
+    print("Parsing {0} files with {1} stanzas each".format(files, stanzas))
+    plain = _traced_size(parse_all_plain)
+    compact = _traced_size(parse_all)
+    print("  {0:40} {1:8.0f} bytes/stanza".format("plain dicts", plain / float(total)))
+    print("  {0:40} {1:8.0f} bytes/stanza   ({2:.2f}x)".format(
+        "Stanza/Conf with interned keys", compact / float(total), plain / float(compact)))
+    positions = _traced_size(lambda: parse_all(keep_positions=True))
+    print("  {0:40} {1:8.0f} bytes/stanza   ({2:.2f}x)".format(
+        "... with source positions", positions / float(total), plain / float(positions)))
+
+
+def bench_render(stanzas=20000):
+    """ Compare writing each piece of a large (colored) diff directly to a line-buffered stream
+    against collecting it with TermWriter, as show_diff() does """
+    text = make_conf_text(stanzas)
+    a = parse_conf_stream(StringIO(text), **PARSECONF_MID)
+    b = parse_conf_stream(StringIO(text.replace("alert.track = 1", "alert.track = 0")),
+                          **PARSECONF_MID)
+    diffs = compare_cfgs(a, b)
+
+    class TtyStream(StringIO):
+        def isatty(self):
+            return True
+
+    rendered = TtyStream()
+    show_diff(rendered, diffs)
+    # Split into the separate writes made before output was buffered:  each color code and line
+    chunks = re.findall(r"\x1b\[[0-9;]*m|[^\x1b\n]*\n|[^\x1b\n]+", rendered.getvalue())
+    print("Rendering a diff of {0} stanzas ({1} writes)".format(stanzas, len(chunks)))
+    with TempConfFile("") as path:
+        with open(path, "w", encoding="utf-8", buffering=1) as stream:
+            def direct():
+                stream.seek(0)
+                for chunk in chunks:
+                    stream.write(chunk)
+                stream.flush()
+
+            def buffered():
+                stream.seek(0)
+                out = TermWriter(stream)
+                for chunk in chunks:
+                    out.write(chunk)
+                out.flush()
+
+            unbuffered = _time(direct)
+            report("direct writes (line buffered)", unbuffered)
+            report("TermWriter", _time(buffered), unbuffered)
+
+
+def bench_linediff(lines=2000):
+    """ Compare difflib.Differ against diff_lines() for a long (generated) search """
+    a = ["| eval field{0} = if(isnull(src{0}), \"none\", lower(src{0}))".format(i)
+         for i in range(lines)]
+    b = list(a)
+    # Rewrite a block of lines:  Differ compares every pair of lines in the block
+    changed = lines // 20
+    for i in range(lines // 2, lines // 2 + changed):
+        b[i] = b[i].replace("lower", "upper")
+    print("Comparing a {0} line search ({1} lines changed)".format(lines, changed))
+    differ = _time(lambda: list(difflib.Differ().compare(a, b)), repeat=1)
+    report("difflib.Differ", differ)
+    report("diff_lines", _time(lambda: list(diff_lines(a, b))), differ)
+
+
+def bench_renames(stanzas=20000, renamed=2000):
+    """ Compare rename detection (MinHash/LSH) against comparing every deleted stanza to every
+    inserted one """
+    text = make_conf_text(stanzas)
+    a = parse_conf_stream(StringIO(text), **PARSECONF_MID)
+    b = parse_conf_stream(StringIO(text), **PARSECONF_MID)
+    for i in range(0, stanzas, stanzas // renamed):
+        stanza = b.pop("Generated search {0:06d}".format(i))
+        stanza["dispatch.earliest_time"] = "-1d"
+        b["Renamed search {0:06d}".format(i)] = stanza
+    print("Finding {0} renamed stanzas in {1}".format(renamed, stanzas))
+    deleted = [_stanza_tokens(a[s]) for s in set(a).difference(b)]
+    inserted = [_stanza_tokens(b[s]) for s in set(b).difference(a)]
+    pairwise = _time(lambda: [jaccard(x, y) for x in deleted for y in inserted], repeat=1)
+    report("pairwise similarity", pairwise)
+    report("find_stanza_renames", _time(lambda: find_stanza_renames(a, b), repeat=1), pairwise)
+    report("iter_compare_cfgs(renames=True)",
+           _time(lambda: list(iter_compare_cfgs(a, b, renames=True)), repeat=1), pairwise)
+
+
+def bench_stat(stanzas=20000):
+    """ Compare summarizing a diff from the full list of ops against only counting the changes """
+    text = make_conf_text(stanzas)
+    a = parse_conf_stream(StringIO(text), **PARSECONF_MID)
+    b = parse_conf_stream(StringIO(text.replace("alert.track = 1", "alert.track = 0")),
+                          **PARSECONF_MID)
+    print("Summarizing the differences of {0} stanzas ({1} changed)".format(stanzas, stanzas // 2))
+    full = _time(lambda: summarize_cfg_diffs(compare_cfgs(a, b), StringIO()))
+    report("summarize_cfg_diffs(compare_cfgs())", full)
+    report("show_diff_stat(iter_diff_stats())",
+           _time(lambda: show_diff_stat(StringIO(), iter_diff_stats(a, b))), full)
+    a.digest()
+    b.digest()
+    report("show_diff_stat (digests known)",
+           _time(lambda: show_diff_stat(StringIO(), iter_diff_stats(a, b))), full)
+
+
+def bench_layered(stanzas=20000, layers=8):
+    """ Compare merging (and writing out) several layers with merge_conf_dicts(), which copies
+    every layer, against the copy-on-write LayeredConf """
+    text = make_conf_text(stanzas)
+    confs = [parse_conf_stream(StringIO(text), **PARSECONF_MID)]
+    # Each additional layer overrides one key in a slice of the stanzas
+    for i in range(1, layers):
+        conf = Conf()
+        for n in range(i, stanzas, layers * 4):
+            conf["Generated search {0:06d}".format(n)] = Stanza(disabled="1")
+        confs.append(conf)
+    print("Merging {0} layers ({1} stanzas)".format(layers, stanzas))
+
+    def merge_and_write(merge):
+        write_conf(StringIO(), merge(*confs))
+
+    copied = _time(lambda: merge_conf_dicts(*confs))
+    report("merge_conf_dicts", copied)
+    report("LayeredConf", _time(lambda: LayeredConf(*confs)), copied)
+    copied = _time(lambda: merge_and_write(merge_conf_dicts))
+    report("merge_conf_dicts + write_conf", copied)
+    report("LayeredConf + write_conf", _time(lambda: merge_and_write(LayeredConf)), copied)
+
+
+BENCHMARKS = {
+    "parser": bench_parser,
+    "renames": bench_renames,
+    "stat": bench_stat,
+    "render": bench_render,
+    "mmap": bench_mmap,
+    "lazy": bench_lazy,
+    "layered": bench_layered,
+    "linediff": bench_linediff,
+    "cache": bench_cache,
+    "compare": bench_compare,
+    "events": bench_events,
+    "many": bench_many,
+    "memory": bench_memory,
+    "merge3": bench_merge3,
+    "writer": bench_writer,
+}
+
+
+def run(names=None):
+    for name in names or sorted(BENCHMARKS):
+        print("=== {0} ===".format(name))
+        BENCHMARKS[name]()
+        print("")
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:])
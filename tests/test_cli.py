@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 from __future__ import absolute_import, print_function, unicode_literals
+import json
 import os
 import shutil
 import stat
@@ -20,7 +21,7 @@ from ksconf.util.file import file_hash
 from ksconf.vc.git import git_cmd
 
 from ksconf.conf.parser import parse_conf, write_conf, \
-    GLOBAL_STANZA, PARSECONF_MID
+    GLOBAL_STANZA, PARSECONF_MID, ConfParserException
 
 
 def _debug_file(flag, fn):       # pragma: no cover
@@ -302,6 +303,50 @@ class CliKsconfCombineTestCase(unittest.TestCase):
         with ksconf_cli:
             ko = ksconf_cli("combine", "--target", default, default + ".d/*")
 
+    def test_combine_manifest(self):
+        twd = TestWorkDir()
+        twd.write_file("default.d/10-upstream/props.conf", """
+        [aws:config]
+        TRUNCATE = 8388608
+        """)
+        twd.write_file("default.d/20-corp/props.conf", """
+        [aws:config]
+        TZ = UTC
+        """)
+        default = twd.get_path("default")
+        with ksconf_cli:
+            ko = ksconf_cli("combine", "--jobs", "2", "--target", default, default + ".d/*")
+            self.assertIn("Merge <created>", ko.stderr)
+        self.assertIn("props.conf", twd.read_file("default/.ksconf_manifest.json"))
+        with ksconf_cli:
+            ko = ksconf_cli("combine", "--target", default, default + ".d/*")
+            self.assertNotIn("Merge <", ko.stderr)
+            self.assertNotIn("Remove unwanted file", ko.stderr)
+        # A hand-edited target no longer matches the recorded digest, and must be rewritten
+        twd.write_file("default/props.conf", "[aws:config]\nTZ = GMT\n")
+        with ksconf_cli:
+            ko = ksconf_cli("combine", "--target", default, default + ".d/*")
+            self.assertIn("Merge <updated>", ko.stderr)
+        self.assertEqual(twd.read_conf("default/props.conf")["aws:config"]["TZ"], "UTC")
+
+    def test_combine_dry_run_text(self):
+        twd = TestWorkDir()
+        lines = ["<row>{0}</row>".format(i) for i in range(1000)]
+        twd.write_file("default.d/10-upstream/data/lookup.xml", "\n".join(lines) + "\n")
+        default = twd.get_path("default")
+        with ksconf_cli:
+            ksconf_cli("combine", "--target", default, default + ".d/*")
+        lines[500] = "<row>changed</row>"
+        twd.write_file("default.d/20-corp/data/lookup.xml", "\n".join(lines) + "\n")
+        with ksconf_cli:
+            ko = ksconf_cli("combine", "--dry-run", "--target", default, default + ".d/*")
+            self.assertIn("DRY-RUN (DIFF)", ko.stderr)
+            self.assertIn("@@ -498,7 +498,7 @@", ko.stdout)
+            self.assertRegex(ko.stdout, r"[\r\n]-<row>500</row>[\r\n]+\+<row>changed</row>")
+            # Only a few lines of context are shown
+            self.assertIn(" <row>497</row>", ko.stdout)
+            self.assertNotIn("<row>496</row>", ko.stdout)
+
     def test_require_arg(self):
         with ksconf_cli:
             ko = ksconf_cli("combine", "source-dir")
@@ -345,6 +390,207 @@ class CliMergeTest(unittest.TestCase):
             self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
             self.assertRegex(ko.stdout, r"^$")
 
+    def test_merge_jobs(self):
+        twd = TestWorkDir()
+        confs = [twd.write_file("{0}.conf".format(i), "[x]\nvalue = {0}\nkey{0} = 1\n".format(i))
+                 for i in range(4)]
+        with ksconf_cli:
+            ko = ksconf_cli("merge", "--jobs", "2", *confs)
+            self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
+            self.assertRegex(ko.stdout, r"[\r\n]key0 = 1[\r\n]+key1 = 1")
+            self.assertRegex(ko.stdout, r"[\r\n]value = 3")
+        bad = twd.write_file("bad.conf", "[x]\na = 1\n[x]\nb = 2\n")
+        for jobs in ("1", "2"):
+            with ksconf_cli:
+                ko = ksconf_cli("merge", "--jobs", jobs, confs[0], bad)
+                self.assertEqual(ko.returncode, 2)
+                self.assertRegex(ko.stderr, r"failed to parse '[^']+bad\.conf'")
+        with ksconf_cli:
+            ko = ksconf_cli("merge", "--jobs", "-1", *confs)
+            self.assertEqual(ko.returncode, 2)
+            self.assertRegex(ko.stderr, r"--jobs/-j: expected 0 or a positive number")
+
+    def test_load_profile_error(self):
+        """ An invalid parse profile is reported for the file, not raised """
+        from ksconf.commands import ConfFileProxy, load_conf_files
+        twd = TestWorkDir()
+        confs = [twd.write_file("{0}.conf".format(i), "[x]\nvalue = {0}\n".format(i))
+                 for i in range(2)]
+        for jobs in (1, 2):
+            proxies = [ConfFileProxy(conf, "r", parse_profile={"bogus": True}) for conf in confs]
+            errors = load_conf_files(proxies, jobs)
+            self.assertTrue(errors)
+            self.assertIs(errors[0][0], proxies[0])
+            self.assertIsInstance(errors[0][1], TypeError)
+
+
+class CliMerge3Test(unittest.TestCase):
+    def setUp(self):
+        self.twd = twd = TestWorkDir()
+        self.base = twd.write_file("old/props.conf", """
+        [syslog]
+        TRANSFORMS = syslog-host
+        TZ = UTC
+        [old]
+        a = 1
+        """)
+        self.ours = twd.write_file("local/props.conf", """
+        [syslog]
+        TRANSFORMS = syslog-host
+        TZ = GMT
+        [old]
+        a = 1
+        """)
+        self.theirs = twd.write_file("new/props.conf", """
+        [syslog]
+        TRANSFORMS = syslog-host, syslog-sourcetype
+        TZ = UTC
+        """)
+
+    def test_merge3(self):
+        target = self.twd.get_path("merged.conf")
+        with ksconf_cli:
+            ko = ksconf_cli("merge3", self.base, self.ours, self.theirs, "--target", target)
+            self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
+        merged = self.twd.read_conf("merged.conf")
+        self.assertEqual(merged, {"syslog": {"TRANSFORMS": "syslog-host, syslog-sourcetype",
+                                             "TZ": "GMT"}})
+
+    def test_conflict(self):
+        self.twd.write_file("new/props.conf", """
+        [syslog]
+        TRANSFORMS = syslog-host
+        TZ = EST
+        """)
+        for (prefer, tz) in (("ours", "GMT"), ("theirs", "EST")):
+            with ksconf_cli:
+                ko = ksconf_cli("merge3", "--prefer", prefer, self.base, self.ours, self.theirs)
+                self.assertEqual(ko.returncode, EXIT_CODE_MERGE_CONFLICT)
+                self.assertIn("Conflict [syslog] TZ:  base='UTC'  ours='GMT'  theirs='EST'",
+                              ko.stderr)
+                self.assertRegex(ko.stdout, r"[\r\n]TZ = {0}".format(tz))
+
+
+class CliCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.twd = TestWorkDir()
+        self.cache_dir = self.twd.get_path("cache")
+        self.conf1 = self.twd.write_file("props1.conf", """
+        index = main
+        [syslog]
+        TRANSFORMS = syslog-host
+        """)
+        self.conf2 = self.twd.write_file("props2.conf", """
+        [syslog]
+        SHOULD_LINEMERGE = false
+        """)
+
+    def test_merge_uses_cache(self):
+        from ksconf.conf import cache
+        with ksconf_cli:
+            ko = ksconf_cli("--cache-dir", self.cache_dir, "merge", self.conf1, self.conf2)
+            self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
+            self.assertEqual((cache.PARSE_CACHE.hits, cache.PARSE_CACHE.misses), (0, 2))
+            first = ko.stdout
+            ko = ksconf_cli("--cache-dir", self.cache_dir, "merge", self.conf1, self.conf2)
+            self.assertEqual((cache.PARSE_CACHE.hits, cache.PARSE_CACHE.misses), (2, 0))
+            self.assertEqual(ko.stdout, first)
+            self.assertRegex(ko.stdout, r"^index = main")
+            # A modified file must be re-parsed
+            self.twd.write_file("props2.conf", """
+            [syslog]
+            SHOULD_LINEMERGE = true
+            """)
+            ko = ksconf_cli("--cache-dir", self.cache_dir, "merge", self.conf1, self.conf2)
+            self.assertEqual((cache.PARSE_CACHE.hits, cache.PARSE_CACHE.misses), (1, 1))
+            self.assertIn("SHOULD_LINEMERGE = true", ko.stdout)
+            # Caching is opt-in
+            ksconf_cli("merge", self.conf1, self.conf2)
+            self.assertIsNone(cache.PARSE_CACHE)
+
+    def test_cache_stats_clear(self):
+        with ksconf_cli:
+            ksconf_cli("--cache-dir", self.cache_dir, "merge", self.conf1, self.conf2)
+            ko = ksconf_cli("--cache-dir", self.cache_dir, "cache", "stats")
+            self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
+            self.assertRegex(ko.stdout, r"Entries:\s+2")
+            ko = ksconf_cli("--cache-dir", self.cache_dir, "cache", "clear", "--expired")
+            self.assertRegex(ko.stdout, r"Removed 0 cache entries")
+            ko = ksconf_cli("--cache-dir", self.cache_dir, "cache", "clear")
+            self.assertRegex(ko.stdout, r"Removed 2 cache entries")
+            ko = ksconf_cli("--cache-dir", self.cache_dir, "cache", "stats")
+            self.assertRegex(ko.stdout, r"Entries:\s+0")
+
+    def test_put_failure_warns(self):
+        import logging
+        from ksconf.conf.cache import ParseCache, logger
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        logger.addHandler(handler)
+        try:
+            parse_cache = ParseCache(self.cache_dir)
+            self.assertFalse(parse_cache.put("0" * 40, {"a": lambda: None}))
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(len(messages), 1)
+        self.assertIn("Unable to write parse cache entry", messages[0])
+        self.assertEqual(parse_cache.stats()["entries"], 0)
+
+    def test_incremental_parse(self):
+        from ksconf.conf.cache import ParseCache
+        parse_cache = ParseCache(self.cache_dir, index_min_size=0)
+        conf = self.twd.write_file("big.conf", """
+        [a]
+        x = 1
+        [b]
+        y = 2
+        [c]
+        z = 3
+        """)
+
+        full_parses = []
+
+        def parse():
+            full_parses.append(conf)
+            return parse_conf(conf, PARSECONF_MID)
+
+        def load():
+            return parse_cache.load(conf, PARSECONF_MID, parse)
+
+        # The first parse is built from the indexed content;  no full parse is needed
+        self.assertEqual(load(), parse_conf(conf, PARSECONF_MID))
+        self.assertEqual((parse_cache.stanzas_reused, parse_cache.stanzas_parsed), (0, 0))
+        self.assertEqual(full_parses, [])
+        self.twd.write_file("big.conf", """
+        [a]
+        x = 1
+        [b]
+        y = 22
+        [c]
+        z = 3
+        [d]
+        """)
+        self.assertEqual(load(), parse_conf(conf, PARSECONF_MID))
+        self.assertEqual((parse_cache.stanzas_reused, parse_cache.stanzas_parsed), (2, 2))
+        # Errors are reported by the full parser
+        self.twd.write_file("big.conf", """
+        [a]
+        x = 1
+        [a]
+        x = 2
+        """)
+        with self.assertRaises(ConfParserException):
+            load()
+        # Including errors before the first stanza
+        self.twd.write_file("big.conf", """
+        junk
+        [a]
+        x = 1
+        """)
+        with self.assertRaises(ConfParserException):
+            load()
+        self.assertEqual(len(full_parses), 2)
 
 
 class CliDiffTest(unittest.TestCase):
@@ -483,6 +729,224 @@ class CliDiffTest(unittest.TestCase):
             #self.assertEqual(ko.returncode, EXIT_CODE_DIFF_CHANGE)
             self.assertRegex(ko.stderr, "No common stanzas")
 
+    def test_diff_line_numbers(self):
+        twd = TestWorkDir()
+        conf1 = twd.write_file("a.conf", """
+        [x]
+        search = noop
+        """)
+        conf2 = twd.write_file("b.conf", """
+        [y]
+        a = 1
+
+        [x]
+        search = other
+        """)
+        with ksconf_cli:
+            ko = ksconf_cli("diff", "--line-numbers", conf1, conf2)
+            self.assertEqual(ko.returncode, EXIT_CODE_DIFF_CHANGE)
+            self.assertRegex(ko.stdout, r"@@ -[^\r\n]+a\.conf:2 \+[^\r\n]+b\.conf:5 @@[\r\n]+ \[x\]")
+            self.assertRegex(ko.stdout, r"@@ \+[^\r\n]+b\.conf:2 @@[\r\n]+\+\[y\]")
+            ko = ksconf_cli("diff", conf1, conf2)
+            self.assertNotIn("@@", ko.stdout)
+
+    def test_diff_baseline(self):
+        twd = TestWorkDir()
+        base = twd.write_file("base.conf", """
+        [x]
+        search = noop
+        [y]
+        a = 1
+        """)
+        same = twd.write_file("sh1.conf", """
+        [y]
+        a = 1
+        [x]
+        search = noop
+        """)
+        changed = twd.write_file("sh2.conf", """
+        [x]
+        search = other
+        [z]
+        """)
+        with ksconf_cli:
+            ko = ksconf_cli("diff", "--jobs", "2", "--baseline", base, same, changed)
+            self.assertEqual(ko.returncode, EXIT_CODE_DIFF_CHANGE)
+            self.assertRegex(ko.stdout, r"1  [^\r\n]+sh1\.conf  \(same\)")
+            self.assertIn("1 of 2 files differ", ko.stdout)
+            self.assertRegex(ko.stdout, r"[\r\n]  \.~  \[x\] search[\r\n]")
+            self.assertRegex(ko.stdout, r"[\r\n]  \.-  \[y\][\r\n]")
+            self.assertRegex(ko.stdout, r"[\r\n]  \.\+  \[z\][\r\n]")
+        with ksconf_cli:
+            ko = ksconf_cli("diff", "--baseline", base, same)
+            self.assertEqual(ko.returncode, EXIT_CODE_DIFF_EQUAL)
+        with ksconf_cli:
+            ko = ksconf_cli("diff", base, same, changed)
+            self.assertEqual(ko.returncode, EXIT_CODE_MISSING_ARG)
+        with ksconf_cli:
+            ko = ksconf_cli("diff", "--format", "jsonl", "--baseline", base, same, changed)
+            self.assertEqual(ko.returncode, EXIT_CODE_DIFF_CHANGE)
+            lines = [json.loads(line) for line in ko.stdout.splitlines()]
+            self.assertEqual(len(lines), 3)
+            self.assertTrue(all(line["file"] == changed for line in lines))
+
+    def test_diff_renames(self):
+        twd = TestWorkDir()
+        conf1 = twd.write_file("a.conf", """
+        [Errors by host]
+        search = index=main error | stats count by host
+        cron_schedule = */5 * * * *
+        dispatch.earliest_time = -5m
+        enableSched = 1
+        """)
+        conf2 = twd.write_file("b.conf", """
+        [Errors by host (v2)]
+        search = index=main error | stats count by host
+        cron_schedule = */5 * * * *
+        dispatch.earliest_time = -15m
+        enableSched = 1
+        """)
+        with ksconf_cli:
+            ko = ksconf_cli("diff", "--detect-renames", conf1, conf2)
+            self.assertEqual(ko.returncode, EXIT_CODE_DIFF_CHANGE)
+            self.assertRegex(ko.stdout, r"[\r\n]-\[Errors by host\][\r\n]+\+\[Errors by host \(v2\)\]")
+            self.assertRegex(ko.stdout, r"[\r\n] enableSched = 1[\r\n]")
+            self.assertRegex(ko.stdout, r"[\r\n]-dispatch.earliest_time = -5m[\r\n]+"
+                                        r"\+dispatch.earliest_time = -15m")
+        with ksconf_cli:
+            ko = ksconf_cli("diff", conf1, conf2)
+            self.assertEqual(ko.returncode, EXIT_CODE_DIFF_NO_COMMON)
+
+    def test_diff_stat(self):
+        twd = TestWorkDir()
+        base = twd.write_file("base.conf", """
+        [x]
+        search = noop
+        mode = fast
+        [y]
+        a = 1
+        """)
+        other = twd.write_file("other.conf", """
+        [x]
+        search = other
+        owner = nobody
+        [z]
+        b = 1
+        c = 2
+        """)
+        with ksconf_cli:
+            ko = ksconf_cli("diff", "--stat", base, other)
+            self.assertEqual(ko.returncode, EXIT_CODE_DIFF_CHANGE)
+            self.assertRegex(ko.stdout, r"  \[x\]  \+1 -1 ~1[\r\n]")
+            self.assertRegex(ko.stdout, r"- \[y\]  -1[\r\n]")
+            self.assertRegex(ko.stdout, r"\+ \[z\]  \+2[\r\n]")
+            self.assertIn("3 stanzas differ (1 added, 1 removed);  keys:  3 added, 2 removed, "
+                          "1 changed", ko.stdout)
+        with ksconf_cli:
+            ko = ksconf_cli("diff", "--stat", "--format", "jsonl", base, other)
+            lines = [json.loads(line) for line in ko.stdout.splitlines()]
+            self.assertEqual(lines[0], {"stanza": "x", "tag": "replace", "inserted": 1,
+                                        "deleted": 1, "changed": 1})
+        with ksconf_cli:
+            ko = ksconf_cli("diff", "--stat", "--baseline", base, other, base)
+            self.assertEqual(ko.returncode, EXIT_CODE_DIFF_CHANGE)
+            self.assertRegex(ko.stdout, r"base\.conf +\(same\)")
+            self.assertIn("1 of 2 files differ", ko.stdout)
+        with ksconf_cli:
+            ko = ksconf_cli("diff", "--stat", base, base)
+            self.assertEqual(ko.returncode, EXIT_CODE_DIFF_EQUAL)
+            self.assertEqual(ko.stdout, "")
+
+    def test_diff_jsonl(self):
+        twd = TestWorkDir()
+        conf1 = twd.write_file("a.conf", """
+        [x]
+        search = noop
+        mode = fast
+        [y]
+        a = 1
+        """)
+        conf2 = twd.write_file("b.conf", """
+        [x]
+        search = other
+        mode = fast
+        [y]
+        a = 1
+        """)
+        with ksconf_cli:
+            ko = ksconf_cli("diff", "--format", "jsonl", conf1, conf2)
+            self.assertEqual(ko.returncode, EXIT_CODE_DIFF_CHANGE)
+            lines = [json.loads(line) for line in ko.stdout.splitlines()]
+            self.assertListEqual(lines, [
+                {"tag": "equal", "type": "key", "stanza": "x", "key": "mode",
+                 "a": "fast", "b": "fast"},
+                {"tag": "replace", "type": "key", "stanza": "x", "key": "search",
+                 "a": "noop", "b": "other"},
+                {"tag": "equal", "type": "stanza", "stanza": "y",
+                 "a": {"a": "1"}, "b": {"a": "1"}}])
+        with ksconf_cli:
+            ko = ksconf_cli("diff", "--format", "jsonl", "--skip-equal", conf1, conf2)
+            self.assertEqual([json.loads(line)["tag"] for line in ko.stdout.splitlines()],
+                             ["replace"])
+        with ksconf_cli:
+            ko = ksconf_cli("diff", "--format", "jsonl", "--skip-equal", conf1, conf1)
+            self.assertEqual(ko.returncode, EXIT_CODE_DIFF_EQUAL)
+            self.assertEqual(ko.stdout, "")
+
+
+class CliHashTest(unittest.TestCase):
+    def setUp(self):
+        self.twd = twd = TestWorkDir()
+        self.conf1 = twd.write_file("props1.conf", """
+        # Header comment
+        [syslog]
+        TRANSFORMS = syslog-host
+        SHOULD_LINEMERGE = false
+        [web]
+        TZ = UTC
+        """)
+        self.conf2 = twd.write_file("props2.conf", """
+        [web]
+        TZ=UTC
+
+        [syslog]
+        SHOULD_LINEMERGE = false
+        TRANSFORMS = syslog-host
+        """)
+
+    def test_same_content(self):
+        with ksconf_cli:
+            ko = ksconf_cli("hash", self.conf1, self.conf2)
+            self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
+            lines = ko.stdout.splitlines()
+            self.assertEqual(len(lines), 2)
+            self.assertEqual(lines[0].split()[0], lines[1].split()[0])
+            self.assertTrue(lines[1].endswith("  " + self.conf2))
+
+    def test_stanzas(self):
+        self.twd.write_file("props2.conf", """
+        [web]
+        TZ = GMT
+        [syslog]
+        SHOULD_LINEMERGE = false
+        TRANSFORMS = syslog-host
+        """)
+        with ksconf_cli:
+            ko = ksconf_cli("hash", "--stanzas", "--jobs", "2", self.conf1, self.conf2)
+            self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
+            lines = ko.stdout.splitlines()
+            self.assertEqual(len(lines), 6)
+            self.assertNotEqual(lines[0].split()[0], lines[3].split()[0])
+            self.assertEqual(lines[1].split(), lines[4].split())
+            self.assertEqual(lines[1].split()[1], "[syslog]")
+            self.assertNotEqual(lines[2].split()[0], lines[5].split()[0])
+
+    def test_bad_conf(self):
+        bad = self.twd.write_file("bad.conf", "[syslog\n")
+        with ksconf_cli:
+            ko = ksconf_cli("hash", self.conf1, bad)
+            self.assertEqual(ko.returncode, 2)
+            self.assertIn("failed to parse", ko.stderr)
 
 
 class CliCheckTest(unittest.TestCase):
@@ -545,6 +1009,44 @@ class CliCheckTest(unittest.TestCase):
             self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
             self.assertRegex(ko.stderr, r"Skipping missing file: [^\r\n]+[/\\]not-a-real-file.conf")
 
+    def test_parallel(self):
+        """ Results are reported in order, regardless of the number of jobs """
+        fake_file = self.twd.get_path("not-a-real-file.conf")
+        files = [self.conf_bad, self.conf_good, fake_file, self.conf_good, self.conf_bad]
+        with ksconf_cli:
+            serial = ksconf_cli("check", *files)
+            parallel = ksconf_cli("check", "--jobs", "3", *files)
+            self.assertEqual(parallel.returncode, EXIT_CODE_BAD_CONF_FILE)
+            self.assertEqual(parallel.stdout, serial.stdout)
+            self.assertEqual(parallel.stderr, serial.stderr)
+            self.assertRegex(parallel.stdout, r"\b2 files failed")
+
+
+    def test_all_errors(self):
+        """ Every error is reported in a single run, unless --max-errors is given """
+        conf = self.twd.write_file("many-errors.conf", """
+        [a]
+        x = 1
+        x = 2
+        [a]
+        junk
+        [b
+        """)
+        with ksconf_cli:
+            ko = ksconf_cli("check", conf, self.conf_bad)
+            self.assertEqual(ko.returncode, EXIT_CODE_BAD_CONF_FILE)
+            self.assertRegex(ko.stdout, r"\b2 files failed")
+            self.assertRegex(ko.stderr, r"duplicate key 'x'.*\(line 4\)")
+            self.assertRegex(ko.stderr, r"\[a\] found more than once.*\(line 5\)")
+            self.assertRegex(ko.stderr, r"Unexpected entry:  junk\s+\(line 6\)")
+            self.assertRegex(ko.stderr, r"Dangling stanza header:  \[b\s+\(line 7\)")
+            self.assertRegex(ko.stderr, r"badfile\.conf:.*\(line 3\)")
+            ko = ksconf_cli("check", "--max-errors", "2", conf, self.conf_bad)
+            self.assertEqual(ko.returncode, EXIT_CODE_BAD_CONF_FILE)
+            self.assertEqual(ko.stderr.count("Error in file"), 2)
+            self.assertRegex(ko.stderr, r"Stopping after 2 errors")
+            self.assertNotIn("badfile.conf", ko.stderr)
+
 
 class CliSortTest(unittest.TestCase):
     def setUp(self):
@@ -603,6 +1105,21 @@ class CliSortTest(unittest.TestCase):
             self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
             self.assertRegex(ko.stderr, "^Nothing to update")
 
+    def test_sort_inplace_round_trip(self):
+        """ Sorting twice must not change the output;  global entries stay at the top """
+        with ksconf_cli:
+            ksconf_cli("sort", "-i", self.conf_bogus)
+        with open(self.conf_bogus, encoding="utf-8") as f:
+            first = f.read()
+        self.assertRegex(first, r"^# Global comment 1\n# Global Comment 2\nglobal_entry1 = x\n")
+        with ksconf_cli:
+            ko = ksconf_cli("sort", "-i", self.conf_bogus)
+            self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
+        with open(self.conf_bogus, encoding="utf-8") as f:
+            self.assertEqual(f.read(), first)
+        self.assertEqual(parse_conf(self.conf_bogus)[GLOBAL_STANZA],
+                         {"global_entry1": "x", "global_entry2": "y"})
+
     ''' # Leaving this enabled makes too much noise...
     @unittest.expectedFailure
     def test_sort_glob(self):
@@ -735,6 +1252,46 @@ class CliMinimizeTest(unittest.TestCase):
             final_size = os.stat(conf).st_size
             self.assertTrue(orig_size > final_size)
 
+    def test_minimize_partial_stanza(self):
+        """ Keys are removed from a stanza that's kept while the rest of it is still compared """
+        twd = TestWorkDir()
+        default = twd.write_file("default.conf", """\
+        [a]
+        x = 1
+        y = 2
+        z = 3
+        [b]
+        x = 1
+        """)
+        local = twd.write_file("local.conf", """\
+        [a]
+        x = 1
+        y = 20
+        z = 3
+        [b]
+        x = 1
+        """)
+        import ksconf.commands.minimize as minimize
+        iter_compare_cfgs = minimize.iter_compare_cfgs
+        changes = []
+
+        def checked_compare(a, b, **kwargs):
+            # The local conf must not change while it's still being compared
+            orig = dict((stanza, dict(b[stanza])) for stanza in b)
+            for op in iter_compare_cfgs(a, b, **kwargs):
+                yield op
+                changes.append(dict((stanza, dict(b[stanza])) for stanza in b) != orig)
+        minimize.iter_compare_cfgs = checked_compare
+        try:
+            with ksconf_cli:
+                ko = ksconf_cli("minimize", "--target", local, default)
+                self.assertEqual(ko.returncode, EXIT_CODE_SUCCESS)
+        finally:
+            minimize.iter_compare_cfgs = iter_compare_cfgs
+        self.assertTrue(changes)
+        self.assertFalse(any(changes))
+        self.assertDictEqual(twd.read_conf("local.conf"), {"a": {"y": "20"}})
+
 
 
 dummy_config = {
@@ -780,6 +1337,25 @@ class CliPromoteTest(unittest.TestCase):
         self.assertEqual(stanza["alert.track"], "1")
         self.assertTrue(len(stanza["search"].splitlines()) > 2)
 
+    def test_promote_ask_summary(self):
+        twd = self.sample_data01()
+        answers = twd.write_file("answers.txt", "q\n")
+        try:
+            _stdin = sys.stdin
+            sys.stdin = open(answers, "r")
+            with ksconf_cli:
+                ko = ksconf_cli("promote", self.conf_local, self.conf_default)
+                self.assertEqual(ko.returncode, EXIT_CODE_USER_QUIT)
+                self.assertRegex(ko.stderr, r"  \[License usage trend by sourcetype\]  ~3[\r\n]")
+                self.assertIn("1 stanzas differ (0 added, 0 removed);  keys:  0 added, "
+                              "0 removed, 3 changed", ko.stderr)
+        finally:
+            sys.stdin.close()
+            sys.stdin = _stdin
+        # Nothing was promoted
+        self.assertEqual(twd.read_conf("default/savedsearches.conf")[
+            "License usage trend by sourcetype"]["alert.track"], "0")
+
     def test_promote_batch_simple_keep(self):
         twd = self.sample_data01()
         with ksconf_cli:
@@ -899,6 +1475,21 @@ class CliKsconfUnarchiveTestCase(unittest.TestCase):
             self.assertIn("RSA Securid Splunk Addon", kco.stdout)
             self.assertRegex(kco.stdout, "without version control support")
 
+    def test_bad_installed_app_conf(self):
+        twd = TestWorkDir()
+        apps = twd.makedir("apps")
+        zfile = static_data("apps/technology-add-on-for-rsa-securid_01.zip")
+        with ksconf_cli:
+            kco = ksconf_cli("unarchive", zfile, "--dest", apps)
+        app_dir = [d for d in os.listdir(apps) if os.path.isdir(os.path.join(apps, d))][0]
+        # Only the body of the stanza is broken, so a lazy parse wouldn't notice right away
+        twd.write_file(os.path.join("apps", app_dir, "default", "app.conf"),
+                       "[launcher]\nx = 1\nbad]\n")
+        with ksconf_cli:
+            kco = ksconf_cli("unarchive", zfile, "--dest", apps)
+            self.assertIn("Unable to read app.conf from existing install", kco.stderr)
+            self.assertIn("About to upgrade", kco.stdout)
+
     def test_modsec_install_defaultd(self):
         twd = TestWorkDir(git_repo=True)
         app_archives = [
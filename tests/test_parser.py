@@ -5,18 +5,36 @@
 
 from __future__ import absolute_import, unicode_literals
 import os
+import shutil
+import sys
+import tempfile
 import unittest
-from io import StringIO, BytesIO
+from io import open, StringIO, BytesIO
 from textwrap import dedent
 
-from ksconf.conf.delta import compare_cfgs, summarize_cfg_diffs, \
-    DIFF_OP_REPLACE, DIFF_OP_EQUAL, DIFF_OP_DELETE, DIFF_OP_INSERT
-from ksconf.conf.merge import merge_conf_dicts
+from copy import deepcopy
+
+from ksconf.conf.delta import compare_cfgs, iter_compare_cfgs, compare_cfgs_many, \
+    show_diff_matrix, summarize_cfg_diffs, show_text_diff, diff_op_to_dict, write_diff_jsonl, \
+    find_stanza_renames, DiffStzRename, DIFF_OP_RENAME, iter_diff_stats, StanzaStat, \
+    DIFF_OP_REPLACE, DIFF_OP_EQUAL, DIFF_OP_DELETE, DIFF_OP_INSERT, DiffStzComments, DiffStzKey
+from ksconf.conf.lazy import LazyConf
+from ksconf.conf.manifest import WriteManifest
+from ksconf.conf.merge import merge_conf_dicts, merge3, LayeredConf, MergeConflict, \
+    MERGE3_THEIRS
 from ksconf.conf.parser import parse_conf_stream, DUP_EXCEPTION, DUP_MERGE, DUP_OVERWRITE, \
     DuplicateStanzaException, DuplicateKeyException, parse_conf, write_conf, ConfParserException, \
-    PARSECONF_MID, GLOBAL_STANZA
+    PARSECONF_MID, PARSECONF_LOOSE, GLOBAL_STANZA, PARSER_BACKEND_LEGACY, PARSER_BACKEND_FUSED, tokenize_conf, \
+    TOKEN_STANZA, TOKEN_KEY, TOKEN_COMMENT, TOKEN_ERROR, Stanza, Conf, parse_conf_many, \
+    PARSECONF_STRICT, parse_conf_events, check_conf, EVENT_STANZA, EVENT_KEY, EVENT_COMMENT, \
+    EVENT_CONTINUATION, EVENT_ERROR, ConfBuffer, ConfParserErrors, detect_by_bom, smart_write_conf, \
+    conf_digest, stanza_digest, same_content
+from ksconf.consts import SMART_CREATE, SMART_NOCHANGE, SMART_UPDATE, EXIT_CODE_DIFF_CHANGE
+from ksconf.util.compare import diff_lines, line_opcodes
 from ksconf.util.file import relwalk
+from ksconf.util.terminal import TermWriter, tty_color, ANSI_GREEN, ANSI_RESET
 import six
+from six.moves import cPickle as pickle
 
 
 def parse_string(text, profile=None, **kwargs):
@@ -140,6 +158,55 @@ class ParserTestCase(unittest.TestCase):
         c = twd.read_conf("comment-bom.conf")
         self.assertTrue(c[GLOBAL_STANZA])
 
+    def test_mmap_matches_text_parser(self):
+        """ The memory-mapped bytes-level parser must produce the same results. """
+        from test_cli import TestWorkDir
+        twd = TestWorkDir()
+        samples = {
+            "ascii.conf": b"# comment\r\n[stanza]\r\nsearch = a \\\r\n| b\r\nempty =\r\n",
+            "utf8-bom.conf": b"\xef\xbb\xbf[caf\xc3\xa9]\nna\xc3\xafve = r\xc3\xa9sum\xc3\xa9\n",
+            "utf16.conf": "[stanza]\nkey = value\n".encode("utf-16"),
+        }
+        for (fn, content) in samples.items():
+            path = twd.write_file(fn, content)
+            for profile in (PARSECONF_MID, PARSECONF_LOOSE):
+                self.assertEqual(parse_conf(path, profile, use_mmap=True),
+                                 parse_conf(path, profile, use_mmap=False))
+        c = parse_conf(twd.get_path("utf8-bom.conf"), use_mmap=True)
+        self.assertEqual(c["caf\u00e9"]["na\u00efve"], "r\u00e9sum\u00e9")
+        # Pure ASCII content must come back as text too (not native byte strings on Python 2)
+        c = parse_conf(twd.get_path("ascii.conf"), use_mmap=True)
+        (stanza, key, value) = [(s, k, v) for s in c for (k, v) in c[s].items()][0]
+        for text in (stanza, key, value):
+            self.assertIsInstance(text, six.text_type)
+
+    def test_conf_buffer(self):
+        """ A ConfBuffer parses the same as a text-mode stream and detects unchanged content """
+        from test_cli import TestWorkDir
+        twd = TestWorkDir()
+        samples = {
+            "crlf.conf": b"# KSCONF-NO-SORT\r\n[stanza]\r\nsearch = a \\\r\n| b\r\n",
+            "utf8-bom.conf": b"\xef\xbb\xbf[caf\xc3\xa9]\nna\xc3\xafve = r\xc3\xa9sum\xc3\xa9\n",
+            "utf16.conf": "[stanza]\nkey = value\n".encode("utf-16"),
+            "lone-cr.conf": b"[a]\rx = 1\r",
+        }
+        for (fn, content) in samples.items():
+            path = twd.write_file(fn, content)
+            buf = ConfBuffer.read(path)
+            self.assertEqual(buf.has_marker(), fn == "crlf.conf")
+            for profile in (PARSECONF_MID, PARSECONF_LOOSE):
+                with open(path, encoding=detect_by_bom(path, "utf-8")) as stream:
+                    self.assertEqual(buf.parse(profile), parse_conf_stream(stream, **profile))
+        buf = ConfBuffer.read(twd.get_path("crlf.conf"))
+        self.assertTrue(buf.matches("# KSCONF-NO-SORT\n[stanza]\nsearch = a \\\n| b\n"))
+        self.assertFalse(buf.matches("[stanza]\nsearch = a \\\n| b\n"))
+
+        path = twd.write_file("sorted.conf", "[a]\nx = 1\n")
+        buf = ConfBuffer.read(path)
+        self.assertEqual(smart_write_conf(path, buf.parse(), original=buf), SMART_NOCHANGE)
+        self.assertEqual(smart_write_conf(path, {"a": {"x": "2"}}, original=buf), SMART_UPDATE)
+        self.assertEqual(parse_conf(path), {"a": {"x": "2"}})
+
     def test_whitespace_stanza(self):
         c = parse_string("""
         [stanza 1]
@@ -354,6 +421,504 @@ class ParserTestCase(unittest.TestCase):
         self.assertEqual(st["int2"], "0")
         self.assertEqual(st["none"], "")
 
+    def test_write_exact(self):
+        text = dedent("""\
+        # global
+        g = 1
+        [a]
+        # comments are written before the first key
+        $x = 0
+        b = 2
+        e =
+        m = one\\
+        two
+
+        [b b]
+        ; another comment
+        z = 1
+        """)
+        c = parse_string(text, keep_comments=True)
+        # Parsed (sorted) content only iterates in sorted order if dicts keep insertion order
+        for presorted in ((False, True) if sys.version_info >= (3, 6) else (False,)):
+            out = StringIO()
+            write_conf(out, c, presorted=presorted)
+            self.assertEqual(out.getvalue(), "# global\ng = 1\n\n" + text[text.index("["):])
+        # Native strings (bytes on Python 2) and a global stanza that doesn't iterate first
+        c = Conf([(str("b"), {str("x"): str("1")}), (GLOBAL_STANZA, {"g": "1"})])
+        for presorted in (False, True):
+            out = StringIO()
+            write_conf(out, c, presorted=presorted)
+            self.assertEqual(out.getvalue(), "g = 1\n\n[b]\nx = 1\n")
+
+    def test_parse_conf_many(self):
+        temp_dir = tempfile.mkdtemp("-ksconftest")
+        try:
+            paths = []
+            for i in range(5):
+                paths.append(os.path.join(temp_dir, "{0}.conf".format(i)))
+                with open(paths[-1], "w", encoding="utf-8") as stream:
+                    stream.write("[s{0}]\nkey = {0}\n".format(i) if i != 3 else "[bad\n")
+            for jobs in (1, 2):
+                results = list(parse_conf_many(paths, PARSECONF_STRICT, jobs=jobs))
+                self.assertEqual([path for (path, _) in results], paths)
+                self.assertEqual(results[4][1], {"s4": {"key": "4"}})
+                self.assertIsInstance(results[3][1], ConfParserException)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_positions(self):
+        text = dedent("""\
+        # comment
+        g = 1
+        [a]
+        x = 1
+        y = 2 \\
+        more
+        [b]
+        x = 3
+        [a]
+        x = 4
+        """)
+        c = parse_string(text, profile=PARSECONF_LOOSE)
+        self.assertIsNone(c.positions)
+        c = parse_string(text, profile=dict(PARSECONF_LOOSE, keep_positions=True))
+        pos = c.positions
+        self.assertEqual(pos.line(GLOBAL_STANZA), 0)
+        self.assertEqual(pos.line(GLOBAL_STANZA, "g"), 2)
+        self.assertEqual([pos.line("a"), pos.line("a", "x"), pos.line("a", "y")], [3, 10, 5])
+        self.assertEqual([pos.line("b"), pos.line("b", "x")], [7, 8])
+        self.assertIsNone(pos.line("a", "z"))
+        self.assertIsNone(pos.line("c"))
+        # An overwritten stanza only has positions of the content that was kept
+        c = parse_string(text, profile=dict(PARSECONF_LOOSE, dup_stanza=DUP_OVERWRITE,
+                                            keep_positions=True))
+        self.assertEqual([c.positions.line("a"), c.positions.line("a", "y")], [9, None])
+        # Also recorded by the bytes-level parser, and kept by pickle and deepcopy
+        temp_dir = tempfile.mkdtemp("-ksconftest")
+        try:
+            path = os.path.join(temp_dir, "positions.conf")
+            with open(path, "w", encoding="utf-8") as stream:
+                stream.write(text)
+            profile = dict(PARSECONF_LOOSE, keep_positions=True)
+            c = parse_conf(path, profile)
+            # Positions also make it back from worker processes
+            c3 = dict(parse_conf_many([path, path], profile, jobs=2))[path]
+        finally:
+            shutil.rmtree(temp_dir)
+        self.assertEqual(c.positions.location("b", "x"), path + ":8")
+        self.assertEqual(c3.positions.line("a", "x"), 10)
+        for protocol in (0, pickle.HIGHEST_PROTOCOL):
+            c2 = pickle.loads(pickle.dumps(c, protocol))
+            self.assertIsInstance(c2, Conf)
+            self.assertEqual(c2.positions.line("a", "x"), 10)
+            self.assertEqual(c2.positions.line(GLOBAL_STANZA, "g"), 2)
+        self.assertIs(deepcopy(c).positions, c.positions)
+
+    def test_shared_names(self):
+        """ Stanza names and keys are shared between parsed files """
+        text = "[stanza one]\ndisabled = 1\n[other]\ndisabled = 0\n"
+        c1 = parse_string(text)
+        c2 = parse_string(text, backend=PARSER_BACKEND_LEGACY)
+        self.assertIsInstance(c1, Conf)
+        self.assertIsInstance(c2["other"], Stanza)
+        keys1 = [k for st in c1.values() for k in st] + list(c1)
+        keys2 = [k for st in c2.values() for k in st] + list(c2)
+        self.assertEqual(sorted(keys1), sorted(keys2))
+        for k1 in keys1:
+            self.assertTrue(any(k1 is k2 for k2 in keys2), k1)
+
+
+class TokenizerTestCase(unittest.TestCase):
+    """ Make sure the fused tokenizer and the legacy parser chain agree. """
+
+    def assertSameParse(self, text, **profile):
+        results = []
+        for backend in (PARSER_BACKEND_LEGACY, PARSER_BACKEND_FUSED):
+            f = StringIO(text)
+            f.name = "sample.conf"
+            try:
+                conf = parse_conf_stream(f, backend=backend, **profile)
+                results.append({k: (dict(v), v.comments) for k, v in conf.items()})
+            except ConfParserException as e:
+                results.append((type(e), str(e)))
+        self.assertEqual(results[0], results[1])
+
+    def test_backends_static_data(self):
+        data_dir = os.path.join(os.path.dirname(__file__), "data")
+        for fn in os.listdir(data_dir):
+            if not fn.endswith(".conf"):
+                continue
+            with open(os.path.join(data_dir, fn), encoding="utf-8") as stream:
+                text = stream.read()
+            for keep_comments in (True, False):
+                self.assertSameParse(text, keep_comments=keep_comments)
+
+    def test_backends_edge_cases(self):
+        samples = [
+            "[a]\n[b]\nx = 1\n",                 # Stanza with no lines is dropped
+            "[a]\nx = 1\n[a]\n",                 # Trailing stanza with no lines
+            "x = 1 \\\n[not a stanza]\ny = 2\n",   # Stanza header within a continuation
+            "[a]\nsearch = x \\",                # Continuation at end of file
+            "[a]\n  ; comment\n# another\nx=1\r\n",
+            "[a]\nDangling]\n",
+            "[a]\njunk text\n",
+            "[]\nx = 1\n[]",
+        ]
+        for text in samples:
+            for strict in (True, False):
+                self.assertSameParse(text, keep_comments=True, strict=strict)
+                self.assertSameParse(text, keep_comments=False, strict=strict,
+                                     dup_stanza=DUP_MERGE)
+
+    def test_token_line_numbers(self):
+        f = StringIO(dedent(r"""
+        # comment
+        [stanza]
+        search = a \
+        | b
+        [Bad stanza
+        """))
+        tokens = list(tokenize_conf(f, keep_comments=True))
+        self.assertEqual(tokens[0], (TOKEN_STANZA, 0, GLOBAL_STANZA, None))
+        self.assertEqual(tokens[1], (TOKEN_COMMENT, 2, "# comment", None))
+        self.assertEqual(tokens[2], (TOKEN_STANZA, 3, "stanza", None))
+        self.assertEqual(tokens[3], (TOKEN_KEY, 4, "search", "a \n| b"))
+        self.assertEqual(tokens[4][:2], (TOKEN_ERROR, 6))
+
+
+class ConfEventsTestCase(unittest.TestCase):
+
+    def events(self, text, profile=PARSECONF_MID):
+        f = StringIO(dedent(text))
+        f.name = "events.conf"
+        return list(parse_conf_events(f, profile))
+
+    def test_events(self):
+        events = self.events("""\
+        # global comment
+        [stanza]
+        search = a \\
+        | b
+        key = value
+        """)
+        self.assertEqual([e[:2] for e in events], [
+            (EVENT_STANZA, 0), (EVENT_COMMENT, 1), (EVENT_STANZA, 2), (EVENT_KEY, 3),
+            (EVENT_CONTINUATION, 4), (EVENT_KEY, 5)])
+        self.assertEqual(events[1].stanza, GLOBAL_STANZA)
+        self.assertEqual(events[3][2:], ("stanza", "search", "a \n| b"))
+        self.assertEqual(events[4].value, "| b")
+
+    def test_errors(self):
+        text = """\
+        [a]
+        x = 1
+        x = 2
+        [a]
+        [b
+        """
+        errors = [e for e in self.events(text, PARSECONF_STRICT) if e.type == EVENT_ERROR]
+        self.assertEqual([e.lineno for e in errors], [3, 4, 5])
+        self.assertIsInstance(errors[0].value, DuplicateKeyException)
+        self.assertIsInstance(errors[1].value, DuplicateStanzaException)
+        self.assertRegex(str(errors[2].value), r"Dangling stanza header")
+        # check_conf() raises the first error, just like parse_conf()
+        f = StringIO(dedent(text))
+        self.assertRaises(DuplicateStanzaException, check_conf, f, PARSECONF_MID)
+        f = StringIO(dedent(text))
+        self.assertRaises(DuplicateKeyException, check_conf, f, PARSECONF_STRICT)
+        self.assertEqual(self.events("[a]\nx = 1\n[a]\n", PARSECONF_LOOSE)[-1].type,
+                         EVENT_STANZA)
+
+    def test_collect_errors(self):
+        """ check_conf() can collect every error in a single pass """
+        text = dedent("""\
+        [a]
+        x = 1
+        x = 2
+        junk
+        [a]
+        [b
+        """)
+        with self.assertRaises(ConfParserErrors) as cm:
+            check_conf(StringIO(text), PARSECONF_STRICT, max_errors=0)
+        errors = cm.exception.errors
+        self.assertEqual([e.lineno for e in errors], [3, 4, 5, 6])
+        self.assertIsInstance(errors[0].value, DuplicateKeyException)
+        self.assertRegex(str(errors[1].value), r"Unexpected entry")
+        self.assertIsInstance(errors[2].value, DuplicateStanzaException)
+        self.assertRegex(str(errors[3].value), r"Dangling stanza header")
+        self.assertRegex(str(cm.exception), r"^Stanza \[a\] has duplicate key 'x'.*\(line 3\)\n")
+        # Stop early
+        with self.assertRaises(ConfParserErrors) as cm:
+            check_conf(StringIO(text), PARSECONF_STRICT, max_errors=2)
+        self.assertEqual(len(cm.exception.errors), 2)
+        # Errors survive the trip back from worker processes
+        errors = pickle.loads(pickle.dumps(cm.exception)).errors
+        self.assertEqual([e.lineno for e in errors], [3, 4])
+        check_conf(StringIO("[a]\nx = 1\n"), PARSECONF_STRICT, max_errors=0)
+
+
+class StanzaCommentsTestCase(unittest.TestCase):
+    sample = dedent("""\
+    # Global comment
+    x = 1
+
+    [a]
+    # Before b
+    b = 2
+    # Trailing comment
+    [b]
+    ; only a comment
+    """)
+
+    def test_comments_out_of_band(self):
+        c = parse_string(self.sample, keep_comments=True)
+        self.assertEqual(dict(c[GLOBAL_STANZA]), {"x": "1"})
+        self.assertEqual(dict(c["a"]), {"b": "2"})
+        self.assertEqual(c["a"].comments, [("b", "# Before b"), (None, "# Trailing comment")])
+        self.assertEqual(c["b"].comments, [(None, "; only a comment")])
+        self.assertEqual(parse_string(self.sample)["a"].comments, [])
+
+    def test_round_trip(self):
+        c = parse_string(self.sample, keep_comments=True)
+        out = StringIO()
+        write_conf(out, c)
+        self.assertEqual(parse_string(out.getvalue(), keep_comments=True), c)
+        self.assertEqual(out.getvalue().splitlines()[:2], ["# Global comment", "x = 1"])
+        for copied in (deepcopy(c), pickle.loads(pickle.dumps(c))):
+            self.assertEqual(copied["a"].comments, c["a"].comments)
+            self.assertIsInstance(copied["a"], Stanza)
+
+    def test_compare_comments(self):
+        a = parse_string(self.sample, keep_comments=True)
+        b = parse_string(self.sample.replace("Before b", "About b"), keep_comments=True)
+        self.assertEqual(compare_cfgs(a, b)[0].tag, DIFF_OP_EQUAL)
+        diffs = compare_cfgs(a, b, comments=True)
+        ops = [op for op in diffs if isinstance(op.location, DiffStzComments)]
+        self.assertEqual(len(ops), 1)
+        self.assertEqual(ops[0].tag, DIFF_OP_REPLACE)
+        self.assertEqual(ops[0].location.stanza, "a")
+
+    def test_dup_merge_replaces_comments(self):
+        """ Comments of a later duplicate stanza replace the earlier ones, as they always have """
+        text = "[a]\n# one\nx = 1\n[b]\n[a]\n# two\ny = 2\n[b]\n# three\n[a]\nz = 3\n"
+        profile = dict(PARSECONF_LOOSE, keep_comments=True)
+        for backend in (PARSER_BACKEND_FUSED, PARSER_BACKEND_LEGACY):
+            c = parse_string(text, dup_stanza=DUP_MERGE, keep_comments=True, backend=backend)
+            self.assertEqual(c["a"], {"x": "1", "y": "2", "z": "3"})
+            self.assertEqual(c["a"].comments, [("y", "# two")])
+            self.assertEqual(c["b"].comments, [(None, "# three")])
+        c = LazyConf(text, profile=profile)
+        self.assertEqual(c["a"].comments, [("y", "# two")])
+        self.assertEqual(c["b"].comments, [(None, "# three")])
+        # Replaced position by position;  the rest of a longer earlier block is kept
+        text = "[a]\n# c1\n# c2\nx = 1\n[a]\n# d1\ny = 2\n"
+        for backend in (PARSER_BACKEND_FUSED, PARSER_BACKEND_LEGACY):
+            c = parse_string(text, dup_stanza=DUP_MERGE, keep_comments=True, backend=backend)
+            self.assertEqual(c["a"].comments, [("y", "# d1"), ("x", "# c2")])
+            out = StringIO()
+            write_conf(out, c)
+            self.assertEqual(out.getvalue(), "[a]\n# d1\n# c2\nx = 1\ny = 2\n")
+        c = LazyConf(text, profile=profile)
+        self.assertEqual(c["a"].comments, [("y", "# d1"), ("x", "# c2")])
+
+    def test_merge_prepends_comments(self):
+        a = parse_string("[x]\n# from a\nk = 1\n", keep_comments=True)
+        b = parse_string("[x]\n# from b\nk = 2\n# from a\n", keep_comments=True)
+        d = merge_conf_dicts(a, b)
+        self.assertEqual(d["x"], {"k": "2"})
+        self.assertEqual([text for (_, text) in d["x"].comments], ["# from b", "# from a"])
+
+
+class ContentDigestTestCase(unittest.TestCase):
+    sample = dedent("""\
+    # Global comment
+    x = 1
+
+    [a]
+    # Before b
+    b = 2
+    c = 3
+    [b]
+    """)
+
+    def test_order_insensitive(self):
+        a = parse_string(self.sample, keep_comments=True)
+        b = parse_string("[a]\nc=3\nb =  2\n[b]\n", keep_comments=True)
+        b[GLOBAL_STANZA] = Stanza(x="1")
+        self.assertEqual(a.digest(), b.digest())
+        self.assertEqual(a["a"].hexdigest(), b["a"].hexdigest())
+        self.assertEqual(conf_digest(dict(a)), a.digest())
+        self.assertEqual(stanza_digest({"c": "3", "b": "2"}), a["a"].digest())
+        # The global stanza is distinct from a stanza named 'GLOBAL';  values aren't just text
+        self.assertNotEqual(conf_digest({"GLOBAL": {"x": "1"}}),
+                            conf_digest({GLOBAL_STANZA: {"x": "1"}}))
+        self.assertNotEqual(stanza_digest({"x": 1}), stanza_digest({"x": "1"}))
+        self.assertNotEqual(stanza_digest({"a": "b=c"}), stanza_digest({"a=b": "c"}))
+
+    def test_native_strings(self):
+        """ Native strings (bytes on Python 2) have the same digest as the equivalent text """
+        text = {"caf\u00e9": {"k": "v\u00e9"}, GLOBAL_STANZA: {"x": "1"}}
+        native = {str("b"): {str("k"): str("v")}, GLOBAL_STANZA: {str("x"): str("1")}}
+        if six.PY2:
+            native["caf\u00e9".encode("utf-8")] = {str("k"): "v\u00e9".encode("utf-8")}
+        else:
+            native["caf\u00e9"] = {"k": "v\u00e9"}
+        text["b"] = {"k": "v"}
+        self.assertEqual(conf_digest(native), conf_digest(text))
+        self.assertEqual(stanza_digest(native[str("b")]), stanza_digest(text["b"]))
+
+    def test_changes(self):
+        c = parse_string(self.sample)
+        digest = c.digest()
+        stanza_digest_ = c["a"].digest()
+        c["a"]["b"] = "4"
+        self.assertNotEqual(c["a"].digest(), stanza_digest_)
+        self.assertNotEqual(c.digest(), digest)
+        c["a"].update(b="2")
+        self.assertEqual(c.digest(), digest)
+        c["a"].pop("c")
+        self.assertNotEqual(c.digest(), digest)
+        c["a"].setdefault("c", "3")
+        self.assertEqual(c.digest(), digest)
+        del c["b"]
+        self.assertNotEqual(c.digest(), digest)
+        c["b"] = {}
+        self.assertEqual(c.digest(), digest)
+
+    def test_copies(self):
+        c = parse_string(self.sample)
+        digest = c.digest()
+        copies = (deepcopy(c), pickle.loads(pickle.dumps(c)),
+                  Conf((name, stanza.copy()) for (name, stanza) in c.items()))
+        for copied in copies:
+            self.assertEqual(copied["a"]._digest, c["a"].digest())
+            self.assertEqual(copied.digest(), digest)
+            copied["a"]["b"] = "4"
+            self.assertNotEqual(copied.digest(), digest)
+        self.assertEqual(c.digest(), digest)
+
+    def test_compare_and_merge(self):
+        a = parse_string(self.sample)
+        b = parse_string(self.sample)
+        a.digest(), b.digest()
+        self.assertEqual(compare_cfgs(a, b)[0].tag, DIFF_OP_EQUAL)
+        b["a"]["b"] = "4"
+        diffs = compare_cfgs(a, b)
+        self.assertEqual([op.tag for op in diffs if getattr(op.location, "key", None) == "b"],
+                         [DIFF_OP_REPLACE])
+        merged = merge_conf_dicts(a, a, b)
+        self.assertEqual(merged, b)
+        self.assertEqual(merged.digest(), b.digest())
+
+    def test_parsed_digests(self):
+        """ Parsing computes the digests, so same_content() matches without calling digest() """
+        twd = tempfile.mkdtemp()
+        try:
+            files = []
+            for (i, text) in enumerate((self.sample, "x = 1\n[a]\nc = 3\nb = 2\n[b]\n")):
+                fn = os.path.join(twd, "{0}.conf".format(i))
+                with open(fn, "w") as f:
+                    f.write(text)
+                files.append(fn)
+            (a, b) = [parse_conf(fn) for fn in files]
+            self.assertTrue(same_content(a, b))
+            self.assertTrue(same_content(a["a"], b["a"]))
+            self.assertFalse(same_content(a["a"], b["b"]))
+        finally:
+            shutil.rmtree(twd)
+        for backend in (PARSER_BACKEND_LEGACY, PARSER_BACKEND_FUSED):
+            c = parse_string(self.sample, backend=backend)
+            self.assertTrue(same_content(c, a))
+            self.assertTrue(same_content(c["a"], a["a"]))
+        # Text with NULs can't be confused with the separator
+        self.assertNotEqual(stanza_digest({"a": "b\0c"}), stanza_digest({"a\0b": "c"}))
+        self.assertNotEqual(stanza_digest({"a": "b\0c"}), stanza_digest({"a": "b", "c": ""}))
+
+    def test_smart_write_skips_render(self):
+        twd = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(twd, "a.conf")
+            manifest = WriteManifest(os.path.join(twd, "manifest.json"))
+            c = parse_string(self.sample, keep_comments=True)
+            self.assertEqual(smart_write_conf(fn, c, manifest=manifest), SMART_CREATE)
+            self.assertEqual(smart_write_conf(fn, deepcopy(c), manifest=manifest), SMART_NOCHANGE)
+            # Comments aren't part of the content digest, but they still change the output
+            c["a"].comments.append((None, "# New comment"))
+            self.assertEqual(smart_write_conf(fn, c, manifest=manifest), SMART_UPDATE)
+            with open(fn) as f:
+                self.assertIn("# New comment", f.read())
+            self.assertEqual(smart_write_conf(fn, c, manifest=manifest), SMART_NOCHANGE)
+        finally:
+            shutil.rmtree(twd)
+
+
+class LazyConfTestCase(unittest.TestCase):
+    """ LazyConf must be indistinguishable from a fully parsed conf dict. """
+    sample = dedent("""\
+    # Global comment
+    [launcher]
+    author = Bob
+    version = 1.0.0
+
+    [ui]
+    label = My app \\
+    [still the label]
+    is_visible = 1
+    [empty]
+    [install]
+    state = enabled
+    """)
+
+    def test_matches_parse_conf(self):
+        for profile in (PARSECONF_MID, PARSECONF_LOOSE):
+            expected = parse_string(self.sample, profile)
+            for data in (self.sample, self.sample.encode("utf-8"),
+                         self.sample.replace("\n", "\r\n").encode("utf-8-sig"),
+                         self.sample.encode("utf-16")):
+                conf = LazyConf(data, profile=profile)
+                self.assertEqual(list(conf), list(expected))
+                self.assertEqual(dict(conf.items()), expected)
+                self.assertEqual(conf, expected)
+
+    def test_parse_on_access(self):
+        conf = LazyConf(self.sample.encode("utf-8"), profile=PARSECONF_LOOSE)
+        self.assertEqual(len(conf), 3)
+        self.assertNotIn("empty", conf)
+        self.assertEqual(conf["launcher"]["version"], "1.0.0")
+        self.assertEqual(conf.get("ui", {}).get("label"), "My app \n[still the label]")
+        self.assertEqual(sorted(conf._stanzas), ["launcher", "ui"])
+        with self.assertRaises(KeyError):
+            conf["missing"]
+
+    def test_merge_and_compare(self):
+        conf = LazyConf(self.sample, profile=PARSECONF_MID)
+        copied = deepcopy(conf)
+        self.assertIsInstance(copied, dict)
+        copied["install"]["state"] = "disabled"
+        self.assertEqual(conf["install"]["state"], "enabled")
+        merged = merge_conf_dicts(conf, {"launcher": {"version": "2.0.0"}})
+        self.assertEqual(merged["launcher"], {"author": "Bob", "version": "2.0.0"})
+        self.assertEqual(compare_cfgs(conf, parse_string(self.sample, PARSECONF_MID))[0].tag,
+                         DIFF_OP_EQUAL)
+
+    def test_errors(self):
+        with self.assertRaises(DuplicateStanzaException):
+            LazyConf("[a]\nx = 1\n[a]\ny = 2\n", profile=PARSECONF_MID)
+        # Body errors are only reported once the offending stanza is used
+        conf = LazyConf("[a]\nx = 1\n[b]\njunk\n", profile=PARSECONF_MID)
+        self.assertEqual(conf["a"], {"x": "1"})
+        with self.assertRaises(ConfParserException):
+            conf["b"]
+        # Errors before the first stanza need the stanza list, but still not on creation
+        conf = LazyConf("junk\n[a]\nx = 1\n", profile=PARSECONF_MID)
+        self.assertEqual(conf["a"], {"x": "1"})
+        self.assertIn("a", conf)
+        with self.assertRaises(ConfParserException):
+            list(conf)
+        with self.assertRaises(ConfParserException):
+            len(conf)
+
 
 # @unittest.expectedFailure()
 
@@ -446,6 +1011,185 @@ class ConfigDiffTestCase(unittest.TestCase):
         self.assertEqual(len(diffs), 1)
         self.assertEqual(diffs[0].location.type, "global")
 
+    def test_iter_compare(self):
+        c1 = parse_string(dedent(self.cfg_props_imapsync_1) + "[same]\na = 1\n")
+        c2 = parse_string(dedent(self.cfg_props_imapsync_2) + "[same]\na = 1\n")
+        diffs = iter_compare_cfgs(c1, c2)
+        self.assertNotIsInstance(diffs, list)
+        self.assertEqual(list(diffs), compare_cfgs(c1, c2))
+        ops = list(iter_compare_cfgs(c1, c2, skip_identical=True))
+        self.assertIsNone(self.find_op_by_location(ops, "stanza", stanza="same"))
+        op = self.find_op_by_location(ops, "key", stanza="imapsync", key="LINE_BREAKER")
+        self.assertEqual(op.tag, DIFF_OP_EQUAL)
+        ops = list(iter_compare_cfgs(c1, c2, skip_equal=True))
+        self.assertNotIn(DIFF_OP_EQUAL, [op.tag for op in ops])
+        self.assertEqual(ops, [op for op in compare_cfgs(c1, c2) if op.tag != DIFF_OP_EQUAL])
+        # The global result is still reported
+        ops = list(iter_compare_cfgs(c1, deepcopy(c1), skip_equal=True))
+        self.assertEqual([(op.tag, op.location.type) for op in ops], [(DIFF_OP_EQUAL, "global")])
+
+    def test_compare_many(self):
+        base = parse_string(self.cfg_props_imapsync_1)
+        others = [parse_string(self.cfg_props_imapsync_2), deepcopy(base),
+                  parse_string(self.cfg_macros_1)]
+        deltas = list(compare_cfgs_many(base, others))
+        self.assertEqual(len(deltas), 3)
+        self.assertEqual(deltas[1], [])
+        for (other, delta) in zip(others, deltas):
+            self.assertEqual(delta, list(iter_compare_cfgs(base, other, allow_level0=False,
+                                                           skip_equal=True)))
+        output = StringIO()
+        self.assertEqual(show_diff_matrix(output, "base.conf", ["a", "b", "c"], deltas), 2)
+        out = output.getvalue()
+        self.assertIn("2 of 3 files differ", out)
+        self.assertRegex(out, r"[\r\n]  ~\.\.  \[imapsync\] NO_BINARY_CHECK[\r\n]")
+        self.assertRegex(out, r"[\r\n]  \.\.-  \[imapsync\][\r\n]")
+        self.assertRegex(out, r"[\r\n]  \.\.\+  \[comment\(1\)\][\r\n]")
+
+    def test_diff_stats(self):
+        def stats_from_ops(ops):
+            stats = {}
+            for op in ops:
+                stanza = op.location.stanza
+                if isinstance(op.location, DiffStzKey):
+                    counts = stats.setdefault(stanza, [DIFF_OP_REPLACE, 0, 0, 0])
+                    counts[{DIFF_OP_INSERT: 1, DIFF_OP_DELETE: 2, DIFF_OP_REPLACE: 3}[op.tag]] += 1
+                elif op.tag == DIFF_OP_INSERT:
+                    stats[stanza] = [op.tag, len(op.a), 0, 0]
+                elif op.tag == DIFF_OP_DELETE:
+                    stats[stanza] = [op.tag, 0, len(op.b), 0]
+            return [StanzaStat(stanza, *counts) for (stanza, counts) in sorted(stats.items())]
+
+        a = parse_string(self.cfg_props_imapsync_1)
+        b = parse_string(self.cfg_props_imapsync_2)
+        stats = list(iter_diff_stats(a, b))
+        self.assertEqual(stats[0], StanzaStat("imapsync", DIFF_OP_REPLACE, 1, 3, 1))
+        for other in (b, parse_string(self.cfg_macros_1)):
+            self.assertListEqual(list(iter_diff_stats(a, other)), stats_from_ops(
+                iter_compare_cfgs(a, other, allow_level0=False, skip_equal=True)))
+        self.assertListEqual(list(iter_diff_stats(a, deepcopy(a))), [])
+        # Stanzas of separately parsed files are matched by their parsed digests alone;  a
+        # change that isn't tracked (and so keeps the digest) proves the keys aren't compared.
+        c = parse_string(self.cfg_props_imapsync_1)
+        dict.__setitem__(c["imapsync"], "LINE_BREAKER", "changed")
+        self.assertListEqual(list(iter_diff_stats(a, c)), [])
+
+    def test_stanza_renames(self):
+        a = parse_string("""
+        [Errors by host]
+        search = index=main error | stats count by host
+        cron_schedule = */5 * * * *
+        dispatch.earliest_time = -5m
+        enableSched = 1
+        [Copy of errors]
+        search = index=main error | stats count by host
+        [unchanged]
+        x = 1
+        [removed]
+        y = 2
+        """)
+        b = parse_string("""
+        [Errors by host (v2)]
+        search = index=main error | stats count by host
+        cron_schedule = */5 * * * *
+        dispatch.earliest_time = -15m
+        enableSched = 1
+        [Errors copy]
+        search = index=main error | stats count by host
+        [unchanged]
+        x = 1
+        [added]
+        y = 3
+        """)
+        self.assertEqual(find_stanza_renames(a, b), {"Errors by host": "Errors by host (v2)",
+                                                     "Copy of errors": "Errors copy"})
+        self.assertEqual(find_stanza_renames(a, b, threshold=0.9), {"Copy of errors": "Errors copy"})
+        # Off by default
+        self.assertNotIn(DIFF_OP_RENAME, [op.tag for op in compare_cfgs(a, b)])
+        ops = list(iter_compare_cfgs(a, b, renames=True, skip_equal=True))
+        self.assertEqual([(op.tag, op.location.stanza) for op in ops], [
+            ("rename", "Copy of errors"),
+            ("rename", "Errors by host"),
+            ("insert", "added"),
+            ("delete", "removed")])
+        self.assertEqual(ops[1].location, DiffStzRename("rename", "Errors by host",
+                                                        "Errors by host (v2)"))
+        self.assertEqual(ops[1].a["dispatch.earliest_time"], "-5m")
+        self.assertEqual(ops[1].b["dispatch.earliest_time"], "-15m")
+        self.assertEqual(diff_op_to_dict(ops[0])["new_stanza"], "Errors copy")
+        # A renamed stanza is the only one in common
+        ops = list(iter_compare_cfgs(parse_string("[a]\nx = 1\n"), parse_string("[b]\nx = 1\n"),
+                                     renames=True))
+        self.assertEqual(len(ops), 1)
+        self.assertEqual(ops[0].location, DiffStzRename("rename", "a", "b"))
+
+    def test_diff_jsonl(self):
+        import json
+        a = parse_string(self.cfg_props_imapsync_1)
+        b = parse_string(self.cfg_props_imapsync_2)
+        diffs = compare_cfgs(a, b)
+        output = StringIO()
+        self.assertEqual(write_diff_jsonl(output, iter(diffs)), EXIT_CODE_DIFF_CHANGE)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), len(diffs))
+        ops = dict(((d["type"], d.get("stanza"), d.get("key")), d)
+                   for d in (json.loads(line) for line in lines))
+        # 'a' and 'b' are always the first and second conf's values
+        self.assertEqual(ops["key", "imapsync", "DATETIME_CONFIG"],
+                         {"tag": "delete", "type": "key", "stanza": "imapsync",
+                          "key": "DATETIME_CONFIG", "a": "", "b": None})
+        self.assertEqual(ops["key", "imapsync", "description"]["a"], None)
+        self.assertEqual(ops["key", "imapsync", "NO_BINARY_CHECK"]["a"], "true")
+        # Equal ops can be skipped;  files with nothing in common give a single global op
+        output = StringIO()
+        write_diff_jsonl(output, compare_cfgs(a, b), skip_equal=True)
+        self.assertNotIn('"equal"', output.getvalue())
+        d = diff_op_to_dict(compare_cfgs(parse_string("g = 1\n[x]\n"), parse_string("[y]\n"))[0])
+        self.assertEqual(d, {"tag": "replace", "type": "global",
+                             "a": [{"stanza": None, "keys": {"g": "1"}},
+                                   {"stanza": "x", "keys": {}}],
+                             "b": [{"stanza": "y", "keys": {}}]})
+        # Native strings (bytes on Python 2) are written out exactly like text
+        def native(value):
+            return value.encode("utf-8") if six.PY2 else value
+        a = {native("caf\u00e9"): {native("k"): native("\u00e9")}, native("b"): {},
+             GLOBAL_STANZA: {native("g"): native("1")}}
+        b = {native("z"): {}}
+        output = StringIO()
+        write_diff_jsonl(output, compare_cfgs(a, b), skip_equal=True)
+        d = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(d[0]["a"], [{"stanza": None, "keys": {"g": "1"}},
+                                     {"stanza": "b", "keys": {}},
+                                     {"stanza": "caf\u00e9", "keys": {"k": "\u00e9"}}])
+
+    def test_text_diff_unified(self):
+        import difflib
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        a = ["line {0}\n".format(i) for i in range(100)]
+        b = list(a)
+        b[20] = "changed\n"
+        del b[60:62]
+        b.append("last")
+        (path_a, path_b) = (os.path.join(tmpdir, "a.txt"), os.path.join(tmpdir, "b.txt"))
+        for (path, lines) in ((path_a, a), (path_b, b)):
+            with open(path, "w") as f:
+                f.write("".join(lines))
+        output = StringIO()
+        show_text_diff(output, path_a, path_b, context=3)
+        hunks = output.getvalue().splitlines(True)[3:]
+        expected = list(difflib.unified_diff(a, b, n=3))[2:]
+        self.assertListEqual(hunks[:-2], expected[:-1])
+        self.assertListEqual(hunks[-2:], ["+last\n", "\\ No newline at end of file\n"])
+        # Over the size limit, only a summary is shown
+        output = StringIO()
+        show_text_diff(output, path_a, path_b, context=3, max_size=100)
+        out = output.getvalue()
+        self.assertIn("larger than 100 bytes", out)
+        self.assertRegex(out, r"[\r\n]- +{0} bytes  sha256:[0-9a-f]{{64}}[\r\n]".format(
+            os.path.getsize(path_a)))
+        self.assertNotIn("@@", out)
+
 
 class ConfigMergeTestCase(unittest.TestCase):
 
@@ -489,6 +1233,119 @@ class ConfigMergeTestCase(unittest.TestCase):
         """)
         self.assertNotIn("y", d)
 
+    def test_layered_conf(self):
+        layers = [parse_string(txt, keep_comments=True) for txt in ("""
+        [x]
+        a = 1
+        [y]
+        b = 2
+        [z]
+        c = 3
+        """, """
+        [x]
+        # Override
+        a = one
+        [y]
+        _stanza = <<DROP>>
+        [new]
+        d = 4
+        """)]
+        original = deepcopy(layers)
+        layered = LayeredConf(*layers)
+        self.assertEqual(layered, merge_conf_dicts(*layers))
+        self.assertEqual(sorted(layered), ["new", "x", "z"])
+        self.assertEqual(layered["x"], {"a": "one"})
+        self.assertEqual(layered["x"].comments, [("a", "# Override")])
+        # Stanzas from a single layer aren't copied, unless they're materialized
+        self.assertIs(layered["z"], layers[0]["z"])
+        z = layered.materialize("z")
+        self.assertIsNot(z, layers[0]["z"])
+        self.assertIs(layered["z"], z)
+        z["c"] = "three"
+        layered.materialize(GLOBAL_STANZA).comments.append((None, "# Banner"))
+        layered["y"] = Stanza(b="two")
+        del layered["new"]
+        self.assertEqual(sorted(layered, key=str), [GLOBAL_STANZA, "x", "y", "z"])
+        self.assertEqual(layered["z"], {"c": "three"})
+        # The layers are never modified
+        self.assertEqual(layers, original)
+        self.assertEqual([l[s].comments for l in layers for s in l],
+                         [o[s].comments for o in original for s in o])
+        self.assertEqual(deepcopy(layered), dict(layered.items()))
+
+    def test_merge3(self):
+        base = parse_string("""
+        [same]
+        a = 1
+        [ours]
+        a = 1
+        [theirs]
+        a = 1
+        b = 2
+        [both]
+        a = 1
+        b = 2
+        c = 3
+        [removed]
+        a = 1
+        [conflict]
+        a = 1
+        """)
+        ours = parse_string("""
+        [same]
+        a = 1
+        [ours]
+        a = ours
+        [theirs]
+        a = 1
+        b = 2
+        [both]
+        a = ours
+        b = 2
+        [removed]
+        a = 1
+        [conflict]
+        a = 1
+        [added]
+        a = ours
+        """)
+        theirs = parse_string("""
+        [same]
+        a = 1
+        [ours]
+        a = 1
+        [theirs]
+        a = theirs
+        [both]
+        a = ours
+        b = theirs
+        c = 3
+        [conflict]
+        a = theirs
+        [added]
+        a = theirs
+        """)
+        (merged, conflicts) = merge3(base, ours, theirs)
+        self.assertEqual(merged, {
+            "same": {"a": "1"},
+            "ours": {"a": "ours"},
+            "theirs": {"a": "theirs"},
+            "both": {"a": "ours", "b": "theirs"},
+            "conflict": {"a": "theirs"},
+            "added": {"a": "ours"},
+        })
+        self.assertIsInstance(merged["both"], Stanza)
+        self.assertEqual(conflicts, [MergeConflict("added", "a", None, "ours", "theirs")])
+        # Removed on one side, but modified on the other
+        ours["removed"]["a"] = "2"
+        (merged, conflicts) = merge3(base, ours, theirs, prefer=MERGE3_THEIRS)
+        self.assertNotIn("removed", merged)
+        self.assertEqual(merged["added"], {"a": "theirs"})
+        self.assertEqual([(c.stanza, c.key) for c in conflicts], [("added", "a"), ("removed", None)])
+        # The inputs are never modified
+        merged["same"]["a"] = "2"
+        self.assertEqual(base["same"]["a"], "1")
+
 
 class UtilFunctionTestCase(unittest.TestCase):
 
@@ -498,6 +1355,85 @@ class UtilFunctionTestCase(unittest.TestCase):
         b = list(relwalk(cwd + os.path.sep))
         self.assertListEqual(a, b, "should return the same paths with or without a trailing slash")
 
+    def test_line_opcodes(self):
+        a = ["search index=main", "| stats count by host", "| where count > 10", "| sort - count",
+             "| head 10"]
+        b = ["search index=main", "| eval host=lower(host)", "| stats count by host",
+             "| where count > 20", "| sort - count"]
+        self.assertListEqual(line_opcodes(a, b), [
+            ("equal", 0, 1, 0, 1),
+            ("insert", 1, 1, 1, 2),
+            ("equal", 1, 2, 2, 3),
+            ("replace", 2, 3, 3, 4),
+            ("equal", 3, 4, 4, 5),
+            ("delete", 4, 5, 5, 5)])
+        self.assertListEqual(line_opcodes([], []), [])
+        self.assertListEqual(line_opcodes(["x", "x"], []), [("delete", 0, 2, 0, 0)])
+        # Lines that aren't unique on either side
+        self.assertListEqual(line_opcodes(["a", "b", "a", "b"], ["b", "a", "b", "b"]), [
+            ("delete", 0, 1, 0, 0),
+            ("equal", 1, 3, 0, 2),
+            ("insert", 3, 3, 2, 3),
+            ("equal", 3, 4, 3, 4)])
+
+    def test_diff_lines(self):
+        import difflib
+        a = ["[search]", "a = 1", "b = 2"]
+        b = ["[search]", "a = 10", "b = 2"]
+        # Small inputs give the same output as difflib
+        self.assertListEqual(list(diff_lines(a, b)), list(difflib.Differ().compare(a, b)))
+        # Large inputs:  only small blocks of changes get intra-line hints
+        a = ["| eval f{0} = lower(src{0})".format(i) for i in range(500)]
+        b = list(a)
+        b[10] = b[10].replace("lower", "upper")
+        for i in range(200, 300):
+            b[i] = b[i].replace("lower", "upper")
+        lines = list(diff_lines(a, b))
+        self.assertEqual(len([line for line in lines if line.startswith("?")]), 2)
+        self.assertEqual(lines[10], "- | eval f10 = lower(src10)")
+        self.assertListEqual([line[0] for line in lines[10:14]], ["-", "?", "+", "?"])
+        self.assertListEqual([line[2:] for line in lines if line[0] in " -"], a)
+        self.assertListEqual([line[2:] for line in lines if line[0] in " +"], b)
+        self.assertEqual(lines[203], "- | eval f200 = lower(src200)")
+        self.assertEqual(lines[303], "+ | eval f200 = upper(src200)")
+
+    def test_term_writer(self):
+        class TtyStream(StringIO):
+            flushes = 0
+
+            def isatty(self):
+                return True
+
+            def flush(self):
+                self.flushes += 1
+
+        expected = TtyStream()
+        stream = TtyStream()
+        out = TermWriter(stream, buffer_size=100)
+        for i in range(30):
+            tty_color(expected, ANSI_GREEN)
+            expected.write("line {0}\n".format(i))
+            tty_color(expected, ANSI_RESET)
+            out.color(ANSI_GREEN)
+            out.write("line {0}\n".format(i))
+            out.color(ANSI_RESET)
+        # Nothing is written until the buffer is full, and the stream is only flushed at the end
+        self.assertLess(len(stream.getvalue()), len(expected.getvalue()))
+        self.assertGreater(len(stream.getvalue()), 0)
+        self.assertEqual(stream.flushes, 0)
+        out.flush()
+        self.assertEqual(stream.getvalue(), expected.getvalue())
+        self.assertEqual(stream.flushes, 1)
+
+        # No color codes for a non-tty stream
+        stream = StringIO()
+        out = TermWriter(stream)
+        out.color(ANSI_GREEN)
+        out.write("text")
+        out.color(ANSI_RESET)
+        out.flush()
+        self.assertEqual(stream.getvalue(), "text")
+
 
 if __name__ == '__main__':  # pragma: no cover
     unittest.main()